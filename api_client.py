@@ -1,4 +1,5 @@
 import asyncio
+from typing import AsyncIterator, Optional
 
 import httpx
 
@@ -6,6 +7,61 @@ API_BASE_URL = "http://127.0.0.1:8000"  # Change if hosted elsewhere
 DEFAULT_PROMPT = "Create a function that sorts a list using bubble sort."
 
 
+class APIError(Exception):
+    """A non-200 response from the API."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code} - {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+async def stream_generate_code(
+    client: httpx.AsyncClient,
+    prompt: str,
+    base_url: str = API_BASE_URL,
+    payload: Optional[dict] = None,
+) -> AsyncIterator[str]:
+    """
+    Send a prompt to the `/generate-code/` endpoint and yield the streamed text.
+
+    Args:
+        client (httpx.AsyncClient): The client to send the request with.
+        prompt (str): The prompt to send.
+        base_url (str, optional): Where the API is served. Defaults to API_BASE_URL.
+        payload (dict, optional): Request body to send instead of `{"prompt": prompt}`.
+
+    Yields:
+        str: The streamed text chunks.
+
+    Raises:
+        APIError: If the API answers with a status other than 200.
+    """
+    async with client.stream(
+        "POST", f"{base_url}/generate-code/", json=payload or {"prompt": prompt}
+    ) as response:
+        if response.status_code != 200:
+            error_message = await response.aread()  # Read error from stream
+            raise APIError(response.status_code, error_message.decode("utf-8"))
+        async for chunk in response.aiter_text():
+            yield chunk
+
+
+async def print_stream(client: httpx.AsyncClient, prompt: str, **kwargs) -> None:
+    """
+    Print a streamed response, or the API error it failed with.
+    """
+    try:
+        started = False
+        async for chunk in stream_generate_code(client, prompt, **kwargs):
+            if not started:
+                print("\nStreaming response:")
+                started = True
+            print(chunk, end="")
+    except APIError as e:
+        print(f"Error: {e}")
+
+
 async def test_generate_code(prompt: str):
     """
     Test the `/generate-code/` endpoint by sending a prompt and printing the streamed response.
@@ -13,19 +69,7 @@ async def test_generate_code(prompt: str):
     print("\nRunning Test: Generate Code (Normal)")
     async with httpx.AsyncClient() as client:
         try:
-            async with client.stream(
-                "POST", f"{API_BASE_URL}/generate-code/", json={"prompt": prompt}
-            ) as response:
-                if response.status_code != 200:
-                    error_message = await response.aread()  # Read error from stream
-                    print(
-                        f"Error: {response.status_code} - {error_message.decode('utf-8')}"
-                    )
-                    return
-
-                print("\nStreaming response:")
-                async for chunk in response.aiter_text():
-                    print(chunk, end="")
+            await print_stream(client, prompt)
         except httpx.RequestError as e:
             print(f"An error occurred while requesting the API: {e}")
 
@@ -37,19 +81,7 @@ async def test_generate_code_timeout(prompt: str, timeout: float):
     print("\nRunning Test: Generate Code with Timeout")
     async with httpx.AsyncClient(timeout=timeout) as client:
         try:
-            async with client.stream(
-                "POST", f"{API_BASE_URL}/generate-code/", json={"prompt": prompt}
-            ) as response:
-                if response.status_code != 200:
-                    error_message = await response.aread()
-                    print(
-                        f"Error: {response.status_code} - {error_message.decode('utf-8')}"
-                    )
-                    return
-
-                print("\nStreaming response:")
-                async for chunk in response.aiter_text():
-                    print(chunk, end="")
+            await print_stream(client, prompt)
         except httpx.ReadTimeout:
             print(f"Request timed out after {timeout} seconds.")
         except httpx.RequestError as e:
@@ -64,19 +96,7 @@ async def test_generate_code_invalid_payload(prompt: str):
     async with httpx.AsyncClient() as client:
         try:
             # Sending an invalid payload to trigger an error
-            async with client.stream(
-                "POST", f"{API_BASE_URL}/generate-code/", json={"invalid_key": prompt}
-            ) as response:
-                if response.status_code != 200:
-                    error_message = await response.aread()
-                    print(
-                        f"Error: {response.status_code} - {error_message.decode('utf-8')}"
-                    )
-                    return
-
-                print("\nStreaming response:")
-                async for chunk in response.aiter_text():
-                    print(chunk, end="")
+            await print_stream(client, prompt, payload={"invalid_key": prompt})
         except httpx.RequestError as e:
             print(f"An error occurred while requesting the API: {e}")
 
@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted. Carries a Retry-After hint."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionRejected):
+    """The wait queue is full."""
+
+
+class QueueTimeoutError(AdmissionRejected):
+    """The request waited in the queue past its deadline."""
+
+
+class Slot:
+    """An admitted request. Releasing it more than once is a no-op."""
+
+    def __init__(self, controller: "AdmissionController"):
+        self._controller = controller
+        self._acquired_at = controller.clock()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._controller._release(self._controller.clock() - self._acquired_at)
+
+
+class _Waiter(NamedTuple):
+    future: asyncio.Future
+    cost: int
+
+
+class FairQueue:
+    """
+    A wait queue with strict priority levels and per-client fairness.
+
+    Higher priority levels are always served first. Within a level, clients take
+    turns by deficit round robin: each turn credits a client `quantum` units and
+    its requests are charged their estimated token cost, so a tenant sending
+    huge prompts gets the same token share as everyone else instead of
+    starving them.
+    """
+
+    def __init__(self, quantum: int = 1024):
+        self.quantum = quantum
+        # priority -> client -> waiters, clients in round-robin order
+        self._levels: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = {}
+        self._deficits: Dict[int, Dict[str, int]] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def push(self, future: asyncio.Future, client: str, priority: int, cost: int):
+        clients = self._levels.setdefault(priority, OrderedDict())
+        if client not in clients:
+            clients[client] = deque()
+            self._deficits.setdefault(priority, {})[client] = 0
+        clients[client].append(_Waiter(future, max(1, cost)))
+        self._size += 1
+
+    def discard(self, future: asyncio.Future) -> None:
+        """Account for a cancelled waiter. It is skipped lazily when reached."""
+        self._size -= 1
+
+    def pop(self) -> Optional[asyncio.Future]:
+        """Return the next waiter to admit, or None if the queue is empty."""
+        for priority in sorted(self._levels, reverse=True):
+            future = self._pop_level(priority)
+            if future is not None:
+                return future
+        return None
+
+    def _pop_level(self, priority: int) -> Optional[asyncio.Future]:
+        clients = self._levels[priority]
+        deficits = self._deficits[priority]
+        while clients:
+            client, waiters = next(iter(clients.items()))
+            while waiters and waiters[0].future.done():
+                waiters.popleft()  # Cancelled while waiting
+            if not waiters:
+                del clients[client], deficits[client]
+                continue
+            head = waiters[0]
+            if deficits[client] < head.cost:
+                deficits[client] += self.quantum
+                if deficits[client] < head.cost:
+                    clients.move_to_end(client)
+                    continue
+            waiters.popleft()
+            deficits[client] -= head.cost
+            if not waiters:
+                # An idle client does not bank credit
+                del clients[client], deficits[client]
+            self._size -= 1
+            return head.future
+        del self._levels[priority], self._deficits[priority]
+        return None
+
+    def clients(self) -> int:
+        return sum(len(clients) for clients in self._levels.values())
+
+
+class AdmissionController:
+    """
+    A concurrency governor for upstream streams.
+
+    At most `max_concurrent` requests hold a slot. Up to `max_queue` more wait in
+    a FairQueue, each for at most `queue_timeout` seconds. Anything beyond that
+    is rejected straight away so the route can shed load with a 503.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 64,
+        max_queue: int = 256,
+        queue_timeout: float = 10.0,
+        quantum: int = 1024,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the AdmissionController.
+
+        Args:
+            max_concurrent (int, optional): Maximum in-flight upstream streams. Defaults to 64.
+            max_queue (int, optional): Maximum requests waiting for a slot. Defaults to 256.
+            queue_timeout (float, optional): Longest a request may wait, in seconds. Defaults to 10.0.
+            quantum (int, optional): Tokens credited to a client per fair-queueing turn. Defaults to 1024.
+            clock (Callable[[], float], optional): Time source. Defaults to time.monotonic.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.in_flight = 0
+        self._waiters = FairQueue(quantum)
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_wait = 0.0  # Exponentially weighted
+        self.avg_hold = 1.0  # Exponentially weighted seconds a slot is held
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def saturated(self) -> bool:
+        """Whether a new request would have to wait."""
+        return self.in_flight >= self.max_concurrent or bool(self._waiters)
+
+    def retry_after(self) -> int:
+        """
+        Estimate how many seconds until a slot is likely to free up.
+        """
+        backlog = (self.queued + 1) / max(self.max_concurrent, 1)
+        return min(60, max(1, math.ceil(backlog * self.avg_hold)))
+
+    async def acquire(
+        self, client: str = "anonymous", cost: int = 1, priority: int = 0
+    ) -> Slot:
+        """
+        Wait for a slot.
+
+        Args:
+            client (str, optional): Client identifier used for fair sharing. Defaults to "anonymous".
+            cost (int, optional): Estimated tokens the request will use. Defaults to 1.
+            priority (int, optional): Higher levels are admitted first. Defaults to 0.
+
+        Returns:
+            Slot: The admitted request, to be released when its stream ends.
+
+        Raises:
+            QueueFullError: If the wait queue is full.
+            QueueTimeoutError: If no slot freed up within `queue_timeout`.
+        """
+        if not self.saturated:
+            self.in_flight += 1
+            self._record_wait(0.0)
+            return Slot(self)
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError("Request queue is full.", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.push(waiter, client, priority, cost)
+        start = self.clock()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            handed_over = waiter.done() and not waiter.cancelled()
+            if not handed_over:
+                waiter.cancel()
+                self._waiters.discard(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timed_out += 1
+                    raise QueueTimeoutError(
+                        "Timed out waiting in the request queue.", self.retry_after()
+                    )
+                raise
+            if isinstance(e, asyncio.CancelledError):
+                # A slot was handed over as the request gave up, pass it on
+                self._release(0.0, record=False)
+                raise
+        self._record_wait(self.clock() - start)
+        return Slot(self)
+
+    def _release(self, held: float, record: bool = True) -> None:
+        if record:
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * held
+        # Hand the slot straight to the next waiter
+        waiter = self._waiters.pop()
+        if waiter is not None:
+            waiter.set_result(None)
+            return
+        self.in_flight -= 1
+
+    def _record_wait(self, wait: float) -> None:
+        self.admitted += 1
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * wait
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "clients_waiting": self._waiters.clients(),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "last_wait": round(self.last_wait, 4),
+            "avg_wait": round(self.avg_wait, 4),
+            "max_wait": round(self.max_wait, 4),
+        }
@@ -0,0 +1,223 @@
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("least_outstanding", "headroom")
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a rate-limit reset duration such as "20ms", "1.5s" or "6m0s".
+
+    Returns:
+        float: Seconds, or None if the value cannot be parsed.
+    """
+    if not value:
+        return None
+    parts = _DURATION.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+@dataclass
+class UpstreamTarget:
+    """
+    One upstream: an API key, a chat completions URL and the model to request.
+    """
+
+    api_key: str
+    api_url: str = "https://api.openai.com/v1/chat/completions"
+    model: str = "gpt-4"
+    name: str = ""
+    outstanding: int = field(default=0, init=False)
+    failures: int = field(default=0, init=False)
+    open_until: float = field(default=0.0, init=False)
+    remaining_requests: Optional[int] = field(default=None, init=False)
+    remaining_tokens: Optional[int] = field(default=None, init=False)
+    limit_requests: Optional[int] = field(default=None, init=False)
+    limit_tokens: Optional[int] = field(default=None, init=False)
+    reset_at: float = field(default=0.0, init=False)
+
+    def __post_init__(self):
+        self.name = self.name or f"{self.api_url}#{(self.api_key or '')[-4:]}"
+
+
+class UpstreamBalancer:
+    """
+    Spreads requests over a pool of upstream targets.
+
+    Targets are picked by fewest outstanding requests, or by the most remaining
+    rate-limit headroom parsed from the upstream's x-ratelimit-* headers. A 429
+    opens the target's circuit for its Retry-After. Repeated 5xx or connection
+    failures open it with an exponential cooldown. Once the cooldown passes the
+    target is tried again, and a success closes the circuit.
+    """
+
+    def __init__(
+        self,
+        targets: Iterable[UpstreamTarget],
+        strategy: str = "least_outstanding",
+        failure_threshold: int = 3,
+        cooldown: float = 5.0,
+        max_cooldown: float = 120.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the UpstreamBalancer.
+
+        Args:
+            targets (Iterable[UpstreamTarget]): The upstream pool.
+            strategy (str, optional): "least_outstanding" or "headroom". Defaults to "least_outstanding".
+            failure_threshold (int, optional): Consecutive failures that open a circuit. Defaults to 3.
+            cooldown (float, optional): First cooldown after the circuit opens, in seconds. Defaults to 5.0.
+            max_cooldown (float, optional): Upper bound on the cooldown. Defaults to 120.0.
+            clock (Callable[[], float], optional): Time source. Defaults to time.monotonic.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.targets: List[UpstreamTarget] = list(targets)
+        if not self.targets:
+            raise ValueError("At least one upstream target is required.")
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.failovers = 0
+
+    def _headroom(self, target: UpstreamTarget, now: float) -> float:
+        if now >= target.reset_at:
+            return 1.0  # The window has reset since the last headers
+        ratios = [1.0]
+        if target.remaining_requests is not None and target.limit_requests:
+            ratios.append(target.remaining_requests / target.limit_requests)
+        if target.remaining_tokens is not None and target.limit_tokens:
+            ratios.append(target.remaining_tokens / target.limit_tokens)
+        return min(ratios)
+
+    def _candidates(self, exclude: Iterable[UpstreamTarget]) -> List[UpstreamTarget]:
+        now = self.clock()
+        excluded = {id(target) for target in exclude}
+        return [
+            target
+            for target in self.targets
+            if target.open_until <= now and id(target) not in excluded
+        ]
+
+    def available(self, exclude: Iterable[UpstreamTarget] = ()) -> bool:
+        """Whether any target outside `exclude` can take a request now."""
+        return bool(self._candidates(exclude))
+
+    def acquire(
+        self, exclude: Iterable[UpstreamTarget] = ()
+    ) -> Optional[UpstreamTarget]:
+        """
+        Pick an available target and count it as outstanding.
+
+        Args:
+            exclude (Iterable[UpstreamTarget], optional): Targets already tried for this request.
+
+        Returns:
+            UpstreamTarget: The chosen target, or None if every target is cooling down.
+        """
+        candidates = self._candidates(exclude)
+        if not candidates:
+            return None
+        now = self.clock()
+        if self.strategy == "headroom":
+            target = max(
+                candidates,
+                key=lambda t: (self._headroom(t, now), -t.outstanding),
+            )
+        else:
+            target = min(candidates, key=lambda t: t.outstanding)
+        target.outstanding += 1
+        return target
+
+    def release(self, target: UpstreamTarget) -> None:
+        target.outstanding -= 1
+
+    def next_available_in(self) -> float:
+        """Seconds until the first cooling-down target becomes available."""
+        now = self.clock()
+        return max(0.0, min(target.open_until for target in self.targets) - now)
+
+    def record_headers(
+        self, target: UpstreamTarget, headers: Mapping[str, str]
+    ) -> None:
+        """
+        Update a target's rate-limit headroom from x-ratelimit-* response headers.
+        """
+
+        def number(name: str) -> Optional[int]:
+            value = headers.get(name)
+            try:
+                return int(value) if value is not None else None
+            except ValueError:
+                return None
+
+        remaining_requests = number("x-ratelimit-remaining-requests")
+        remaining_tokens = number("x-ratelimit-remaining-tokens")
+        if remaining_requests is None and remaining_tokens is None:
+            return
+        target.remaining_requests = remaining_requests
+        target.remaining_tokens = remaining_tokens
+        target.limit_requests = number("x-ratelimit-limit-requests")
+        target.limit_tokens = number("x-ratelimit-limit-tokens")
+        resets = [
+            parse_duration(headers.get("x-ratelimit-reset-requests")),
+            parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        ]
+        resets = [reset for reset in resets if reset is not None]
+        target.reset_at = self.clock() + (max(resets) if resets else 60.0)
+
+    def record_success(self, target: UpstreamTarget) -> None:
+        target.failures = 0
+        target.open_until = 0.0
+
+    def record_failure(
+        self, target: UpstreamTarget, retry_after: Optional[float] = None
+    ) -> None:
+        """
+        Record a failed request. A Retry-After opens the circuit at once for that
+        long. Other failures open it after `failure_threshold` in a row.
+        """
+        target.failures += 1
+        if retry_after is not None:
+            target.open_until = self.clock() + retry_after
+        elif target.failures >= self.failure_threshold:
+            exponent = target.failures - self.failure_threshold
+            cooldown = min(self.max_cooldown, self.cooldown * 2**exponent)
+            target.open_until = self.clock() + cooldown
+        else:
+            return
+        logger.warning(
+            f"Upstream {target.name} cooling down for "
+            f"{target.open_until - self.clock():.1f} seconds."
+        )
+
+    def stats(self) -> Dict:
+        now = self.clock()
+        return {
+            "failovers": self.failovers,
+            "targets": {
+                target.name: {
+                    "outstanding": target.outstanding,
+                    "failures": target.failures,
+                    "cooldown": round(max(0.0, target.open_until - now), 3),
+                    "headroom": round(self._headroom(target, now), 4),
+                }
+                for target in self.targets
+            },
+        }
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence
+
+from app.generator import Usage
+from app.utils import cancel_and_wait
+
+logger = logging.getLogger(__name__)
+
+
+async def run_batch(
+    prompts: Sequence[str],
+    stream_factory: Callable[[str, Usage], AsyncIterator[str]],
+    parallelism: int = 8,
+    max_buffered: Optional[int] = None,
+) -> AsyncIterator[Dict]:
+    """
+    Stream several prompts concurrently and interleave their output.
+
+    A fixed pool of `parallelism` workers takes prompts in order. Each one
+    yields `{"id", "chunk"}` records as content arrives and finishes with
+    `{"id", "done", "usage"}`. A failed item finishes with an extra "error"
+    field and the rest of the batch keeps running. Records pass through a
+    bounded queue, so a slow reader holds back the workers instead of
+    buffering without limit. Closing the iterator cancels every worker.
+
+    Args:
+        prompts (Sequence[str]): The prompts. Record ids are their indexes.
+        stream_factory (Callable[[str, Usage], AsyncIterator[str]]): Opens the stream
+            for one prompt and fills in its usage.
+        parallelism (int, optional): Prompts streamed at the same time. Defaults to 8.
+        max_buffered (int, optional): Records buffered ahead of the reader.
+            Defaults to 64 per worker.
+
+    Yields:
+        Dict: The next record from any prompt.
+    """
+    workers = max(1, min(parallelism, len(prompts)))
+    queue: asyncio.Queue = asyncio.Queue(max_buffered or workers * 64)
+    pending = iter(enumerate(prompts))
+
+    async def run_item(index: int, prompt: str) -> None:
+        usage = Usage()
+        record = {"id": index, "done": True}
+        try:
+            async for chunk in stream_factory(prompt, usage):
+                await queue.put({"id": index, "chunk": chunk})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Batch item {index} failed: {e}")
+            record["error"] = str(e) or e.__class__.__name__
+        record["usage"] = usage.to_dict()
+        await queue.put(record)
+
+    async def worker() -> None:
+        for index, prompt in pending:
+            await run_item(index, prompt)
+        await queue.put(None)  # Tell the reader this worker is finished
+
+    tasks: List[asyncio.Task] = [asyncio.create_task(worker()) for _ in range(workers)]
+    finished = 0
+    try:
+        while finished < workers:
+            record = await queue.get()
+            if record is None:
+                finished += 1
+            else:
+                yield record
+    finally:
+        await cancel_and_wait(*tasks)
@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheEntry:
+    """A completed stream: its chunks and when each arrived relative to the start."""
+
+    chunks: List[str]
+    offsets: List[float]
+    size: int
+    created_at: float
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalize a prompt so trivially different spellings share a cache entry.
+
+    Inner whitespace is kept, since indentation in pasted code changes what
+    the prompt asks for.
+
+    Args:
+        prompt (str): The raw prompt.
+
+    Returns:
+        str: The prompt with surrounding whitespace stripped and line endings unified.
+    """
+    return prompt.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+
+class ResponseCache:
+    """
+    An in-process LRU cache of completed streams with a TTL and size bounds.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 3600.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the ResponseCache.
+
+        Args:
+            max_entries (int, optional): Maximum number of cached streams. Defaults to 1024.
+            max_bytes (int, optional): Maximum total size of cached text. Defaults to 64 MiB.
+            ttl (float, optional): Seconds an entry stays valid. Defaults to 3600.0.
+            clock (Callable[[], float], optional): Time source. Defaults to time.monotonic.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(
+        model: str, system_prompt: str, temperature: float, prompt: str
+    ) -> str:
+        """
+        Build a cache key from everything that shapes the completion.
+
+        Returns:
+            str: A hex digest identifying the request.
+        """
+        raw = "\x1f".join(
+            [model, system_prompt, repr(float(temperature)), normalize_prompt(prompt)]
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """
+        Look up a stream, counting the hit or miss and refreshing its LRU position.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and self.clock() - entry.created_at > self.ttl:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def contains(self, key: str) -> bool:
+        """
+        Check for a live entry without counting a hit or miss.
+        """
+        entry = self._entries.get(key)
+        return entry is not None and self.clock() - entry.created_at <= self.ttl
+
+    def set(self, key: str, chunks: List[str], offsets: List[float]) -> None:
+        """
+        Store a completed stream, evicting least recently used entries as needed.
+        """
+        size = sum(len(chunk.encode("utf-8")) for chunk in chunks)
+        if size > self.max_bytes:
+            logger.info("Response too large to cache.")
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = CacheEntry(chunks, offsets, size, self.clock())
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def replay(
+        self, entry: CacheEntry, pacing: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Replay a cached stream.
+
+        Args:
+            entry (CacheEntry): The cached stream.
+            pacing (bool, optional): Reproduce the original timing between chunks
+                instead of flushing everything at once. Defaults to False.
+
+        Yields:
+            str: The cached chunks in order.
+        """
+        start = self.clock()
+        for chunk, offset in zip(entry.chunks, entry.offsets):
+            if pacing:
+                wait = offset - (self.clock() - start)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            yield chunk
+
+
+async def cached_stream(
+    cache: ResponseCache,
+    key: str,
+    source_factory: Callable[[], AsyncIterator[str]],
+    pacing: bool = False,
+    should_store: Callable[[], bool] = lambda: True,
+) -> AsyncIterator[str]:
+    """
+    Serve a stream from the cache, or from the source and cache it once it completes.
+
+    Only streams that run to completion and pass `should_store` are stored. A
+    stream that raises or is closed early by the client is never cached.
+
+    Args:
+        cache (ResponseCache): The cache to use.
+        key (str): The cache key for this request.
+        source_factory (Callable[[], AsyncIterator[str]]): Creates the upstream stream on a miss.
+        pacing (bool, optional): Replay hits with their original pacing. Defaults to False.
+        should_store (Callable[[], bool], optional): Checked after the source completes,
+            e.g. to skip completions cut short by the token limit.
+
+    Yields:
+        str: The content chunks.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        logger.info("Serving response from cache.")
+        replay = cache.replay(entry, pacing=pacing)
+        try:
+            async for chunk in replay:
+                yield chunk
+        finally:
+            await replay.aclose()
+        return
+
+    chunks: List[str] = []
+    offsets: List[float] = []
+    start = cache.clock()
+    source = source_factory()
+    try:
+        async for chunk in source:
+            chunks.append(chunk)
+            offsets.append(cache.clock() - start)
+            yield chunk
+    finally:
+        await source.aclose()
+    if should_store():
+        cache.set(key, chunks, offsets)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from typing import AsyncIterator, List, Literal, get_args
+
+from app.utils import cancel_and_wait
+
+logger = logging.getLogger(__name__)
+
+FlushMode = Literal["immediate", "coalesce"]
+FLUSH_MODES = get_args(FlushMode)
+
+
+def at_boundary(chunk: str) -> bool:
+    """Whether a chunk ends a line or touches a code fence, a natural flush point."""
+    return "\n" in chunk or "`" in chunk
+
+
+async def coalesce(
+    source: AsyncIterator[str],
+    max_bytes: int = 1024,
+    max_latency: float = 0.02,
+    flush_on_boundary: bool = True,
+) -> AsyncIterator[str]:
+    """
+    Merge small chunks from a stream into fewer, larger ones.
+
+    A background task reads the source into a buffer. The buffer is flushed when
+    it reaches `max_bytes`, when `max_latency` has passed since its first chunk
+    arrived, or at a newline or code fence boundary. One timer is armed per flush
+    rather than per chunk. Reading pauses while an unflushed buffer is four times
+    `max_bytes`, so a slow client still pushes back on the upstream.
+
+    Args:
+        source (AsyncIterator[str]): The stream to coalesce.
+        max_bytes (int, optional): Flush once this many characters are buffered. Defaults to 1024.
+        max_latency (float, optional): Longest a chunk may wait in the buffer, in seconds. Defaults to 0.02.
+        flush_on_boundary (bool, optional): Flush at newlines and code fences. Defaults to True.
+
+    Yields:
+        str: The coalesced chunks.
+    """
+    loop = asyncio.get_running_loop()
+    buffer: List[str] = []
+    size = 0
+    done = False
+    error = None
+    timer = None
+    ready = asyncio.Event()
+    drained = asyncio.Event()
+    high_water = 4 * max_bytes
+
+    async def pump():
+        nonlocal size, done, error, timer
+        try:
+            async for chunk in source:
+                buffer.append(chunk)
+                size += len(chunk)
+                if timer is None:
+                    timer = loop.call_later(max_latency, ready.set)
+                if size >= max_bytes or (flush_on_boundary and at_boundary(chunk)):
+                    ready.set()
+                if size >= high_water:
+                    drained.clear()
+                    await drained.wait()
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            ready.set()
+            # The source may be paused at the high-water mark, close it now
+            await source.aclose()
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            await ready.wait()
+            ready.clear()
+            if timer is not None:
+                timer.cancel()
+                timer = None
+            if buffer:
+                out = "".join(buffer)
+                buffer.clear()
+                size = 0
+                drained.set()
+                yield out
+            if done and not buffer:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        if timer is not None:
+            timer.cancel()
+        await cancel_and_wait(task)
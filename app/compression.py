@@ -0,0 +1,267 @@
+import logging
+import zlib
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+# zstd and brotli are offered when their packages are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Server preference when the client accepts several with the same weight
+PREFERENCE = ("zstd", "br", "gzip")
+AVAILABLE_ENCODINGS = tuple(
+    encoding
+    for encoding, module in (("zstd", zstandard), ("br", brotli), ("gzip", zlib))
+    if module is not None
+)
+# Set to True in a request's scope to send its response uncompressed
+SKIP_COMPRESSION = "scg.skip_compression"
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+)
+
+
+def negotiate(
+    accept_encoding: str, available: Tuple[str, ...] = AVAILABLE_ENCODINGS
+) -> Optional[str]:
+    """
+    Pick a content encoding from an Accept-Encoding header.
+
+    The client's weights decide first, then the server's preference. Encodings
+    with `q=0`, or not covered by the header or a `*`, are never chosen.
+
+    Args:
+        accept_encoding (str): The request's Accept-Encoding header.
+        available (Tuple[str, ...], optional): Encodings the server can produce.
+
+    Returns:
+        Optional[str]: The chosen encoding, or None to send the body as is.
+    """
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                continue
+        weights[name.strip()] = weight
+    wildcard = weights.get("*", 0.0)
+    best, best_weight = None, 0.0
+    for encoding in PREFERENCE:
+        weight = weights.get(encoding, wildcard)
+        if encoding in available and weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+class StreamCompressor:
+    """
+    Compresses one response body chunk by chunk.
+
+    Every chunk is flushed, so the client can decode it as soon as it arrives.
+    gzip uses a partial flush, which costs far fewer bytes per chunk than a sync
+    flush when chunks are small.
+    `window_bits` bounds the compressor's memory per stream: a 2**window_bits
+    byte history window, with the match tables sized alike.
+    """
+
+    def __init__(
+        self, encoding: str, level: Optional[int] = None, window_bits: int = 14
+    ):
+        """
+        Initialize the compressor.
+
+        Args:
+            encoding (str): "gzip", "br" or "zstd".
+            level (int, optional): Compression level. Defaults to a fast level for
+                each encoding (gzip 6, brotli 4, zstd 3).
+            window_bits (int, optional): Log2 of the history window, 10 to 15. Defaults to 14.
+        """
+        self.encoding = encoding
+        window_bits = max(10, min(15, window_bits))
+        if encoding == "gzip":
+            # 16 + wbits selects the gzip container. memLevel scales the hash table
+            self._compressor = zlib.compressobj(
+                6 if level is None else level,
+                zlib.DEFLATED,
+                16 + window_bits,
+                max(1, window_bits - 7),
+            )
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(
+                quality=4 if level is None else level, lgwin=window_bits
+            )
+        elif encoding == "zstd":
+            params = zstandard.ZstdCompressionParameters.from_level(
+                3 if level is None else level,
+                window_log=window_bits,
+                hash_log=window_bits,
+                chain_log=window_bits,
+            )
+            self._compressor = zstandard.ZstdCompressor(
+                compression_params=params
+            ).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress a chunk and flush it."""
+        compressor = self._compressor
+        if self.encoding == "gzip":
+            return compressor.compress(data) + compressor.flush(zlib.Z_PARTIAL_FLUSH)
+        if self.encoding == "br":
+            return compressor.process(data) + compressor.flush()
+        return compressor.compress(data) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self, data: bytes = b"") -> bytes:
+        """Compress the last chunk and end the stream."""
+        compressor = self._compressor
+        if self.encoding == "gzip":
+            return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+        if self.encoding == "br":
+            return compressor.process(data) + compressor.finish()
+        return compressor.compress(data) + compressor.flush()
+
+
+class StreamingCompressionMiddleware:
+    """
+    Compresses responses without buffering them.
+
+    Unlike GZipMiddleware, which collects the body before compressing it, every
+    body message is compressed and flushed on its own, so streamed chunks reach
+    the client at the same boundaries as without compression.
+
+    Whether to compress is decided from the response start, which is forwarded
+    at once, so headers such as `X-Stream-ID` never wait for the first chunk. A
+    body whose Content-Length is below `min_size` is sent uncompressed, so tiny
+    responses skip the encoding overhead. A streamed body, without a
+    Content-Length, has no known size when the headers go out, so it is
+    compressed whatever its size, at a cost of about 20 bytes of framing for
+    gzip. Responses that already have a Content-Encoding, or whose type is not
+    text, are left alone, as are requests that set `SKIP_COMPRESSION` in their
+    scope, e.g. streams of per-token chunks that flushing would make larger.
+    Trailers pass through unchanged.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        min_size: int = 512,
+        level: Optional[int] = None,
+        window_bits: int = 14,
+        encodings: Tuple[str, ...] = AVAILABLE_ENCODINGS,
+    ):
+        """
+        Wrap an ASGI app.
+
+        Args:
+            app (ASGIApp): The application.
+            min_size (int, optional): Smallest Content-Length that is compressed. Defaults to 512.
+            level (int, optional): Compression level, each encoding's fast default when None.
+            window_bits (int, optional): Log2 of each stream's window. Defaults to 14.
+            encodings (Tuple[str, ...], optional): Encodings to offer. Defaults to
+                every installed one.
+        """
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.window_bits = window_bits
+        self.encodings = tuple(e for e in encodings if e in AVAILABLE_ENCODINGS)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(
+            Headers(scope=scope).get("accept-encoding", ""), self.encodings
+        )
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        compressor: Optional[StreamCompressor] = None
+        raw_bytes = compressed_bytes = 0
+
+        async def compressing_send(message: Message) -> None:
+            nonlocal compressor, raw_bytes, compressed_bytes
+            message_type = message["type"]
+            if message_type == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                if self._should_compress(scope, headers):
+                    del headers["content-length"]
+                    headers["content-encoding"] = encoding
+                    headers.add_vary_header("accept-encoding")
+                    compressor = StreamCompressor(
+                        encoding, self.level, self.window_bits
+                    )
+                await send(message)
+                return
+            if compressor is None or message_type != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if more_body:
+                compressed = compressor.compress(body) if body else b""
+            else:
+                compressed = compressor.finish(body)
+            raw_bytes += len(body)
+            compressed_bytes += len(compressed)
+            if compressed or not more_body:
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": compressed,
+                        "more_body": more_body,
+                    }
+                )
+
+        try:
+            await self.app(scope, receive, compressing_send)
+        finally:
+            if raw_bytes:
+                metrics.COMPRESSION_BYTES.labels(encoding, "input").inc(raw_bytes)
+                metrics.COMPRESSION_BYTES.labels(encoding, "output").inc(
+                    compressed_bytes
+                )
+
+    def _should_compress(self, scope: Scope, headers: Headers) -> bool:
+        if scope.get(SKIP_COMPRESSION) or "content-encoding" in headers:
+            return False
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return False
+        content_length = headers.get("content-length")
+        return content_length is None or int(content_length) >= self.min_size
+
+
+def compression_ratio() -> Dict[str, float]:
+    """
+    Output bytes per input byte so far, per encoding.
+    """
+    ratios = {}
+    for encoding in AVAILABLE_ENCODINGS:
+        sent = metrics.COMPRESSION_BYTES.labels(encoding, "input").value
+        if sent:
+            compressed = metrics.COMPRESSION_BYTES.labels(encoding, "output").value
+            ratios[encoding] = round(compressed / sent, 3)
+    return ratios
@@ -1,6 +1,132 @@
+import json
 import os
 
 from dotenv import load_dotenv
 
+from app.coalesce import FLUSH_MODES
+
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
+
+# Upstream connection pool settings for the shared httpx client
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30.0"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Prompt-keyed response cache
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600.0"))
+RESPONSE_CACHE_REPLAY_PACING = os.getenv(
+    "RESPONSE_CACHE_REPLAY_PACING", "false"
+).lower() in ("1", "true", "yes")
+
+# Coalesce identical in-flight prompts onto one upstream stream
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Load the tokenizer in a background thread at startup instead of on first use
+TOKENIZER_PREWARM = os.getenv("TOKENIZER_PREWARM", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Coalescing of small chunks before they are written to the client
+STREAM_FLUSH_MODE = os.getenv("STREAM_FLUSH_MODE", "coalesce")
+if STREAM_FLUSH_MODE not in FLUSH_MODES:
+    raise ValueError(
+        f"STREAM_FLUSH_MODE must be one of {', '.join(FLUSH_MODES)}, got {STREAM_FLUSH_MODE!r}."
+    )
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "1024"))
+STREAM_FLUSH_LATENCY = float(os.getenv("STREAM_FLUSH_LATENCY", "0.02"))
+
+# Client-side upstream rate limits, unlimited when unset
+UPSTREAM_REQUESTS_PER_MINUTE = int(os.getenv("UPSTREAM_REQUESTS_PER_MINUTE", "0"))
+UPSTREAM_TOKENS_PER_MINUTE = int(os.getenv("UPSTREAM_TOKENS_PER_MINUTE", "0"))
+UPSTREAM_MAX_TOKENS = int(os.getenv("UPSTREAM_MAX_TOKENS", "0"))
+
+# Admission control in front of the generator
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10.0"))
+
+# Opt-in hedging of slow upstream starts
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGING_PERCENTILE = float(os.getenv("HEDGING_PERCENTILE", "0.95"))
+HEDGING_DEFAULT_DELAY = float(os.getenv("HEDGING_DEFAULT_DELAY", "2.0"))
+HEDGING_MAX_RATIO = float(os.getenv("HEDGING_MAX_RATIO", "0.05"))
+
+# Pool of upstream keys/endpoints, a JSON list of {"api_key", "api_url", "model"}
+UPSTREAM_TARGETS = json.loads(os.getenv("UPSTREAM_TARGETS", "[]"))
+UPSTREAM_BALANCE_STRATEGY = os.getenv(
+    "UPSTREAM_BALANCE_STRATEGY", "least_outstanding"
+)  # or "headroom"
+
+# Batch endpoint limits
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "256"))
+BATCH_MAX_PARALLELISM = int(os.getenv("BATCH_MAX_PARALLELISM", "8"))
+
+# Send a Server-Timing header, and a trailer when the server supports trailers
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Completion store on disk, shared by all workers, disabled when the path is empty
+COMPLETION_STORE_PATH = os.getenv("COMPLETION_STORE_PATH", "")
+COMPLETION_STORE_MAX_BYTES = int(
+    os.getenv("COMPLETION_STORE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+COMPLETION_STORE_TTL = float(os.getenv("COMPLETION_STORE_TTL", "86400.0"))
+COMPLETION_STORE_COMPACT_INTERVAL = float(
+    os.getenv("COMPLETION_STORE_COMPACT_INTERVAL", "300.0")
+)
+
+# Resumable SSE streams, kept in memory for reconnects with Last-Event-ID
+RESUMABLE_STREAMS_ENABLED = os.getenv("RESUMABLE_STREAMS_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+RESUMABLE_STREAM_MAX_BYTES = int(os.getenv("RESUMABLE_STREAM_MAX_BYTES", "262144"))
+RESUMABLE_STREAMS_MAX_TOTAL_BYTES = int(
+    os.getenv("RESUMABLE_STREAMS_MAX_TOTAL_BYTES", str(64 * 1024 * 1024))
+)
+RESUMABLE_STREAM_GRACE_PERIOD = float(
+    os.getenv("RESUMABLE_STREAM_GRACE_PERIOD", "30.0")
+)
+
+# Optional sink that appends every content chunk to a file, off the stream's path
+CHUNK_LOG_PATH = os.getenv("CHUNK_LOG_PATH", "")
+CHUNK_LOG_MAX_QUEUE = int(os.getenv("CHUNK_LOG_MAX_QUEUE", "1024"))
+CHUNK_LOG_OVERFLOW = os.getenv("CHUNK_LOG_OVERFLOW", "drop")  # or "block", "sample"
+
+# Streaming response compression, negotiated from Accept-Encoding
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "512"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "0"))  # 0 picks per encoding
+COMPRESSION_WINDOW_BITS = int(os.getenv("COMPRESSION_WINDOW_BITS", "14"))
@@ -0,0 +1,123 @@
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+import anyio
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from app import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DisconnectStats:
+    """
+    Counts client disconnects and the upstream tokens generated after them.
+    """
+
+    def __init__(self):
+        self.disconnects = 0
+        self.wasted_tokens = 0
+        self.max_close_seconds = 0.0
+
+    def record(self, wasted_tokens: int, close_seconds: float) -> None:
+        self.disconnects += 1
+        self.wasted_tokens += max(0, wasted_tokens)
+        metrics.CLIENT_DISCONNECTS.inc()
+        metrics.WASTED_TOKENS.inc(max(0, wasted_tokens))
+        self.max_close_seconds = max(self.max_close_seconds, close_seconds)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "disconnects": self.disconnects,
+            "wasted_tokens": self.wasted_tokens,
+            "max_close_seconds": round(self.max_close_seconds, 4),
+        }
+
+
+class DisconnectAwareResponse(StreamingResponse):
+    """
+    A StreamingResponse that records when the client disconnects and always
+    closes its body.
+
+    Starlette cancels the body task on disconnect but leaves the body generator
+    for the garbage collector. This closes it straight away, shielded from the
+    cancellation and bounded by `close_timeout`, so upstream streams further down
+    the generator chain are released before the handler returns.
+
+    Body bytes are counted as they are written. If the server supports the ASGI
+    trailers extension, a Server-Timing trailer can be sent after the body.
+    """
+
+    def __init__(
+        self,
+        *args,
+        close_timeout: float = 5.0,
+        server_timing: Optional[Callable[[], str]] = None,
+        **kwargs,
+    ):
+        """
+        Initialize the DisconnectAwareResponse.
+
+        Args:
+            *args: Positional arguments for StreamingResponse.
+            close_timeout (float, optional): Longest wait for the body to close, in seconds. Defaults to 5.0.
+            server_timing (Callable[[], str], optional): Builds the Server-Timing trailer
+                value once the body is complete. No trailer is sent if None.
+            **kwargs: Keyword arguments for StreamingResponse.
+        """
+        super().__init__(*args, **kwargs)
+        self.close_timeout = close_timeout
+        self.server_timing = server_timing
+        self.send_trailers = False
+        self.disconnected_at: Optional[float] = None
+
+    @property
+    def disconnected(self) -> bool:
+        return self.disconnected_at is not None
+
+    async def listen_for_disconnect(self, receive: Receive) -> None:
+        await super().listen_for_disconnect(receive)
+        self.disconnected_at = time.monotonic()
+        logger.info("Client disconnected. Closing the upstream stream.")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send_trailers = self.server_timing is not None and (
+            "http.response.trailers" in scope.get("extensions", {})
+        )
+        if self.send_trailers:
+            self.raw_headers.append((b"trailer", b"server-timing"))
+        await super().__call__(scope, receive, send)
+
+    async def stream_response(self, send: Send) -> None:
+        try:
+            start = {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+            if self.send_trailers:
+                start["trailers"] = True
+            await send(start)
+            async for chunk in self.body_iterator:
+                if not isinstance(chunk, (bytes, memoryview)):
+                    chunk = chunk.encode(self.charset)
+                metrics.BYTES_SENT.inc(len(chunk))
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            if self.send_trailers:
+                await send(
+                    {
+                        "type": "http.response.trailers",
+                        "headers": [(b"server-timing", self.server_timing().encode())],
+                        "more_trailers": False,
+                    }
+                )
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                with anyio.move_on_after(self.close_timeout, shield=True):
+                    await aclose()
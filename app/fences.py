@@ -0,0 +1,168 @@
+import json
+import logging
+from typing import Dict, List, Literal, Optional, get_args
+
+logger = logging.getLogger(__name__)
+
+OutputFormat = Literal["text", "sse", "ndjson"]
+OUTPUT_FORMATS = get_args(OutputFormat)
+MEDIA_TYPES = {
+    "text": "text/plain",
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson",
+}
+
+# Outcomes of classifying the start of a line
+_TEXT, _FENCE, _PENDING = range(3)
+
+
+class FenceSplitter:
+    """
+    An incremental splitter of markdown into explanation text and fenced code blocks.
+
+    Emits `explanation_delta` and `code_delta` events with the text of each, and
+    `code_start` (with the block's `lang`, or None) and `code_end` events around
+    every block. Fences follow the CommonMark rules: three or more backticks or
+    tildes, indented by at most three spaces, closed by a fence of the same
+    character at least as long. The fence lines themselves are not emitted.
+
+    Text is passed through as soon as it arrives. Only the start of a line that
+    may still turn out to be a fence is held back, until the line ends or stops
+    looking like one, so each chunk is processed in time linear in its length
+    and fences split across chunks are recognised.
+    """
+
+    def __init__(self):
+        self._pending = ""  # Start of the current line, while it may be a fence
+        self._line_start = True
+        self._fence: Optional[str] = None  # Opening fence of the current code block
+        self._kind = ""
+        self._parts: List[str] = []
+        self._events: List[Dict] = []
+
+    @property
+    def in_code(self) -> bool:
+        return self._fence is not None
+
+    def feed(self, text: str) -> List[Dict]:
+        """
+        Split a chunk of the stream.
+
+        Args:
+            text (str): The next content chunk.
+
+        Returns:
+            List[Dict]: Events completed by this chunk, consecutive deltas merged.
+        """
+        i = 0
+        while i < len(text):
+            newline = text.find("\n", i)
+            end = len(text) if newline < 0 else newline + 1
+            if not self._line_start:
+                self._emit(text[i:end])
+            else:
+                line = self._pending + text[i:end] if self._pending else text[i:end]
+                self._pending = ""
+                outcome = self._classify(line, complete=newline >= 0)
+                if outcome == _PENDING:
+                    self._pending = line
+                    break
+                if outcome == _FENCE:
+                    self._toggle(line)
+                else:
+                    self._emit(line)
+            self._line_start = newline >= 0
+            i = end
+        return self._take()
+
+    def flush(self) -> List[Dict]:
+        """
+        Finish splitting at the end of the stream.
+
+        A fence on the last line without a trailing newline is still recognised,
+        and a code block left open is closed.
+
+        Returns:
+            List[Dict]: Any events still pending.
+        """
+        if self._pending:
+            line, self._pending = self._pending, ""
+            if self._classify(line, complete=True) == _FENCE:
+                self._toggle(line)
+            else:
+                self._emit(line)
+        if self.in_code:
+            self._end_delta()
+            self._events.append({"type": "code_end"})
+            self._fence = None
+        self._line_start = True
+        return self._take()
+
+    def _classify(self, line: str, complete: bool) -> int:
+        body = line.rstrip("\r\n") if complete else line
+        stripped = body.lstrip(" ")
+        if len(body) - len(stripped) > 3:
+            return _TEXT
+        if not stripped:
+            return _TEXT if complete else _PENDING
+        char = self._fence[0] if self.in_code else stripped[0]
+        if stripped[0] != char or char not in "`~":
+            return _TEXT
+        run = len(stripped) - len(stripped.lstrip(char))
+        if run == len(stripped) and not complete:
+            return _PENDING  # The fence may still grow or gain an info string
+        rest = stripped[run:]
+        if self.in_code:
+            if run < len(self._fence) or rest.strip():
+                return _TEXT
+        elif run < 3 or (char == "`" and "`" in rest):
+            return _TEXT
+        return _FENCE if complete else _PENDING
+
+    def _toggle(self, line: str) -> None:
+        self._end_delta()
+        if self.in_code:
+            self._events.append({"type": "code_end"})
+            self._fence = None
+            return
+        stripped = line.strip()
+        char = stripped[0]
+        self._fence = char * (len(stripped) - len(stripped.lstrip(char)))
+        info = stripped.lstrip(char).split()
+        self._events.append({"type": "code_start", "lang": info[0] if info else None})
+
+    def _emit(self, text: str) -> None:
+        kind = "code_delta" if self.in_code else "explanation_delta"
+        if kind != self._kind:
+            self._end_delta()
+            self._kind = kind
+        self._parts.append(text)
+
+    def _end_delta(self) -> None:
+        if self._parts:
+            self._events.append({"type": self._kind, "text": "".join(self._parts)})
+            self._parts = []
+        self._kind = ""
+
+    def _take(self) -> List[Dict]:
+        self._end_delta()
+        events, self._events = self._events, []
+        return events
+
+
+def encode_events(events: List[Dict], output: str) -> str:
+    """
+    Serialize events as server-sent events or NDJSON lines.
+
+    Args:
+        events (List[Dict]): Events from a FenceSplitter.
+        output (str): "sse" or "ndjson".
+
+    Returns:
+        str: The encoded events, empty when there are none.
+    """
+    if output == "sse":
+        return "".join(
+            f"event: {event['type']}\ndata: {json.dumps(event)}\n\n" for event in events
+        )
+    return "".join(json.dumps(event) + "\n" for event in events)
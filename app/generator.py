@@ -1,20 +1,64 @@
 import asyncio
+import importlib.util
+import inspect
 import json
 import logging
-from typing import AsyncGenerator, Callable, Optional
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
+import anyio
 import httpx
-import tiktoken
+
+from app import metrics
+from app.balancer import UpstreamBalancer, UpstreamTarget
+from app.ratelimit import RateLimiter, parse_retry_after
+from app.sinks import QueuedSink
+from app.sse import SSEDecoder, SSEEvent, json_loads
+from app.tokenizer import count_tokens_each, get_encoding
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# HTTP/2 support in httpx needs the optional 'h2' package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+DEFAULT_SYSTEM_PROMPT = "You are an assistant that provides code with explanations."
+
+# Completion tokens budgeted per request when max_tokens is not set
+COMPLETION_TOKEN_ESTIMATE = 1024
+
+# Bounds on reading the body after [DONE] to keep the connection pooled
+DRAIN_TIMEOUT = 0.5
+DRAIN_MAX_BYTES = 64 * 1024
+
+# Follow-up instruction sent when resuming a partially streamed answer
+CONTINUATION_INSTRUCTION = (
+    "Your previous reply was cut off. Continue exactly where it stopped. "
+    "Do not repeat any text that was already written."
+)
+
 
 class RateLimitError(Exception):
     """Custom exception for rate limit errors."""
 
-    pass
+    def __init__(
+        self, message: str = "Rate limit exceeded.", retry_after: Optional[float] = None
+    ):
+        super().__init__(message)
+        self.retry_after = retry_after
 
 
 class MalformedResponseError(Exception):
@@ -23,6 +67,37 @@ class MalformedResponseError(Exception):
     pass
 
 
+@dataclass
+class Usage:
+    """
+    Token usage for one request, accumulated across retry attempts.
+
+    `estimated` is True when any attempt was counted locally with the tokenizer
+    because the upstream did not report usage.
+    """
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimated: bool = False
+    finish_reason: Optional[str] = None  # Reported by the last attempt
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, prompt_tokens: int, completion_tokens: int, estimated: bool) -> None:
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.estimated = self.estimated or estimated
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+
 class StreamingCodeGenerator:
     """
     A class to interact with the OpenAI API and stream code generation with explanations.
@@ -35,6 +110,19 @@ class StreamingCodeGenerator:
         request_timeout: float = 30.0,
         max_parse_errors: int = 5,
         model: str = "gpt-4",
+        api_url: str = "https://api.openai.com/v1/chat/completions",
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        system_prompt: str = DEFAULT_SYSTEM_PROMPT,
+        temperature: float = 0.7,
+        max_tokens: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        targets: Optional[List[UpstreamTarget]] = None,
+        balance_strategy: str = "least_outstanding",
+        sinks: Optional[List[QueuedSink]] = None,
     ):
         """
         Initialize the StreamingCodeGenerator.
@@ -44,18 +132,352 @@ class StreamingCodeGenerator:
             request_timeout (float, optional): Timeout for the API request. Defaults to 30.0.
             max_parse_errors (int, optional): Maximum allowed consecutive parse errors before aborting. Defaults to 5.
             model (str, optional): Model to use for code generation. Defaults to "gpt-4".
+            api_url (str, optional): Chat completions endpoint. Defaults to the OpenAI API.
+            max_connections (int, optional): Maximum upstream connections in the pool. Defaults to 100.
+            max_keepalive_connections (int, optional): Maximum idle connections kept alive. Defaults to 20.
+            keepalive_expiry (float, optional): Seconds an idle connection is kept alive. Defaults to 30.0.
+            http2 (bool, optional): Multiplex concurrent streams over HTTP/2 if 'h2' is installed. Defaults to False.
+            system_prompt (str, optional): System message sent with every prompt.
+            temperature (float, optional): Sampling temperature. Defaults to 0.7.
+            max_tokens (int, optional): Maximum completion tokens per request. Unlimited if None.
+            requests_per_minute (int, optional): Client-side request budget. Unlimited if None.
+            tokens_per_minute (int, optional): Client-side token budget. Unlimited if None.
+            targets (List[UpstreamTarget], optional): Pool of upstream keys and endpoints to
+                balance over. Defaults to a single target built from api_key, api_url and model.
+            balance_strategy (str, optional): "least_outstanding" or "headroom". Defaults to "least_outstanding".
+            sinks (List[QueuedSink], optional): Receive every content chunk through their
+                own queues, without delaying the stream.
         """
         self.api_key = api_key
-        self.api_url = "https://api.openai.com/v1/chat/completions"
+        self.api_url = api_url
         self.request_timeout = request_timeout
         self.max_parse_errors = max_parse_errors
         self.model = model
-        self.tokenizer = tiktoken.encoding_for_model(model)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.system_prompt = system_prompt
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.balancer = UpstreamBalancer(
+            targets or [UpstreamTarget(api_key, api_url, model)],
+            strategy=balance_strategy,
+        )
+        self.sinks = list(sinks or [])
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def tokenizer(self):
+        """The model's tiktoken encoding, loaded on first use and shared process-wide."""
+        return get_encoding(self.model)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        """
+        Build an httpx client configured with the generator's timeout and pool limits.
+
+        Returns:
+            httpx.AsyncClient: A new client.
+        """
+        http2 = self.http2
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning(
+                "HTTP/2 requested but the 'h2' package is not installed. Falling back to HTTP/1.1."
+            )
+            http2 = False
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(self.request_timeout),
+            limits=self.limits,
+            http2=http2,
+        )
+
+    async def start(self) -> None:
+        """
+        Open the shared upstream client and start the sinks. Safe to call more than once.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+            logger.info("Opened shared upstream HTTP client.")
+        for sink in self.sinks:
+            sink.start()
+
+    async def aclose(self) -> None:
+        """
+        Close the shared upstream client and release pooled connections, after the
+        sinks have handled their queued chunks.
+        """
+        for sink in self.sinks:
+            await sink.aclose()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("Closed shared upstream HTTP client.")
+
+    @asynccontextmanager
+    async def _get_client(self) -> AsyncIterator[httpx.AsyncClient]:
+        """
+        Yield the shared client if it is open, otherwise a short-lived one.
+        """
+        if self._client is not None and not self._client.is_closed:
+            yield self._client
+        else:
+            async with self._build_client() as client:
+                yield client
+
+    async def count_prompt_tokens(self, messages: List[Dict[str, str]]) -> int:
+        """
+        Estimate the prompt tokens for a list of chat messages, off the event loop.
+
+        Uses the OpenAI chat format overhead of 3 tokens per message plus 3 tokens
+        priming the reply.
+
+        Args:
+            messages (List[Dict[str, str]]): The chat messages.
+
+        Returns:
+            int: The estimated number of prompt tokens.
+        """
+        counts = await count_tokens_each(
+            self.model, [message["content"] for message in messages]
+        )
+        return self._prompt_tokens(counts)
+
+    @staticmethod
+    def _prompt_tokens(content_tokens: List[int]) -> int:
+        return 3 + sum(3 + tokens for tokens in content_tokens)
+
+    def build_messages(
+        self, prompt: str, continuation: Optional[str] = None
+    ) -> List[Dict[str, str]]:
+        """
+        Build the chat messages sent for a prompt.
+
+        Args:
+            prompt (str): The user's prompt.
+            continuation (str, optional): Partial assistant output to continue.
+
+        Returns:
+            List[Dict[str, str]]: The messages.
+        """
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": prompt},
+        ]
+        if continuation:
+            messages += [
+                {"role": "assistant", "content": continuation},
+                {"role": "user", "content": CONTINUATION_INSTRUCTION},
+            ]
+        return messages
+
+    async def estimate_request_tokens(self, messages: List[Dict[str, str]]) -> int:
+        """
+        Estimate the tokens a request may consume, prompt plus maximum completion.
+        """
+        return await self.count_prompt_tokens(messages) + (
+            self.max_tokens or COMPLETION_TOKEN_ESTIMATE
+        )
+
+    async def _count_usage(
+        self,
+        messages: List[Dict[str, str]],
+        completion_parts: List[str],
+        upstream_usage: Optional[Dict[str, int]],
+    ) -> Tuple[int, int, bool]:
+        """
+        Return prompt tokens, completion tokens and whether they were estimated.
+        """
+        if upstream_usage:
+            return (
+                upstream_usage.get("prompt_tokens", 0),
+                upstream_usage.get("completion_tokens", 0),
+                False,
+            )
+        # Encode the whole completion once instead of every delta, in the same
+        # thread hop as the prompt
+        *prompt_counts, completion_tokens = await count_tokens_each(
+            self.model,
+            [message["content"] for message in messages] + ["".join(completion_parts)],
+        )
+        return self._prompt_tokens(prompt_counts), completion_tokens, True
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Report the generator's client-side rate limiter, upstream pool and sink state.
+        """
+        return {
+            "rate_limiter": self.rate_limiter.stats(),
+            "upstreams": self.balancer.stats(),
+            "sinks": {sink.name: sink.stats() for sink in self.sinks},
+        }
+
+    @staticmethod
+    def _connect_tracer() -> Callable:
+        """
+        Build an httpcore trace hook that times a new upstream connection, TCP
+        and TLS, for one request. Pooled connections are not observed.
+        """
+        started = None
+
+        async def trace(event_name: str, info: Dict) -> None:
+            nonlocal started
+            if event_name == "connection.connect_tcp.started":
+                started = time.perf_counter()
+            elif started is not None and event_name.endswith(
+                "send_request_headers.started"
+            ):
+                metrics.UPSTREAM_CONNECT.observe(time.perf_counter() - started)
+                started = None
+
+        return trace
+
+    @asynccontextmanager
+    async def _open_stream(
+        self, client: httpx.AsyncClient, payload: Dict
+    ) -> AsyncIterator[httpx.Response]:
+        """
+        Open a streaming request on the best available upstream target.
+
+        A target that answers 429, 401/403 or 5xx is put into cooldown and the
+        request moves on to the next healthy target straight away. An error is only
+        raised once no untried target is left, so one rate-limited key does not
+        cost the caller a retry backoff.
+
+        Yields:
+            httpx.Response: A response with status 200.
+        """
+        tried = []
+        while True:
+            target = self.balancer.acquire(exclude=tried)
+            if target is None:
+                retry_after = self.balancer.next_available_in()
+                logger.warning(
+                    f"No upstream target available. Retry after {retry_after:.1f} seconds."
+                )
+                raise RateLimitError(
+                    "All upstream targets are cooling down.", retry_after=retry_after
+                )
+            tried.append(target)
+            headers = {
+                "Authorization": f"Bearer {target.api_key}",
+                "Content-Type": "application/json",
+            }
+            error = None
+            try:
+                async with client.stream(
+                    "POST",
+                    target.api_url,
+                    json={**payload, "model": target.model},
+                    headers=headers,
+                    extensions={"trace": self._connect_tracer()},
+                ) as response:
+                    metrics.UPSTREAM_REQUESTS.labels(str(response.status_code)).inc()
+                    self.balancer.record_headers(target, response.headers)
+
+                    if response.status_code == 429:
+                        retry_after = parse_retry_after(
+                            response.headers.get("Retry-After")
+                        )  # Defaults to 5 seconds
+                        logger.warning(
+                            f"Rate limit exceeded on {target.name}. "
+                            f"Retry after {retry_after} seconds."
+                        )
+                        self.balancer.record_failure(target, retry_after=retry_after)
+                        if len(self.balancer.targets) == 1:
+                            # Hold every caller, not just this request
+                            self.rate_limiter.pause(retry_after)
+                        error = RateLimitError(
+                            "Rate limit exceeded.", retry_after=retry_after
+                        )
+
+                    elif response.status_code != 200:
+                        await response.aread()
+                        logger.error(
+                            f"API Error: {response.status_code} {response.text}"
+                        )
+                        error = Exception(
+                            f"API Error: {response.status_code} {response.text}"
+                        )
+                        if response.status_code < 500 and response.status_code not in (
+                            401,
+                            403,
+                        ):
+                            raise error  # The request itself is bad, do not fail over
+                        self.balancer.record_failure(target)
+
+                    else:
+                        yield response
+                        self.balancer.record_success(target)
+                        return
+            except httpx.TransportError:
+                metrics.UPSTREAM_REQUESTS.labels("error").inc()
+                self.balancer.record_failure(target)
+                raise
+            except MalformedResponseError:
+                self.balancer.record_failure(target)
+                raise
+            finally:
+                self.balancer.release(target)
+
+            if not self.balancer.available(exclude=tried):
+                raise error
+            self.balancer.failovers += 1
+            logger.info(f"Failing over from upstream {target.name}.")
+
+    @staticmethod
+    async def _iter_events(response: httpx.Response) -> AsyncIterator[SSEEvent]:
+        """
+        Decode server-sent events from the raw response body.
+        """
+        decoder = SSEDecoder()
+        async for chunk in response.aiter_bytes():
+            for event in decoder.feed(chunk):
+                yield event
+        for event in decoder.flush():
+            yield event
+
+    @staticmethod
+    async def _drain(
+        response: httpx.Response, events: AsyncGenerator[SSEEvent, None]
+    ) -> None:
+        """
+        Read the rest of the body after [DONE] so the connection can go back to
+        the pool.
+
+        Reading stops after DRAIN_TIMEOUT seconds or DRAIN_MAX_BYTES of event
+        data. The response is then closed, which discards its connection. Nothing
+        is raised, since the stream itself has already completed.
+        """
+
+        async def drain() -> bool:
+            size = 0
+            async for event in events:
+                size += len(event.data)
+                if size > DRAIN_MAX_BYTES:
+                    return False
+            return True
+
+        try:
+            drained = await asyncio.wait_for(drain(), DRAIN_TIMEOUT)
+        except Exception as e:
+            logger.debug(f"Upstream body not drained after [DONE]: {e!r}")
+            drained = False
+        if not drained:
+            try:
+                await events.aclose()
+                await response.aclose()
+            except Exception as e:
+                logger.debug(f"Failed to close upstream response: {e!r}")
 
     async def generate_code_with_explanation(
         self,
         prompt: str,
-        callback: Optional[Callable[[str], None]] = None,
+        callback: Optional[Callable[[str], Union[None, Awaitable[None]]]] = None,
+        continuation: Optional[str] = None,
+        usage: Optional[Usage] = None,
     ) -> AsyncGenerator[str, None]:
         """
         Stream OpenAI API responses and yield chunks iteratively with token tracking.
@@ -63,90 +485,90 @@ class StreamingCodeGenerator:
         Args:
             prompt (str): The prompt to send to the OpenAI API.
             callback (Callable[[str], None], optional): A callback function to process each chunk.
+                May be async, and is awaited inline, so slow work belongs in a sink.
+            continuation (str, optional): Partial assistant output from an interrupted
+                attempt. When set, the model is asked to continue it instead of starting over.
+            usage (Usage, optional): Filled in with the tokens this attempt consumed, taken
+                from the upstream's usage report when present and counted once otherwise.
 
         Yields:
             str: The generated content chunk.
         """
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
         payload = {
             "model": self.model,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are an assistant that provides code with explanations.",
-                },
-                {"role": "user", "content": prompt},
-            ],
-            "temperature": 0.7,
+            "messages": self.build_messages(prompt, continuation),
+            "temperature": self.temperature,
             "stream": True,
+            "stream_options": {"include_usage": True},
         }
+        if self.max_tokens:
+            payload["max_tokens"] = self.max_tokens
 
         malformed_response_count = 0  # Counter for consecutive parse errors
-        total_tokens = 0  # Total tokens generated
         max_malformed_responses = self.max_parse_errors
+        completion_parts = []  # Content yielded, counted once at the end
+        upstream_usage = None  # Usage reported in the final stream event
+        streaming = False
 
-        timeout = httpx.Timeout(self.request_timeout)
+        # Reserve the estimated cost so concurrent requests share the budgets
+        reserved = 0
+        if self.rate_limiter.tokens is not None:
+            reserved = await self.estimate_request_tokens(payload["messages"])
+        await self.rate_limiter.acquire(reserved)
+        sent_at = time.perf_counter()
+        first_chunk_at = last_chunk_at = None
 
-        async with httpx.AsyncClient(timeout=timeout) as client:
+        async with self._get_client() as client:
             try:
-                async with client.stream(
-                    "POST", self.api_url, json=payload, headers=headers
-                ) as response:
-
-                    if response.status_code == 429:
-                        retry_after = int(
-                            response.headers.get("Retry-After", "5")
-                        )  # Default to 5 seconds
-                        logger.warning(
-                            f"Rate limit exceeded. Retry after {retry_after} seconds."
-                        )
-                        raise RateLimitError("Rate limit exceeded.")
+                async with self._open_stream(client, payload) as response:
+                    streaming = True
+                    events = self._iter_events(response)
+                    async for event in events:
+                        data = event.data
+                        if data[:1] == b"[" and data.strip() == b"[DONE]":
+                            await self._drain(response, events)
+                            break
+                        try:
+                            parsed = json_loads(data)
+                            malformed_response_count = (
+                                0  # Reset counter on successful parse
+                            )
+                            if parsed.get("usage"):
+                                upstream_usage = parsed["usage"]
+                            choices = parsed.get("choices")
+                            if not choices:
+                                continue  # The usage event carries no choices
+                            if usage is not None and choices[0].get("finish_reason"):
+                                usage.finish_reason = choices[0]["finish_reason"]
+                            content = choices[0].get("delta", {}).get("content")
+                            if content:
+                                completion_parts.append(content)
+                                now = time.perf_counter()
+                                if last_chunk_at is None:
+                                    first_chunk_at = now
+                                    metrics.TIME_TO_FIRST_TOKEN.observe(now - sent_at)
+                                else:
+                                    metrics.INTER_CHUNK_GAP.observe(now - last_chunk_at)
+                                last_chunk_at = now
 
-                    elif response.status_code != 200:
-                        logger.error(
-                            f"API Error: {response.status_code} {response.text}"
-                        )
-                        raise Exception(
-                            f"API Error: {response.status_code} {response.text}"
-                        )
+                                if callback:
+                                    result = callback(content)
+                                    if inspect.isawaitable(result):
+                                        await result
+                                for sink in self.sinks:
+                                    await sink.put(content)
 
-                    async for line in response.aiter_lines():
-                        if line.strip() == "":
-                            continue
-                        if line.startswith("data:"):
-                            part = line.replace("data:", "").strip()
-                            if part == "[DONE]":
-                                break
-                            try:
-                                parsed = json.loads(part)
-                                malformed_response_count = (
-                                    0  # Reset counter on successful parse
+                                yield content
+                        except json.JSONDecodeError as e:
+                            malformed_response_count += 1
+                            metrics.PARSE_ERRORS.inc()
+                            logger.error(f"Failed to parse part: {e}")
+                            if malformed_response_count >= max_malformed_responses:
+                                logger.error("Too many malformed responses. Aborting.")
+                                raise MalformedResponseError(
+                                    "Too many malformed responses."
                                 )
-                                delta = parsed["choices"][0]["delta"]
-                                if "content" in delta:
-                                    content = delta["content"]
-                                    # Count tokens in the content
-                                    tokens = len(self.tokenizer.encode(content))
-                                    total_tokens += tokens
-
-                                    if callback:
-                                        callback(content)
-
-                                    yield content
-                            except json.JSONDecodeError as e:
-                                malformed_response_count += 1
-                                logger.error(f"Failed to parse part: {e}")
-                                if malformed_response_count >= max_malformed_responses:
-                                    logger.error(
-                                        "Too many malformed responses. Aborting."
-                                    )
-                                    raise MalformedResponseError(
-                                        "Too many malformed responses."
-                                    )
-                                continue  # Skip to the next part
+                            continue  # Skip to the next part
             except asyncio.CancelledError:
                 logger.info("Streaming cancelled by client.")
                 raise  # Re-raise the exception to propagate cancellation
@@ -158,3 +580,28 @@ class StreamingCodeGenerator:
             except Exception as e:
                 logger.error(f"Error in generate_code_with_explanation: {e}")
                 raise
+            finally:
+                actual = 0
+                if streaming and (usage is not None or reserved):
+                    try:
+                        # May run after a cancellation, and counting is off the loop
+                        with anyio.CancelScope(shield=True):
+                            (
+                                prompt_tokens,
+                                completion_tokens,
+                                estimated,
+                            ) = await self._count_usage(
+                                payload["messages"], completion_parts, upstream_usage
+                            )
+                        actual = prompt_tokens + completion_tokens
+                        if last_chunk_at is not None and last_chunk_at > first_chunk_at:
+                            metrics.TOKENS_PER_SECOND.observe(
+                                completion_tokens / (last_chunk_at - first_chunk_at)
+                            )
+                        if usage is not None:
+                            usage.add(prompt_tokens, completion_tokens, estimated)
+                    except Exception as e:
+                        logger.warning(f"Failed to count token usage: {e}")
+                        actual = reserved
+                if reserved:
+                    self.rate_limiter.reconcile(reserved, actual)
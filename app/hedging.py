@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict
+
+from app.utils import cancel_and_wait
+
+logger = logging.getLogger(__name__)
+
+
+class Hedger:
+    """
+    Hedges slow upstream starts with a second identical request.
+
+    If the first chunk has not arrived after a delay derived from recent
+    time-to-first-token samples (the p95 by default), a second request is sent.
+    Whichever stream yields its first chunk first is committed and the other is
+    cancelled at once. Hedges are paid for from a budget that earns
+    `max_hedge_ratio` of a hedge per request, which caps the extra upstream cost.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        default_delay: float = 2.0,
+        min_delay: float = 0.2,
+        max_delay: float = 10.0,
+        max_hedge_ratio: float = 0.05,
+        window: int = 256,
+        min_samples: int = 20,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the Hedger.
+
+        Args:
+            percentile (float, optional): TTFT percentile used as the hedge delay. Defaults to 0.95.
+            default_delay (float, optional): Delay until enough samples exist, in seconds. Defaults to 2.0.
+            min_delay (float, optional): Lower bound on the delay. Defaults to 0.2.
+            max_delay (float, optional): Upper bound on the delay. Defaults to 10.0.
+            max_hedge_ratio (float, optional): Long-run fraction of requests that may be hedged. Defaults to 0.05.
+            window (int, optional): Number of recent TTFT samples kept. Defaults to 256.
+            min_samples (int, optional): Samples needed before the percentile is used. Defaults to 20.
+            clock (Callable[[], float], optional): Time source. Defaults to time.monotonic.
+        """
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.clock = clock
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._delay = default_delay
+        self._dirty = 0
+        self._budget = 1.0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def record(self, ttft: float) -> None:
+        """Add a time-to-first-token sample."""
+        self._samples.append(ttft)
+        self._dirty += 1
+
+    def delay(self) -> float:
+        """
+        The current hedge delay. Recomputed at most every 16 samples.
+        """
+        if self._dirty >= 16 or (self._dirty and len(self._samples) < 64):
+            self._dirty = 0
+            if len(self._samples) >= self.min_samples:
+                ordered = sorted(self._samples)
+                index = min(
+                    len(ordered) - 1, math.ceil(self.percentile * len(ordered)) - 1
+                )
+                self._delay = ordered[index]
+        return min(self.max_delay, max(self.min_delay, self._delay))
+
+    def _spend(self) -> bool:
+        if self._budget >= 1.0:
+            self._budget -= 1.0
+            return True
+        self.budget_denied += 1
+        return False
+
+    async def stream(self, factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """
+        Stream from `factory()`, hedging with a second call if the first chunk is slow.
+
+        Args:
+            factory (Callable[[], AsyncIterator]): Starts one upstream stream.
+
+        Yields:
+            Any: Items from the committed stream.
+        """
+        self.requests += 1
+        self._budget = min(1.0, self._budget + self.max_hedge_ratio)
+        start = self.clock()
+        primary = factory()
+        primary_task = asyncio.ensure_future(primary.__anext__())
+        contenders = {primary_task: (primary, start)}
+        winner_task = None
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=self.delay())
+            if not done and self._spend():
+                logger.info("No first chunk yet. Sending a hedged request.")
+                self.hedged += 1
+                hedge = factory()
+                hedge_task = asyncio.ensure_future(hedge.__anext__())
+                contenders[hedge_task] = (hedge, self.clock())
+
+            first_error = None
+            pending = set(contenders)
+            while pending and winner_task is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner_task = task
+                        break
+                    first_error = first_error or error
+            if winner_task is None:
+                raise first_error
+        finally:
+            for task, (gen, _) in contenders.items():
+                if task is not winner_task:
+                    await self._discard(task, gen)
+
+        winner, started = contenders[winner_task]
+        self.record(self.clock() - started)
+        if winner_task is not primary_task:
+            self.hedge_wins += 1
+        error = winner_task.exception()
+        if isinstance(error, StopAsyncIteration):
+            return
+        try:
+            yield winner_task.result()
+            async for item in winner:
+                yield item
+        finally:
+            await winner.aclose()
+
+    @staticmethod
+    async def _discard(task: asyncio.Future, gen) -> None:
+        """Cancel a losing stream and close its generator."""
+        await cancel_and_wait(task)
+        await gen.aclose()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "delay": round(self.delay(), 4),
+        }
+
+
+def hedged(func: Callable[..., AsyncIterator], hedger: Hedger):
+    """
+    Wrap an async generator function so each call is hedged by `hedger`.
+    """
+
+    def wrapper(*args, **kwargs):
+        return hedger.stream(lambda: func(*args, **kwargs))
+
+    return wrapper
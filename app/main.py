@@ -1,20 +1,56 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
-from app.routes import router
+from app.compression import StreamingCompressionMiddleware
+from app.config import (
+    COMPRESSION_ENABLED,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MIN_SIZE,
+    COMPRESSION_WINDOW_BITS,
+    TOKENIZER_PREWARM,
+)
+from app.routes import completion_store, generator, resumable_streams, router
+from app.tokenizer import prewarm_encodings
 
-app = FastAPI()
-app.include_router(router)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the pooled upstream client once and reuse it across requests
+    await generator.start()
+    if TOKENIZER_PREWARM:
+        prewarm_encodings([generator.model])
+    if completion_store is not None:
+        completion_store.start()
+    try:
+        yield
+    finally:
+        if resumable_streams is not None:
+            await resumable_streams.aclose()
+        if completion_store is not None:
+            await completion_store.aclose()
+        await generator.aclose()
 
 
 app = FastAPI(
     title="Streaming Code Generator",
     description="API for real-time code generation and explanation",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # Include the router for endpoints
 app.include_router(router)
 
+if COMPRESSION_ENABLED:
+    # Compresses each streamed chunk as it is sent, unlike GZipMiddleware
+    app.add_middleware(
+        StreamingCompressionMiddleware,
+        min_size=COMPRESSION_MIN_SIZE,
+        level=COMPRESSION_LEVEL or None,
+        window_bits=COMPRESSION_WINDOW_BITS,
+    )
+
 
 @app.get("/")
 async def root():
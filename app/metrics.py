@@ -0,0 +1,197 @@
+import math
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Buckets in seconds for latencies from sub-millisecond gaps to slow first tokens
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing count. A counter with label names is split into
+    one child counter per set of label values, created on first use.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.value = 0
+        self._children: Dict[Tuple[str, ...], "Counter"] = {}
+
+    def labels(self, *labelvalues: str) -> "Counter":
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[labelvalues] = Counter(self.name, "")
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        if not self.labelnames:
+            return [f"{self.name} {_format_value(self.value)}"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+            for key, child in self._children.items()
+        ]
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram.
+
+    Bucket counts are kept in a preallocated list and an observation is one
+    bisect plus two additions, so recording does not allocate per sample.
+    Counts are made cumulative only when rendered.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            le = _format_labels((), (), f'le="{_format_value(float(bound))}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Registry:
+    """
+    Holds metrics and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Optional[Sequence[float]] = None,
+    ):
+        return self.register(Histogram(name, documentation, buckets or LATENCY_BUCKETS))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "scg_requests_total", "Requests received by /generate-code/.", ["endpoint"]
+)
+QUEUE_WAIT = REGISTRY.histogram(
+    "scg_queue_wait_seconds", "Time requests waited for an admission slot."
+)
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "scg_upstream_requests_total", "Upstream responses by status code.", ["status"]
+)
+UPSTREAM_CONNECT = REGISTRY.histogram(
+    "scg_upstream_connect_seconds",
+    "Time to open a new upstream connection, including TLS.",
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "scg_time_to_first_token_seconds",
+    "Time from sending an upstream request to its first content chunk.",
+)
+INTER_CHUNK_GAP = REGISTRY.histogram(
+    "scg_inter_chunk_gap_seconds", "Time between upstream content chunks."
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "scg_tokens_per_second",
+    "Completion tokens per second of upstream streaming.",
+    RATE_BUCKETS,
+)
+RETRIES = REGISTRY.counter("scg_retries_total", "Upstream attempts that were retried.")
+PARSE_ERRORS = REGISTRY.counter(
+    "scg_parse_errors_total", "Upstream stream events that failed to parse."
+)
+BYTES_SENT = REGISTRY.counter(
+    "scg_bytes_sent_total", "Response body bytes written to clients."
+)
+CLIENT_DISCONNECTS = REGISTRY.counter(
+    "scg_client_disconnects_total", "Streams abandoned by the client."
+)
+WASTED_TOKENS = REGISTRY.counter(
+    "scg_wasted_tokens_total", "Completion tokens generated after a client left."
+)
+COMPRESSION_BYTES = REGISTRY.counter(
+    "scg_compression_bytes_total",
+    "Response body bytes before (input) and after (output) compression.",
+    ("encoding", "stage"),
+)
+SINK_DROPPED = REGISTRY.counter(
+    "scg_sink_dropped_chunks_total",
+    "Chunks a sink dropped because its queue was full.",
+    ("sink",),
+)
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: Optional[str], default: float = 5.0) -> float:
+    """
+    Parse a Retry-After header given in seconds or as an HTTP date.
+
+    Args:
+        value (str, optional): The header value.
+        default (float, optional): Seconds to use when it is missing or invalid. Defaults to 5.0.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at `capacity` units per minute.
+    """
+
+    def __init__(self, capacity: float, clock: Callable[[], float]):
+        self.capacity = capacity
+        self.rate = capacity / 60.0
+        self.clock = clock
+        self.available = capacity
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.available = min(
+            self.capacity, self.available + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self.available = min(self.capacity, self.available + amount)
+
+
+class RateLimiter:
+    """
+    A client-side limiter shared by every request a generator sends upstream.
+
+    Requests-per-minute and tokens-per-minute budgets are enforced with token
+    buckets, and `pause` holds every caller until it expires. The generator
+    pauses for an upstream Retry-After only when it has a single target. With a
+    pool, the balancer skips just the limited target instead. Waiting callers
+    are served in arrival order.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the RateLimiter.
+
+        Args:
+            requests_per_minute (int, optional): Request budget. Unlimited if None.
+            tokens_per_minute (int, optional): Token budget. Unlimited if None.
+            clock (Callable[[], float], optional): Time source. Defaults to time.monotonic.
+        """
+        self.clock = clock
+        self.requests = (
+            TokenBucket(requests_per_minute, clock) if requests_per_minute else None
+        )
+        self.tokens = (
+            TokenBucket(tokens_per_minute, clock) if tokens_per_minute else None
+        )
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self.acquired = 0
+        self.throttled = 0
+        self.retry_after_pauses = 0
+        self.total_wait = 0.0
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = self.paused_until - self.clock()
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    async def acquire(self, tokens: int) -> None:
+        """
+        Wait until a request costing `tokens` fits the budgets, then reserve it.
+
+        Args:
+            tokens (int): Estimated tokens for the request, prompt plus completion.
+        """
+        async with self._lock:
+            waited = False
+            while True:
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                waited = True
+                self.total_wait += wait
+                await asyncio.sleep(wait)
+            if waited:
+                self.throttled += 1
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.acquired += 1
+
+    def reconcile(self, estimated: int, actual: int) -> None:
+        """
+        Correct the token budget once a request's real usage is known.
+        """
+        if self.tokens is None:
+            return
+        if actual < estimated:
+            self.tokens.give(estimated - actual)
+        elif actual > estimated:
+            self.tokens.take(actual - estimated)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold every caller for `seconds`, as asked by an upstream Retry-After.
+        """
+        until = self.clock() + seconds
+        if until > self.paused_until:
+            self.paused_until = until
+            self.retry_after_pauses += 1
+            logger.warning(f"Pausing upstream requests for {seconds} seconds.")
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "requests_available": (
+                round(self.requests.available, 2) if self.requests else None
+            ),
+            "tokens_available": (
+                round(self.tokens.available, 2) if self.tokens else None
+            ),
+            "paused_for": round(max(0.0, self.paused_until - self.clock()), 3),
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "retry_after_pauses": self.retry_after_pauses,
+            "total_wait": round(self.total_wait, 3),
+        }
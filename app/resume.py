@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import secrets
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from app.utils import cancel_and_wait
+
+logger = logging.getLogger(__name__)
+
+
+class StreamGone(Exception):
+    """The requested position is no longer buffered, or the stream has expired."""
+
+    pass
+
+
+class ResumableStream:
+    """
+    A generation that outlives the connection it was started on.
+
+    A background task pumps the source into a ring buffer of numbered chunks.
+    Chunks are numbered from 1, and the oldest are dropped once the buffer holds
+    more than its byte budget. Readers follow the buffer from any position it
+    still holds.
+    """
+
+    def __init__(self, stream_id: str):
+        self.id = stream_id
+        self.chunks: Deque[Tuple[int, str]] = deque()
+        self.size = 0
+        self.next_seq = 1
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.expiry: Optional[asyncio.TimerHandle] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def first_seq(self) -> int:
+        """Number of the oldest buffered chunk, `next_seq` when none is."""
+        return self.chunks[0][0] if self.chunks else self.next_seq
+
+    def can_resume(self, last_event_id: Optional[int]) -> bool:
+        """Whether every chunk after `last_event_id` is still buffered or to come."""
+        after = last_event_id or 0
+        return self.first_seq <= after + 1 <= self.next_seq
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _append(self, chunk: str) -> int:
+        size = len(chunk.encode("utf-8"))
+        self.chunks.append((self.next_seq, chunk))
+        self.next_seq += 1
+        self.size += size
+        self._notify()
+        return size
+
+    def _drop_oldest(self) -> int:
+        _, chunk = self.chunks.popleft()
+        size = len(chunk.encode("utf-8"))
+        self.size -= size
+        return size
+
+    async def follow(
+        self, last_event_id: Optional[int] = None
+    ) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Yield buffered chunks after `last_event_id`, then live ones until the
+        source finishes.
+
+        Args:
+            last_event_id (int, optional): Number of the last chunk the client
+                received. Starts from the first chunk when None.
+
+        Yields:
+            Tuple[int, str]: Each chunk's number and text.
+
+        Raises:
+            StreamGone: If chunks the reader still needs were dropped.
+        """
+        seq = (last_event_id or 0) + 1
+        while True:
+            if seq < self.first_seq:
+                raise StreamGone(f"Chunks after {seq - 1} are no longer buffered.")
+            if seq < self.next_seq:
+                chunk_seq, chunk = self.chunks[seq - self.first_seq]
+                seq += 1
+                yield chunk_seq, chunk
+                continue
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class StreamRegistry:
+    """
+    An in-process registry of resumable streams.
+
+    A stream keeps generating while no client is attached. Once the last reader
+    leaves, it is kept for `grace_period` seconds for a reconnect to resume it,
+    after which its source is closed and its buffer freed. When the buffers of
+    all streams exceed `max_total_bytes`, detached streams are evicted first,
+    oldest first, then the oldest chunks of the stream that is growing.
+    """
+
+    def __init__(
+        self,
+        max_stream_bytes: int = 256 * 1024,
+        max_total_bytes: int = 64 * 1024 * 1024,
+        grace_period: float = 30.0,
+    ):
+        """
+        Initialize the registry.
+
+        Args:
+            max_stream_bytes (int, optional): Ring buffer size of each stream.
+                Defaults to 256 KiB.
+            max_total_bytes (int, optional): Cap on all buffers together. Defaults to 64 MiB.
+            grace_period (float, optional): Seconds a detached stream is kept. Defaults to 30.
+        """
+        self.max_stream_bytes = max_stream_bytes
+        self.max_total_bytes = max_total_bytes
+        self.grace_period = grace_period
+        self._streams: "OrderedDict[str, ResumableStream]" = OrderedDict()
+        self._bytes = 0
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, stream_id: str) -> Optional[ResumableStream]:
+        return self._streams.get(stream_id)
+
+    def create(self, source: AsyncIterator[str]) -> ResumableStream:
+        """
+        Start pumping `source` into a new stream in the background.
+
+        The stream is detached until a reader follows it, so it expires if the
+        response is never sent.
+
+        Args:
+            source (AsyncIterator[str]): The chunks to buffer.
+
+        Returns:
+            ResumableStream: The new stream.
+        """
+        stream = ResumableStream(secrets.token_urlsafe(16))
+        self._streams[stream.id] = stream
+        stream.task = asyncio.create_task(self._pump(stream, source))
+        self._schedule_expiry(stream)
+        self.started += 1
+        return stream
+
+    async def _pump(self, stream: ResumableStream, source: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in source:
+                if self._streams.get(stream.id) is not stream:
+                    # Removed, and the cancellation has not landed yet
+                    raise StreamGone("The stream expired.")
+                self._bytes += stream._append(chunk)
+                while stream.size > self.max_stream_bytes and len(stream.chunks) > 1:
+                    self._bytes -= stream._drop_oldest()
+                if self._bytes > self.max_total_bytes:
+                    self._enforce_cap(stream)
+        except asyncio.CancelledError:
+            stream.error = StreamGone("The stream expired.")
+            raise
+        except Exception as e:
+            stream.error = e
+        finally:
+            stream.done = True
+            stream._notify()
+            await source.aclose()
+
+    def _enforce_cap(self, growing: ResumableStream) -> None:
+        for stream in list(self._streams.values()):
+            if self._bytes <= self.max_total_bytes:
+                return
+            if stream is not growing and stream.subscribers == 0:
+                logger.info(f"Evicting detached stream {stream.id} to free memory.")
+                self._remove(stream)
+                self.evictions += 1
+        while self._bytes > self.max_total_bytes and len(growing.chunks) > 1:
+            self._bytes -= growing._drop_oldest()
+
+    async def follow(
+        self, stream: ResumableStream, last_event_id: Optional[int] = None
+    ) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Attach to a stream and follow it, keeping it alive while attached.
+
+        Args:
+            stream (ResumableStream): The stream to follow.
+            last_event_id (int, optional): Last chunk number the client received,
+                from the `Last-Event-ID` header of a reconnect.
+
+        Yields:
+            Tuple[int, str]: Each chunk's number and text.
+        """
+        if stream.expiry is not None:
+            stream.expiry.cancel()
+            stream.expiry = None
+        if last_event_id is not None:
+            self.resumed += 1
+        stream.subscribers += 1
+        try:
+            async for item in stream.follow(last_event_id):
+                yield item
+        finally:
+            stream.subscribers -= 1
+            if stream.subscribers == 0:
+                self._schedule_expiry(stream)
+
+    def _schedule_expiry(self, stream: ResumableStream) -> None:
+        loop = asyncio.get_running_loop()
+        stream.expiry = loop.call_later(self.grace_period, self._expire, stream)
+
+    def _expire(self, stream: ResumableStream) -> None:
+        stream.expiry = None
+        if stream.subscribers == 0 and self._streams.get(stream.id) is stream:
+            if not stream.done:
+                logger.info(f"Stream {stream.id} was not resumed. Closing upstream.")
+            self._remove(stream)
+            self.expired += 1
+
+    def _remove(self, stream: ResumableStream) -> None:
+        del self._streams[stream.id]
+        if stream.expiry is not None:
+            stream.expiry.cancel()
+            stream.expiry = None
+        if not stream.done:
+            stream.task.cancel()
+        self._bytes -= stream.size
+        stream.chunks.clear()
+        stream.size = 0
+
+    async def aclose(self) -> None:
+        """
+        Close every stream's source and free the buffers.
+        """
+        tasks = [stream.task for stream in self._streams.values()]
+        for stream in list(self._streams.values()):
+            self._remove(stream)
+        await cancel_and_wait(*tasks)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "streams": len(self._streams),
+            "detached": sum(1 for s in self._streams.values() if s.subscribers == 0),
+            "buffered_bytes": self._bytes,
+            "started": self.started,
+            "resumed": self.resumed,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
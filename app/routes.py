@@ -1,16 +1,157 @@
 import asyncio
+import json
 import logging
+import sqlite3
+import time
+from typing import Dict, List, Optional
 
-from fastapi import APIRouter, HTTPException, status
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+import anyio
+from fastapi import APIRouter, Header, HTTPException, Query, Request, status
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
-from app.config import API_KEY
-from app.generator import MalformedResponseError, RateLimitError, StreamingCodeGenerator
+from app import metrics
+from app.admission import AdmissionController, AdmissionRejected
+from app.balancer import UpstreamTarget
+from app.batch import run_batch
+from app.cache import ResponseCache, cached_stream
+from app.coalesce import FlushMode, coalesce
+from app.compression import SKIP_COMPRESSION, compression_ratio
+from app.config import (
+    ADMISSION_ENABLED,
+    ADMISSION_MAX_CONCURRENT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT,
+    API_KEY,
+    BATCH_MAX_PARALLELISM,
+    BATCH_MAX_PROMPTS,
+    CHUNK_LOG_MAX_QUEUE,
+    CHUNK_LOG_OVERFLOW,
+    CHUNK_LOG_PATH,
+    COMPLETION_STORE_COMPACT_INTERVAL,
+    COMPLETION_STORE_MAX_BYTES,
+    COMPLETION_STORE_PATH,
+    COMPLETION_STORE_TTL,
+    HEDGING_DEFAULT_DELAY,
+    HEDGING_ENABLED,
+    HEDGING_MAX_RATIO,
+    HEDGING_PERCENTILE,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_REPLAY_PACING,
+    RESPONSE_CACHE_TTL,
+    RESUMABLE_STREAM_GRACE_PERIOD,
+    RESUMABLE_STREAM_MAX_BYTES,
+    RESUMABLE_STREAMS_ENABLED,
+    RESUMABLE_STREAMS_MAX_TOTAL_BYTES,
+    SERVER_TIMING_ENABLED,
+    SINGLE_FLIGHT_ENABLED,
+    STREAM_FLUSH_BYTES,
+    STREAM_FLUSH_LATENCY,
+    STREAM_FLUSH_MODE,
+    UPSTREAM_BALANCE_STRATEGY,
+    UPSTREAM_HTTP2,
+    UPSTREAM_KEEPALIVE_EXPIRY,
+    UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+    UPSTREAM_MAX_TOKENS,
+    UPSTREAM_REQUESTS_PER_MINUTE,
+    UPSTREAM_TARGETS,
+    UPSTREAM_TOKENS_PER_MINUTE,
+)
+from app.disconnect import DisconnectAwareResponse, DisconnectStats
+from app.fences import MEDIA_TYPES, FenceSplitter, OutputFormat, encode_events
+from app.generator import (
+    COMPLETION_TOKEN_ESTIMATE,
+    MalformedResponseError,
+    RateLimitError,
+    StreamingCodeGenerator,
+    Usage,
+)
+from app.hedging import Hedger, hedged
+from app.resume import ResumableStream, StreamGone, StreamRegistry
+from app.singleflight import SingleFlight
+from app.sinks import FileSink, QueuedSink
+from app.store import CompletionStore, stored_stream
+from app.tokenizer import count_tokens, estimate_tokens
 from app.utils import async_call_with_retry_generator
 
 router = APIRouter()
-generator = StreamingCodeGenerator(api_key=API_KEY, request_timeout=30.0)
+sinks = []
+if CHUNK_LOG_PATH:
+    sinks.append(
+        QueuedSink(
+            FileSink(CHUNK_LOG_PATH),
+            name="chunk_log",
+            max_queue=CHUNK_LOG_MAX_QUEUE,
+            overflow=CHUNK_LOG_OVERFLOW,
+            offload=True,  # File writes block
+        )
+    )
+generator = StreamingCodeGenerator(
+    api_key=API_KEY,
+    request_timeout=30.0,
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    http2=UPSTREAM_HTTP2,
+    max_tokens=UPSTREAM_MAX_TOKENS or None,
+    requests_per_minute=UPSTREAM_REQUESTS_PER_MINUTE or None,
+    tokens_per_minute=UPSTREAM_TOKENS_PER_MINUTE or None,
+    targets=[UpstreamTarget(**target) for target in UPSTREAM_TARGETS] or None,
+    balance_strategy=UPSTREAM_BALANCE_STRATEGY,
+    sinks=sinks,
+)
+response_cache = (
+    ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl=RESPONSE_CACHE_TTL,
+    )
+    if RESPONSE_CACHE_ENABLED
+    else None
+)
+completion_store = (
+    CompletionStore(
+        COMPLETION_STORE_PATH,
+        max_bytes=COMPLETION_STORE_MAX_BYTES,
+        ttl=COMPLETION_STORE_TTL,
+        compact_interval=COMPLETION_STORE_COMPACT_INTERVAL,
+    )
+    if COMPLETION_STORE_PATH
+    else None
+)
+single_flight = SingleFlight() if SINGLE_FLIGHT_ENABLED else None
+hedger = (
+    Hedger(
+        percentile=HEDGING_PERCENTILE,
+        default_delay=HEDGING_DEFAULT_DELAY,
+        max_hedge_ratio=HEDGING_MAX_RATIO,
+    )
+    if HEDGING_ENABLED
+    else None
+)
+admission = (
+    AdmissionController(
+        max_concurrent=ADMISSION_MAX_CONCURRENT,
+        max_queue=ADMISSION_MAX_QUEUE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+    )
+    if ADMISSION_ENABLED
+    else None
+)
+resumable_streams = (
+    StreamRegistry(
+        max_stream_bytes=RESUMABLE_STREAM_MAX_BYTES,
+        max_total_bytes=RESUMABLE_STREAMS_MAX_TOTAL_BYTES,
+        grace_period=RESUMABLE_STREAM_GRACE_PERIOD,
+    )
+    if RESUMABLE_STREAMS_ENABLED
+    else None
+)
+disconnect_stats = DisconnectStats()
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -18,26 +159,87 @@ logger = logging.getLogger(__name__)
 
 class Prompt(BaseModel):
     prompt: str
+    client_id: Optional[str] = Field(
+        None, description="Client identifier used to share capacity fairly."
+    )
+    priority: int = Field(
+        0, ge=0, le=9, description="Queue priority, higher is admitted first."
+    )
 
 
 @router.post("/generate-code/", status_code=status.HTTP_200_OK)
-async def generate_code(payload: Prompt):
+async def generate_code(
+    request: Request,
+    payload: Prompt,
+    flush: Optional[FlushMode] = Query(None),
+    output: OutputFormat = Query("text"),
+):
     """
     Endpoint to generate code with explanation using OpenAI's API.
 
     Args:
+        request (Request): The incoming request.
         payload (Prompt): The prompt data containing the user's prompt.
+        flush (str, optional): "immediate" sends every upstream delta as its own chunk,
+            "coalesce" merges small deltas before writing. Defaults to STREAM_FLUSH_MODE.
+        output (str, optional): "text" streams the raw answer. "sse" and "ndjson" stream
+            typed `explanation_delta`, `code_start`, `code_delta` and `code_end` events,
+            split from the markdown code fences as they arrive. Defaults to "text".
+            SSE streams are resumable: the response carries an `X-Stream-ID` header
+            and numbered events, see `resume_generate_code`.
 
     Returns:
         StreamingResponse: An asynchronous streaming response with the generated code.
     """
 
+    received = time.perf_counter()
+    metrics.REQUESTS.labels("generate").inc()
+    if (flush or STREAM_FLUSH_MODE) == "immediate":
+        # Per-token chunks come out larger once each is compressed and flushed
+        request.scope[SKIP_COMPRESSION] = True
+    usage = Usage()
+    slot = await admit(prompt_key(payload.prompt), payload)
+    timing = {"queue": time.perf_counter() - received}
+
+    def server_timing() -> str:
+        return format_server_timing({**timing, "total": time.perf_counter() - received})
+
+    if output == "sse" and resumable_streams is not None:
+        # The generation runs in the background so a reconnect can pick it up
+        stream = resumable_streams.create(
+            sse_events(payload.prompt, usage, flush, slot, received, timing)
+        )
+        headers = {"X-Stream-ID": stream.id}
+        if SERVER_TIMING_ENABLED:
+            headers["Server-Timing"] = format_server_timing(timing)
+        return DisconnectAwareResponse(
+            follow_stream(stream),
+            media_type=MEDIA_TYPES[output],
+            headers=headers,
+            server_timing=server_timing if SERVER_TIMING_ENABLED else None,
+        )
+
     async def stream():
+        delivered = []  # Content handed to the client, to measure waste on disconnect
+        splitter = FenceSplitter() if output != "text" else None
+        async_gen = content_stream(payload.prompt, usage, flush)
         try:
-            async_gen = async_stream_generator(payload.prompt)
             async for content in async_gen:
-                # Yield the content as plain text
-                yield content
+                if not delivered:
+                    timing["ttft"] = time.perf_counter() - received
+                delivered.append(content)
+                if splitter is None:
+                    # Yield the content as plain text
+                    yield content
+                else:
+                    events = encode_events(splitter.feed(content), output)
+                    if events:
+                        yield events
+            if splitter is not None:
+                events = encode_events(splitter.flush(), output)
+                if events:
+                    yield events
+            logger.info(f"Upstream token usage: {usage.to_dict()}")
         except asyncio.TimeoutError:
             logger.error("Request handling timed out.")
             raise HTTPException(
@@ -52,22 +254,406 @@ async def generate_code(payload: Prompt):
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Internal Server Error",
             )
+        finally:
+            # Closes the chain down to the upstream response, which also
+            # finalizes the usage counted for it
+            await async_gen.aclose()
+            if response.disconnected:
+                # Still inside the cancelled body task, and counting is off the loop
+                with anyio.CancelScope(shield=True):
+                    await record_disconnect(usage, delivered, response.disconnected_at)
+            if slot is not None:
+                slot.release()
+
+    # The background task releases the slot if the body is never iterated
+    response = DisconnectAwareResponse(
+        stream(),
+        media_type=MEDIA_TYPES[output],
+        headers=(
+            {"Server-Timing": format_server_timing(timing)}
+            if SERVER_TIMING_ENABLED
+            else None
+        ),
+        background=BackgroundTask(slot.release) if slot is not None else None,
+        server_timing=server_timing if SERVER_TIMING_ENABLED else None,
+    )
+    return response
+
+
+class BatchPrompt(BaseModel):
+    prompts: List[str] = Field(..., min_length=1)
+    client_id: Optional[str] = Field(
+        None, description="Client identifier used to share capacity fairly."
+    )
+    priority: int = Field(
+        0, ge=0, le=9, description="Queue priority, higher is admitted first."
+    )
+    parallelism: Optional[int] = Field(
+        None, ge=1, description="Prompts streamed at the same time."
+    )
+
+
+@router.post("/generate-code/batch", status_code=status.HTTP_200_OK)
+async def generate_code_batch(payload: BatchPrompt):
+    """
+    Endpoint to generate code for several prompts over one streaming response.
+
+    Prompts run concurrently, each through admission control, the cache and the
+    retry wrapper like a single request. The response is NDJSON: `{"id", "chunk"}`
+    records interleaved across prompts, and one `{"id", "done", "usage"}` record
+    per prompt, with an "error" field if that prompt failed.
+
+    Args:
+        payload (BatchPrompt): The prompts, ids being their indexes.
+
+    Returns:
+        StreamingResponse: An asynchronous NDJSON stream.
+    """
+    if len(payload.prompts) > BATCH_MAX_PROMPTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A batch may contain at most {BATCH_MAX_PROMPTS} prompts.",
+        )
+    metrics.REQUESTS.labels("batch").inc()
+    parallelism = min(
+        payload.parallelism or BATCH_MAX_PARALLELISM, BATCH_MAX_PARALLELISM
+    )
+
+    async def item_stream(prompt: str, usage: Usage):
+        item = Prompt(
+            prompt=prompt, client_id=payload.client_id, priority=payload.priority
+        )
+        try:
+            slot = await admit(prompt_key(prompt), item)
+        except HTTPException as e:
+            raise Exception(e.detail)
+        try:
+            async_gen = content_stream(prompt, usage)
+            async for content in async_gen:
+                yield content
+        finally:
+            if slot is not None:
+                slot.release()
+
+    async def stream():
+        records = run_batch(payload.prompts, item_stream, parallelism)
+        try:
+            async for record in records:
+                yield json.dumps(record) + "\n"
+        except asyncio.CancelledError:
+            logger.info("Client disconnected.")
+            raise
+        finally:
+            await records.aclose()
+
+    return DisconnectAwareResponse(stream(), media_type="application/x-ndjson")
+
+
+@router.get("/generate-code/streams/{stream_id}", status_code=status.HTTP_200_OK)
+async def resume_generate_code(
+    stream_id: str,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Endpoint to resume an SSE stream after a dropped connection.
+
+    Serves the events after `Last-Event-ID` from the stream's buffer, then
+    follows the generation if it is still running. No new upstream call is made.
+
+    Args:
+        stream_id (str): The `X-Stream-ID` of the original response.
+        last_event_id (str, optional): The id of the last event received. Replays
+            the whole buffered stream when absent.
+
+    Returns:
+        StreamingResponse: An asynchronous SSE stream.
+    """
+    metrics.REQUESTS.labels("resume").inc()
+    stream = resumable_streams.get(stream_id) if resumable_streams else None
+    if stream is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown or expired stream.",
+        )
+    try:
+        after = int(last_event_id) if last_event_id else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Last-Event-ID must be an event id of this stream.",
+        )
+    if not stream.can_resume(after):
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="The requested events are no longer buffered.",
+        )
+    return DisconnectAwareResponse(
+        follow_stream(stream, after),
+        media_type=MEDIA_TYPES["sse"],
+        headers={"X-Stream-ID": stream.id},
+    )
+
+
+@router.get("/stats")
+async def stats():
+    """
+    Report queue depth, wait times and the state of the caches and rate limiter.
+    """
+    return {
+        "admission": admission.stats() if admission is not None else None,
+        "response_cache": (
+            response_cache.stats() if response_cache is not None else None
+        ),
+        "completion_store": (
+            completion_store.stats() if completion_store is not None else None
+        ),
+        "single_flight": single_flight.stats() if single_flight is not None else None,
+        "hedging": hedger.stats() if hedger is not None else None,
+        "resumable_streams": (
+            resumable_streams.stats() if resumable_streams is not None else None
+        ),
+        "disconnects": disconnect_stats.stats(),
+        "compression_ratio": compression_ratio(),
+        **generator.stats(),
+    }
+
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    """
+    Expose latency, throughput and error metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+def format_server_timing(timing: Dict[str, float]) -> str:
+    """
+    Format durations in seconds as a Server-Timing value in milliseconds.
+    """
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in timing.items()
+    )
+
+
+async def record_disconnect(usage: Usage, delivered: List[str], disconnected_at: float):
+    """
+    Record a client disconnect and the completion tokens it did not receive.
+
+    Called once the upstream stream has been closed, so `usage` holds
+    everything the upstream generated for this request.
+    """
+    close_seconds = time.monotonic() - disconnected_at
+    wasted = usage.completion_tokens - await count_tokens(
+        generator.model, "".join(delivered)
+    )
+    disconnect_stats.record(wasted, close_seconds)
+    logger.info(
+        f"Upstream closed {close_seconds:.3f} seconds after disconnect. "
+        f"{max(0, wasted)} tokens were generated after the client left."
+    )
+
+
+def prompt_key(prompt: str) -> str:
+    """
+    Key identifying requests that would produce the same completion.
+    """
+    return ResponseCache.make_key(
+        generator.model, generator.system_prompt, generator.temperature, prompt
+    )
+
+
+def estimate_cost(prompt: str) -> int:
+    """
+    Estimate a request's token cost for fair queueing. A character-based estimate
+    is close enough to order the queue, and never runs the tokenizer on the loop.
+    """
+    return estimate_tokens(prompt) + (generator.max_tokens or COMPLETION_TOKEN_ESTIMATE)
+
+
+async def admit(key: str, payload: Prompt):
+    """
+    Wait for an upstream slot, or shed the request with a 503 and Retry-After.
+
+    Waiting requests are ordered by priority, then shared fairly between
+    clients by estimated token cost. Requests that will be served from the
+    caches or attach to an identical in-flight stream do not open an upstream
+    stream and skip the queue.
+
+    Returns:
+        Slot: The admitted request, or None when no slot is needed.
+    """
+    if admission is None:
+        return None
+    if (response_cache is not None and response_cache.contains(key)) or (
+        single_flight is not None and key in single_flight
+    ):
+        return None
+    # Only worth a disk lookup when the request would otherwise wait
+    if completion_store is not None and admission.saturated:
+        try:
+            if await completion_store.contains(key):
+                return None
+        except sqlite3.Error as e:
+            logger.warning(
+                f"Completion store lookup failed, treating it as a miss: {e}"
+            )
+    started = time.perf_counter()
+    try:
+        slot = await admission.acquire(
+            client=payload.client_id or "anonymous",
+            cost=estimate_cost(payload.prompt),
+            priority=payload.priority,
+        )
+        metrics.QUEUE_WAIT.observe(time.perf_counter() - started)
+        return slot
+    except AdmissionRejected as e:
+        logger.warning(f"Request rejected by admission control: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def content_stream(prompt: str, usage: Usage, flush: Optional[str] = None):
+    """
+    The answer's content for one request, coalesced unless `flush` is "immediate".
+    """
+    async_gen = async_stream_generator(prompt, usage=usage)
+    if (flush or STREAM_FLUSH_MODE) == "coalesce":
+        async_gen = coalesce(
+            async_gen,
+            max_bytes=STREAM_FLUSH_BYTES,
+            max_latency=STREAM_FLUSH_LATENCY,
+        )
+    return async_gen
+
 
-    return StreamingResponse(stream(), media_type="text/plain")
+async def sse_events(
+    prompt: str,
+    usage: Usage,
+    flush: Optional[str],
+    slot,
+    received: float,
+    timing: Dict[str, float],
+):
+    """
+    Source of a resumable stream: the answer as SSE events, without ids.
 
+    Runs in the background independently of the client connection, so the
+    admission slot is released here once the generation ends or expires.
+    """
+    splitter = FenceSplitter()
+    async_gen = content_stream(prompt, usage, flush)
+    try:
+        async for content in async_gen:
+            timing.setdefault("ttft", time.perf_counter() - received)
+            for event in splitter.feed(content):
+                yield encode_events([event], "sse")
+        for event in splitter.flush():
+            yield encode_events([event], "sse")
+        logger.info(f"Upstream token usage: {usage.to_dict()}")
+    finally:
+        await async_gen.aclose()
+        if slot is not None:
+            slot.release()
+
+
+async def follow_stream(stream: ResumableStream, last_event_id: Optional[int] = None):
+    """
+    Follow a resumable stream, numbering its SSE events so a client can resume.
 
-async def async_stream_generator(prompt: str):
+    A failed generation ends with an `error` event rather than a dropped connection.
+    """
+    events = resumable_streams.follow(stream, last_event_id)
+    try:
+        async for seq, event in events:
+            yield f"id: {seq}\n{event}"
+    except asyncio.CancelledError:
+        logger.info("Client disconnected. Keeping the stream for a reconnect.")
+        raise
+    except Exception as e:
+        logger.error(f"Error in stream: {e}")
+        if isinstance(e, asyncio.TimeoutError):
+            detail = "Request timed out."
+        elif isinstance(e, StreamGone):
+            detail = str(e)
+        else:
+            detail = "Internal Server Error"
+        yield encode_events([{"type": "error", "detail": detail}], "sse")
+    finally:
+        await events.aclose()
+
+
+async def async_stream_generator(prompt: str, usage: Optional[Usage] = None):
     """
     Asynchronous generator that streams data from the code generator with retries.
+    Repeated prompts are served from the response cache, then from the completion
+    store, and identical prompts that are already in flight share one upstream stream.
+
+    Args:
+        prompt (str): The user's prompt to send to the generator.
+        usage (Usage, optional): Filled in with the upstream tokens this request
+            consumed. Stays at zero for cache hits and coalesced requests.
+
+    Yields:
+        str: The generated content chunk.
+    """
+    key = prompt_key(prompt)
+    if usage is None:
+        usage = Usage()  # Still needed for the finish reason
+
+    def complete() -> bool:
+        # Completions cut short by the token limit or a filter are not kept
+        return usage.finish_reason in (None, "stop")
+
+    def persistent_stream():
+        if completion_store is None:
+            return upstream_stream(prompt, usage)
+        return stored_stream(
+            completion_store,
+            key,
+            lambda: upstream_stream(prompt, usage),
+            should_store=complete,
+        )
+
+    def source_factory():
+        if response_cache is None:
+            return persistent_stream()
+        return cached_stream(
+            response_cache,
+            key,
+            persistent_stream,
+            pacing=RESPONSE_CACHE_REPLAY_PACING,
+            should_store=complete,
+        )
+
+    if single_flight is None:
+        source = source_factory()
+    else:
+        source = single_flight.stream(key, source_factory)
+    async for content in source:
+        yield content
+
+
+async def upstream_stream(prompt: str, usage: Optional[Usage] = None):
+    """
+    Stream a fresh completion from the code generator with retries.
 
     Args:
         prompt (str): The user's prompt to send to the generator.
+        usage (Usage, optional): Accumulates token usage across attempts.
 
     Yields:
         str: The generated content chunk.
     """
+    func = generator.generate_code_with_explanation
+    if hedger is not None:
+        func = hedged(func, hedger)
     async for content in async_call_with_retry_generator(
-        generator.generate_code_with_explanation,
+        func,
         prompt,
         retries=3,
         delay=1,
@@ -75,7 +661,8 @@ async def async_stream_generator(prompt: str):
         exceptions=(Exception, RateLimitError, MalformedResponseError),
         operation_timeout=60.0,  # Timeout per attempt
         total_timeout=120.0,  # Total timeout across all retries
+        resume=True,  # Continue a partial answer instead of replaying it
+        jitter=0.25,  # Spread out concurrent retries
+        usage=usage,
     ):
-        # Allow cancellation between chunks
-        await asyncio.sleep(0)
         yield content
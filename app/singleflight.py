@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from app.utils import cancel_and_wait
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """
+    One in-flight upstream stream shared by every subscriber with the same key.
+
+    Chunks are appended to a shared buffer. Each subscriber reads it through its
+    own cursor, so a slow subscriber only holds back itself. A subscriber that
+    joins late replays the buffered prefix and then follows the live chunks.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _pump(self, source: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            await source.aclose()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """
+        Yield the buffered prefix, then live chunks until the upstream finishes.
+        """
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                chunk = self.chunks[index]
+                index += 1
+                yield chunk
+                continue
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    An in-process registry that coalesces identical in-flight requests onto one
+    upstream stream.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._flights
+
+    async def stream(
+        self, key: str, source_factory: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """
+        Stream the result for `key`, starting the upstream only if no identical
+        request is already running.
+
+        The shared upstream is cancelled when its last subscriber disconnects.
+
+        Args:
+            key (str): Identifies identical requests.
+            source_factory (Callable[[], AsyncIterator[str]]): Creates the upstream stream.
+
+        Yields:
+            str: The content chunks.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = Flight(key)
+            flight.task = asyncio.create_task(flight._pump(source_factory()))
+            flight.task.add_done_callback(lambda _: self._discard(flight))
+            self._flights[key] = flight
+            self.started += 1
+        else:
+            logger.info("Coalescing request onto in-flight upstream stream.")
+            self.coalesced += 1
+
+        flight.subscribers += 1
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                logger.info("Last subscriber left. Cancelling upstream stream.")
+                self._discard(flight)
+                await cancel_and_wait(flight.task)
+
+    def _discard(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(f.subscribers for f in self._flights.values()),
+            "started": self.started,
+            "coalesced": self.coalesced,
+        }
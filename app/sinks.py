@@ -0,0 +1,202 @@
+import asyncio
+import inspect
+import logging
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from app import metrics
+from app.utils import cancel_and_wait
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop", "block", "sample")
+
+ChunkHandler = Callable[[str], Union[None, Awaitable[None]]]
+
+
+class QueuedSink:
+    """
+    Feeds content chunks to a handler off the upstream read loop.
+
+    `put` enqueues a chunk on a bounded queue that a background task drains,
+    so a slow handler never delays the stream it observes. When the queue is
+    full, the overflow policy decides what happens:
+
+    - "drop" discards the new chunk.
+    - "block" waits for room, pushing back on the stream. Only for sinks that
+      must see every chunk.
+    - "sample" keeps one chunk in `sample_every` once the queue is half full,
+      and drops the rest, so the sink sees a thinned stream under load.
+
+    Handlers may be plain functions or coroutines. With `offload`, a plain
+    handler runs on a thread pool instead of the event loop, which suits
+    CPU-heavy or blocking work such as compression or file writes. Chunks
+    waiting in the queue are handed over in one batch per thread hop. Calls
+    to one sink's handler never overlap.
+    """
+
+    def __init__(
+        self,
+        handler: ChunkHandler,
+        name: Optional[str] = None,
+        max_queue: int = 1024,
+        overflow: str = "drop",
+        sample_every: int = 10,
+        offload: bool = False,
+        executor: Optional[Executor] = None,
+        max_batch: int = 64,
+    ):
+        """
+        Initialize the sink.
+
+        Args:
+            handler (Callable[[str], None]): Called with each chunk, may be async.
+            name (str, optional): Name used in stats and metrics. Defaults to the handler's.
+            max_queue (int, optional): Chunks that may wait for the handler. Defaults to 1024.
+            overflow (str, optional): "drop", "block" or "sample". Defaults to "drop".
+            sample_every (int, optional): Chunks kept under the "sample" policy, one in
+                this many. Defaults to 10.
+            offload (bool, optional): Run a plain handler on a thread pool. Defaults to False.
+            executor (Executor, optional): The thread pool. Defaults to the loop's default executor.
+            max_batch (int, optional): Most chunks handed to the thread pool at once. Defaults to 64.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if offload and inspect.iscoroutinefunction(handler):
+            raise ValueError("Only plain handlers can be offloaded to a thread pool.")
+        self.handler = handler
+        self.name = name or getattr(handler, "__name__", type(handler).__name__)
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.sample_every = sample_every
+        self.offload = offload
+        self.executor = executor
+        self.max_batch = max_batch
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+        self._sampled = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._dropped_metric = metrics.SINK_DROPPED.labels(self.name)
+
+    def start(self) -> None:
+        """
+        Start draining the queue. Called on the first `put` if not before.
+        """
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(self.max_queue)
+            self._task = asyncio.create_task(self._drain())
+
+    async def put(self, chunk: str) -> None:
+        """
+        Enqueue a chunk. Only suspends under the "block" policy when the queue is full.
+
+        Args:
+            chunk (str): A content chunk.
+        """
+        if self._task is None:
+            self.start()
+        queue = self._queue
+        if self.overflow == "block":
+            await queue.put(chunk)
+            return
+        if self.overflow == "sample" and queue.qsize() >= self.max_queue // 2:
+            self._sampled += 1
+            if self._sampled % self.sample_every:
+                self._drop()
+                return
+        try:
+            queue.put_nowait(chunk)
+        except asyncio.QueueFull:
+            self._drop()
+
+    def _drop(self) -> None:
+        self.dropped += 1
+        self._dropped_metric.inc()
+
+    def _handle_batch(self, batch: List[str]) -> None:
+        for chunk in batch:
+            try:
+                self.handler(chunk)
+                self.delivered += 1
+            except Exception as e:
+                self._failed(e)
+
+    async def _handle(self, chunk: str) -> None:
+        try:
+            result = self.handler(chunk)
+            if inspect.isawaitable(result):
+                await result
+            self.delivered += 1
+        except Exception as e:
+            self._failed(e)
+
+    def _failed(self, error: Exception) -> None:
+        self.errors += 1
+        logger.warning(f"Sink {self.name} failed to handle a chunk: {error}")
+
+    async def _drain(self) -> None:
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                if self.offload:
+                    await loop.run_in_executor(self.executor, self._handle_batch, batch)
+                else:
+                    for chunk in batch:
+                        await self._handle(chunk)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def aclose(self, timeout: float = 5.0) -> None:
+        """
+        Let the handler catch up on queued chunks for up to `timeout` seconds,
+        then stop the background task.
+        """
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Sink {self.name} closed with {self._queue.qsize()} chunks unhandled."
+            )
+        await cancel_and_wait(self._task)
+        self._task = None
+        close = getattr(self.handler, "close", None)
+        if callable(close):
+            close()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+class FileSink:
+    """
+    A handler that appends chunks to a file. Blocking, so meant to be offloaded.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __call__(self, chunk: str) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(chunk)
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
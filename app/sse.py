@@ -0,0 +1,132 @@
+import json
+import logging
+from typing import List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Use a faster JSON backend when one is installed. orjson.JSONDecodeError
+# subclasses json.JSONDecodeError, so callers catch the same exception either way.
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    json_loads = json.loads
+    JSON_BACKEND = "json"
+
+
+class SSEEvent(NamedTuple):
+    """A dispatched server-sent event. `data` is kept as raw bytes."""
+
+    data: bytes
+    event: str = "message"
+    id: Optional[str] = None
+
+
+class SSEDecoder:
+    """
+    An incremental server-sent events decoder that works on raw byte chunks.
+
+    Follows the SSE field rules: `data:` lines are joined with newlines, `event:`
+    and `id:` set the event type and last event ID, `retry:` sets the reconnection
+    time, lines starting with `:` are comments, and a blank line dispatches the
+    event. Lines may end in LF, CRLF or CR, even when split across chunks.
+    """
+
+    def __init__(self):
+        self._tail = b""
+        self._pending_cr = False
+        self._data: List[bytes] = []
+        self._event = ""
+        self.last_event_id: Optional[str] = None
+        self.retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """
+        Decode a chunk of the stream.
+
+        Args:
+            chunk (bytes): Raw bytes as received from the network.
+
+        Returns:
+            List[SSEEvent]: Events completed by this chunk.
+        """
+        if self._pending_cr:
+            chunk = b"\r" + chunk
+            self._pending_cr = False
+        if b"\r" in chunk:
+            if chunk.endswith(b"\r"):
+                # Wait for the next chunk to tell a CRLF from a lone CR
+                chunk = chunk[:-1]
+                self._pending_cr = True
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        lines = (self._tail + chunk).split(b"\n") if self._tail else chunk.split(b"\n")
+        self._tail = lines.pop()
+        events = []
+        data = self._data
+        for line in lines:
+            if line.startswith(b"data: "):
+                # Fast path for the common case
+                data.append(line[6:])
+            elif not line:
+                if data:
+                    events.append(
+                        SSEEvent(
+                            data[0] if len(data) == 1 else b"\n".join(data),
+                            self._event or "message",
+                            self.last_event_id,
+                        )
+                    )
+                    data = self._data = []
+                self._event = ""
+            else:
+                self._process_line(line)
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """
+        Finish decoding at the end of the stream.
+
+        A trailing event without its closing blank line is still dispatched, which
+        tolerates upstreams that close the connection right after the last event.
+
+        Returns:
+            List[SSEEvent]: Any event still pending.
+        """
+        self._pending_cr = False
+        if self._tail:
+            self._process_line(self._tail)
+            self._tail = b""
+        event = self._dispatch()
+        return [event] if event is not None else []
+
+    def _process_line(self, line: bytes) -> None:
+        if line.startswith(b":"):
+            return  # Comment
+        name, colon, value = line.partition(b":")
+        if colon and value.startswith(b" "):
+            value = value[1:]
+        if name == b"data":
+            self._data.append(value)
+        elif name == b"event":
+            self._event = value.decode("utf-8", "replace")
+        elif name == b"id":
+            if b"\0" not in value:
+                self.last_event_id = value.decode("utf-8", "replace")
+        elif name == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        data, event = self._data, self._event
+        self._data = []
+        self._event = ""
+        if not data:
+            return None
+        return SSEEvent(
+            data[0] if len(data) == 1 else b"\n".join(data),
+            event or "message",
+            self.last_event_id,
+        )
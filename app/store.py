@@ -0,0 +1,432 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    chunks INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access);
+CREATE TABLE IF NOT EXISTS chunks (
+    key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (key, seq)
+) WITHOUT ROWID;
+"""
+
+
+@dataclass
+class StoredCompletion:
+    """
+    Index entry of a stored completion. The chunks stay on disk.
+    """
+
+    key: str
+    size: int
+    chunks: int
+    created_at: float
+    last_access: float
+
+
+class CompletionStore:
+    """
+    Persistent store of completed streams, shared by all workers on a host.
+
+    Completions live in a SQLite database in WAL mode, so any number of worker
+    processes can read while one writes. The `completions` table is a compact
+    key index, the chunks are stored as rows and read back in small batches,
+    so replaying a completion never loads it fully into memory.
+
+    Every database call runs in a thread so the event loop is never blocked on
+    disk. Expired entries are removed and the store is shrunk back under
+    `max_bytes`, least recently used first, by a background compaction task.
+    Between compactions the store may exceed `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 256 * 1024 * 1024,
+        ttl: Optional[float] = None,
+        compact_interval: float = 300.0,
+        batch_size: int = 64,
+        touch_interval: float = 60.0,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        Open or create the store.
+
+        Args:
+            path (str): Database file, shared by the workers.
+            max_bytes (int, optional): Size of the stored text above which compaction
+                evicts entries. Defaults to 256 MiB.
+            ttl (float, optional): Seconds a completion stays valid, forever when None.
+            compact_interval (float, optional): Seconds between background compactions.
+                Defaults to 300.
+            batch_size (int, optional): Chunks read per query on replay. Defaults to 64.
+            touch_interval (float, optional): Minimum seconds between updates of an
+                entry's last access time, so hot keys do not serialize workers on the
+                write lock. Defaults to 60.
+            clock (Callable[[], float], optional): Wall clock, shared across processes.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        self.batch_size = batch_size
+        self.touch_interval = touch_interval
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._compactor: Optional[asyncio.Task] = None
+        self._writes: Set[asyncio.Task] = set()
+
+        conn = self._connection()
+        # Must be set before the first table is created to take effect
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        with conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Return the calling thread's connection, opening it on first use.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    async def _run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(func, *args))
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and self.clock() - created_at > self.ttl
+
+    def _get(self, key: str) -> Optional[StoredCompletion]:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT key, size, chunks, created_at, last_access "
+            "FROM completions WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = StoredCompletion(*row)
+        if self._expired(entry.created_at):
+            return None
+        now = self.clock()
+        if now - entry.last_access > self.touch_interval:
+            with conn:
+                conn.execute(
+                    "UPDATE completions SET last_access = ? WHERE key = ?", (now, key)
+                )
+            entry.last_access = now
+        return entry
+
+    async def get(self, key: str) -> Optional[StoredCompletion]:
+        """
+        Look up a completion, counting a hit or a miss.
+
+        Args:
+            key (str): The completion key.
+
+        Returns:
+            Optional[StoredCompletion]: The index entry, or None if absent or expired.
+        """
+        entry = await self._run(self._get, key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _contains(self, key: str) -> bool:
+        row = (
+            self._connection()
+            .execute("SELECT created_at FROM completions WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row is not None and not self._expired(row[0])
+
+    async def contains(self, key: str) -> bool:
+        """
+        Check for a fresh completion without counting a hit or touching it.
+        """
+        return await self._run(self._contains, key)
+
+    async def replay(self, key: str) -> AsyncIterator[str]:
+        """
+        Stream a stored completion, `batch_size` chunks at a time.
+
+        The whole replay reads from one snapshot, so it stays complete even if
+        another worker evicts the entry meanwhile.
+
+        Args:
+            key (str): The completion key.
+
+        Yields:
+            str: The stored chunks in order.
+        """
+        # A dedicated connection, since its open cursor holds the read snapshot
+        conn = await self._run(self._connect)
+        try:
+            cursor = await self._run(
+                conn.execute,
+                "SELECT text FROM chunks WHERE key = ? ORDER BY seq",
+                (key,),
+            )
+            while True:
+                rows = await self._run(cursor.fetchmany, self.batch_size)
+                if not rows:
+                    break
+                for (text,) in rows:
+                    yield text
+        finally:
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+
+    def _put(self, key: str, chunks: List[str]) -> None:
+        now = self.clock()
+        size = sum(len(chunk.encode("utf-8")) for chunk in chunks)
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM chunks WHERE key = ?", (key,))
+            conn.executemany(
+                "INSERT INTO chunks (key, seq, text) VALUES (?, ?, ?)",
+                ((key, seq, chunk) for seq, chunk in enumerate(chunks)),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO completions "
+                "(key, size, chunks, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, size, len(chunks), now, now),
+            )
+
+    async def put(self, key: str, chunks: List[str]) -> None:
+        """
+        Store a completed stream in one transaction, replacing any previous one.
+
+        Args:
+            key (str): The completion key.
+            chunks (List[str]): The content chunks in order.
+        """
+        await self._run(self._put, key, chunks)
+        self.writes += 1
+
+    def put_later(self, key: str, chunks: List[str]) -> asyncio.Task:
+        """
+        Store a completed stream in a background task, so the caller never waits
+        on another worker holding the write lock. Failures are logged.
+
+        Args:
+            key (str): The completion key.
+            chunks (List[str]): The content chunks in order.
+
+        Returns:
+            asyncio.Task: The write.
+        """
+        task = asyncio.create_task(self._put_logged(key, chunks))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+        return task
+
+    async def _put_logged(self, key: str, chunks: List[str]) -> None:
+        try:
+            await self.put(key, chunks)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to store completion: {e}")
+
+    async def flush_writes(self) -> None:
+        """
+        Wait for the background writes started so far.
+        """
+        if self._writes:
+            await asyncio.wait(list(self._writes))
+
+    def _delete(self, conn: sqlite3.Connection, keys: List[str]) -> None:
+        conn.executemany("DELETE FROM chunks WHERE key = ?", ((k,) for k in keys))
+        conn.executemany("DELETE FROM completions WHERE key = ?", ((k,) for k in keys))
+
+    def _compact(self) -> int:
+        conn = self._connection()
+        evicted = 0
+        with conn:
+            if self.ttl is not None:
+                expired = [
+                    key
+                    for (key,) in conn.execute(
+                        "SELECT key FROM completions WHERE created_at < ?",
+                        (self.clock() - self.ttl,),
+                    )
+                ]
+                self._delete(conn, expired)
+                evicted += len(expired)
+            (total,) = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()
+            while total > self.max_bytes:
+                oldest = conn.execute(
+                    "SELECT key, size FROM completions ORDER BY last_access LIMIT ?",
+                    (self.batch_size,),
+                ).fetchall()
+                victims = []
+                for key, size in oldest:
+                    if total <= self.max_bytes:
+                        break
+                    victims.append(key)
+                    total -= size
+                self._delete(conn, victims)
+                evicted += len(victims)
+        # Return freed pages to the filesystem and fold the WAL back in
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return evicted
+
+    async def compact(self) -> int:
+        """
+        Remove expired entries, evict least recently used ones until the store fits
+        in `max_bytes`, and shrink the database file.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        evicted = await self._run(self._compact)
+        self.evictions += evicted
+        if evicted:
+            logger.info(f"Compaction removed {evicted} stored completions.")
+        return evicted
+
+    async def _compact_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except sqlite3.Error as e:
+                logger.warning(f"Completion store compaction failed: {e}")
+
+    def start(self) -> None:
+        """
+        Start the background compaction task.
+        """
+        if self._compactor is None:
+            self._compactor = asyncio.create_task(self._compact_periodically())
+
+    async def aclose(self) -> None:
+        """
+        Finish pending writes, stop background compaction and close the database
+        connections.
+        """
+        await self.flush_writes()
+        if self._compactor is not None:
+            self._compactor.cancel()
+            try:
+                await self._compactor
+            except asyncio.CancelledError:
+                pass
+            self._compactor = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report this worker's hit, miss, write and eviction counts.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+async def stored_stream(
+    store: CompletionStore,
+    key: str,
+    source_factory: Callable[[], AsyncIterator[str]],
+    should_store: Callable[[], bool] = lambda: True,
+) -> AsyncIterator[str]:
+    """
+    Replay a stream from the completion store, or stream it from the source and
+    store it once it completes.
+
+    Only streams that run to completion and pass `should_store` are written, in
+    the background so the response never waits on the write. A stream that
+    raises or is closed early by the client is never stored. The store is only
+    a cache: if it cannot be read, the stream comes from the source.
+
+    Args:
+        store (CompletionStore): The store to use.
+        key (str): The completion key for this request.
+        source_factory (Callable[[], AsyncIterator[str]]): Creates the upstream stream on a miss.
+        should_store (Callable[[], bool], optional): Checked after the source completes,
+            e.g. to skip completions cut short by the token limit.
+
+    Yields:
+        str: The content chunks.
+    """
+    try:
+        entry = await store.get(key)
+    except sqlite3.Error as e:
+        logger.warning(f"Completion store lookup failed, treating it as a miss: {e}")
+        entry = None
+    if entry is not None:
+        logger.info("Serving response from the completion store.")
+        replayed = False
+        replay = store.replay(key)
+        try:
+            async for chunk in replay:
+                replayed = True
+                yield chunk
+        except sqlite3.Error as e:
+            if replayed:
+                raise  # Part of the answer is out, the source cannot continue it
+            logger.warning(
+                f"Completion store replay failed, treating it as a miss: {e}"
+            )
+        finally:
+            await replay.aclose()
+        # Stored completions are never empty, so nothing was replayed only if
+        # another worker evicted the entry after the lookup, or the read failed
+        if replayed:
+            return
+
+    chunks: List[str] = []
+    source = source_factory()
+    try:
+        async for chunk in source:
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        await source.aclose()
+    if chunks and should_store():
+        store.put_later(key, chunks)
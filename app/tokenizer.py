@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import threading
+from typing import Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# Process-wide cache of loaded encodings, keyed by model name
+_ENCODINGS: Dict[str, object] = {}
+_LOCK = threading.Lock()
+
+# Rough characters per token, for estimates that need no tokenizer
+CHARS_PER_TOKEN = 4
+
+
+def get_encoding(model: str):
+    """
+    Return the tiktoken encoding for a model, loading it on first use.
+
+    tiktoken is imported lazily so importing the app never blocks on BPE data.
+    Every caller asking for the same model shares one loaded encoding.
+
+    Args:
+        model (str): The model name, e.g. "gpt-4".
+
+    Returns:
+        tiktoken.Encoding: The encoding for the model.
+    """
+    encoding = _ENCODINGS.get(model)
+    if encoding is not None:
+        return encoding
+    with _LOCK:
+        encoding = _ENCODINGS.get(model)
+        if encoding is None:
+            import tiktoken
+
+            encoding = tiktoken.encoding_for_model(model)
+            _ENCODINGS[model] = encoding
+            logger.info(f"Loaded tokenizer for model {model}.")
+    return encoding
+
+
+def prewarm_encodings(models: Iterable[str]) -> threading.Thread:
+    """
+    Load encodings for the given models in a background thread.
+
+    Failures are logged rather than raised, the encoding is then loaded on first use.
+
+    Args:
+        models (Iterable[str]): Model names to load.
+
+    Returns:
+        threading.Thread: The started daemon thread.
+    """
+    models = list(models)
+
+    def load():
+        for model in models:
+            try:
+                get_encoding(model)
+            except Exception as e:
+                logger.warning(f"Failed to pre-warm tokenizer for {model}: {e}")
+
+    thread = threading.Thread(target=load, name="tokenizer-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the tokens in `text` from its length, without the tokenizer.
+    """
+    return len(text) // CHARS_PER_TOKEN
+
+
+def _encoded_lengths(model: str, texts: List[str]) -> List[int]:
+    encoding = get_encoding(model)
+    return [len(encoding.encode(text)) for text in texts]
+
+
+async def count_tokens_each(model: str, texts: List[str]) -> List[int]:
+    """
+    Count the tokens in each of `texts` with the model's encoding.
+
+    Loading the encoding and encoding the texts run in one worker thread hop, so
+    neither a long text nor a first load of the BPE data stalls the event loop.
+    Falls back to `estimate_tokens` when the tokenizer is unavailable.
+
+    Args:
+        model (str): The model name, e.g. "gpt-4".
+        texts (List[str]): The texts to count.
+
+    Returns:
+        List[int]: The number of tokens in each text.
+    """
+    try:
+        return await asyncio.to_thread(_encoded_lengths, model, texts)
+    except Exception as e:
+        logger.warning(f"Falling back to a rough token count: {e}")
+        return [estimate_tokens(text) for text in texts]
+
+
+async def count_tokens(model: str, text: str) -> int:
+    """
+    Count the tokens in `text` off the event loop, like `count_tokens_each`.
+
+    Args:
+        model (str): The model name, e.g. "gpt-4".
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    (count,) = await count_tokens_each(model, [text])
+    return count
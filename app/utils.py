@@ -1,6 +1,10 @@
 import asyncio
 import logging
+import random
 import time
+from typing import Optional
+
+from app import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +17,173 @@ class MalformedResponseError(Exception):
     pass
 
 
+class ContinuationTrimmer:
+    """
+    Trims text a resumed stream repeats from the output that was already emitted.
+
+    The start of the resumed stream is buffered until it is clear whether it
+    overlaps the emitted text, then only the new tail is released. Overlaps
+    shorter than `min_overlap` are kept, since a shared newline or space is
+    more likely a coincidence than repeated text.
+    """
+
+    def __init__(self, emitted: str, overlap_window: int = 64, min_overlap: int = 4):
+        """
+        Initialize the ContinuationTrimmer.
+
+        Args:
+            emitted (str): Text already sent to the client.
+            overlap_window (int, optional): Characters to buffer before deciding on
+                the overlap. Defaults to 64.
+            min_overlap (int, optional): Shortest overlap that is trimmed. Defaults to 4.
+        """
+        self.emitted = emitted
+        self.overlap_window = overlap_window
+        self.min_overlap = min_overlap
+        self._buffer = ""
+        self._decided = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Add a chunk from the resumed stream.
+
+        Returns:
+            str: Text that is safe to emit, possibly empty.
+        """
+        if self._decided:
+            return chunk
+        self._buffer += chunk
+        return self._decide(final=False)
+
+    def flush(self) -> str:
+        """
+        Release whatever is still buffered when the resumed stream ends.
+
+        Returns:
+            str: The remaining new text, possibly empty.
+        """
+        if self._decided:
+            return ""
+        return self._decide(final=True)
+
+    def _decide(self, final: bool) -> str:
+        buffer, emitted = self._buffer, self.emitted
+        if buffer.startswith(emitted):
+            # The model replayed the whole answer, drop the replayed part
+            tail = buffer.replace(emitted, "", 1)
+        elif emitted.startswith(buffer) and not final:
+            # Possibly a full replay in progress, keep buffering
+            return ""
+        elif len(buffer) >= self.overlap_window or final:
+            overlap = 0
+            for k in range(min(len(buffer), len(emitted)), self.min_overlap - 1, -1):
+                if emitted.endswith(buffer[:k]):
+                    overlap = k
+                    break
+            tail = buffer[overlap:]
+        else:
+            return ""
+        self._decided = True
+        self._buffer = ""
+        return tail
+
+
+class StreamDeadline:
+    """
+    A single resettable deadline enforcing idle and total timeouts for a stream.
+
+    Instead of a task and timer per chunk, one timer handle is kept per stream.
+    Starting a wait only moves the deadline forward. When the timer fires early
+    it re-arms itself at the current deadline, and only cancels the waiting task
+    once the deadline has really passed. Time spent by the consumer between
+    chunks is not counted against the idle timeout.
+    """
+
+    def __init__(self, idle_timeout: Optional[float], total_deadline: float):
+        """
+        Initialize the StreamDeadline.
+
+        Args:
+            idle_timeout (float): Maximum seconds to wait for one item, only bounded
+                by the total deadline when None.
+            total_deadline (float): Absolute loop time by which the stream must finish.
+        """
+        self.idle_timeout = idle_timeout
+        self.total_deadline = total_deadline
+        self.expired = False
+        self._loop = asyncio.get_running_loop()
+        self._task = None
+        self._deadline = None
+        self._handle = None
+
+    def start(self) -> None:
+        """Begin waiting for the next item."""
+        self._task = asyncio.current_task()
+        self._deadline = self.total_deadline
+        if self.idle_timeout is not None:
+            self._deadline = min(self._loop.time() + self.idle_timeout, self._deadline)
+        if self._handle is None:
+            self._handle = self._loop.call_at(self._deadline, self._on_timer)
+
+    def stop(self) -> None:
+        """Stop waiting, the item arrived."""
+        self._deadline = None
+
+    def close(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _on_timer(self) -> None:
+        self._handle = None
+        if self._deadline is None:
+            return  # Not waiting, re-armed by the next start()
+        if self._loop.time() < self._deadline:
+            self._handle = self._loop.call_at(self._deadline, self._on_timer)
+            return
+        self.expired = True
+        self._task.cancel()
+
+    def timed_out(self) -> bool:
+        """
+        Check whether a CancelledError came from this deadline and, if so, clear
+        the cancellation request so the task can carry on.
+        """
+        if not self.expired:
+            return False
+        self.expired = False
+        uncancel = getattr(self._task, "uncancel", None)  # Python 3.11+
+        if uncancel is not None:
+            uncancel()
+        return True
+
+
+async def cancel_and_wait(*tasks: asyncio.Future) -> None:
+    """
+    Cancel tasks and wait until they have all finished.
+
+    Keeps waiting even if the caller is cancelled meanwhile, so cleanup in the
+    tasks (such as closing an upstream response) has run when this returns. The
+    caller's cancellation is raised afterwards.
+    """
+    for task in tasks:
+        task.cancel()
+    cancelled = False
+    while True:
+        pending = [task for task in tasks if not task.done()]
+        if not pending:
+            break
+        try:
+            await asyncio.wait(pending)
+        except asyncio.CancelledError:
+            cancelled = True
+    for task in tasks:
+        if not task.cancelled():
+            task.exception()  # Mark a failure as retrieved
+    if cancelled:
+        raise asyncio.CancelledError()
+
+
 async def async_call_with_retry_generator(
     func,
     *args,
@@ -22,6 +193,9 @@ async def async_call_with_retry_generator(
     exceptions=(Exception,),
     operation_timeout=60.0,
     total_timeout=120.0,
+    resume=False,
+    overlap_window=64,
+    jitter=0.0,
     **kwargs,
 ):
     """
@@ -34,8 +208,15 @@ async def async_call_with_retry_generator(
         delay (float, optional): Initial delay between retries in seconds. Defaults to 1.
         backoff (int, optional): Backoff multiplier. Defaults to 2.
         exceptions (tuple, optional): Exceptions to catch and retry on. Defaults to (Exception,).
-        operation_timeout (float, optional): Timeout per attempt. Defaults to 60.0.
+        operation_timeout (float, optional): Timeout per attempt, none when None. Defaults to 60.0.
         total_timeout (float, optional): Total timeout across all retries. Defaults to 120.0.
+        resume (bool, optional): On retry, pass the text already yielded to the function
+            as `continuation` and trim any repeated overlap. Requires string items.
+            Defaults to False.
+        overlap_window (int, optional): Characters buffered to detect overlap when
+            resuming. Defaults to 64.
+        jitter (float, optional): Randomize each backoff by up to this fraction so
+            concurrent retries spread out. Defaults to 0.0.
         **kwargs: Keyword arguments to pass to the function.
 
     Yields:
@@ -43,36 +224,84 @@ async def async_call_with_retry_generator(
     """
     attempt = 0
     start_time = time.monotonic()
+    emitted = []  # Chunks already yielded, used to resume
+    deadline = StreamDeadline(
+        operation_timeout, asyncio.get_running_loop().time() + total_timeout
+    )
 
-    while True:
-        attempt += 1
-        try:
-            gen = func(*args, **kwargs)
-            while True:
+    try:
+        while True:
+            attempt += 1
+            gen = None
+            try:
+                trimmer = None
+                if resume and emitted:
+                    partial = "".join(emitted)
+                    trimmer = ContinuationTrimmer(partial, overlap_window)
+                    gen = func(*args, continuation=partial, **kwargs)
+                else:
+                    gen = func(*args, **kwargs)
+                while True:
+                    deadline.start()
+                    try:
+                        item = await gen.__anext__()
+                    except StopAsyncIteration:
+                        if trimmer is not None:
+                            tail = trimmer.flush()
+                            if tail:
+                                emitted.append(tail)
+                                yield tail
+                        return
+                    except asyncio.CancelledError:
+                        if deadline.timed_out():
+                            if time.monotonic() - start_time >= total_timeout:
+                                raise asyncio.TimeoutError("Total timeout exceeded.")
+                            raise asyncio.TimeoutError("Operation timeout exceeded.")
+                        raise
+                    finally:
+                        # Disarm before anything else, e.g. a retry backoff, awaits
+                        deadline.stop()
+                    if trimmer is not None:
+                        item = trimmer.feed(item)
+                        if not item:
+                            continue
+                    if resume:
+                        emitted.append(item)
+                    yield item
+            except (asyncio.CancelledError, GeneratorExit):
+                raise  # Cancellation and client disconnects are never retried
+            except exceptions as e:
                 current_time = time.monotonic()
                 elapsed_time = current_time - start_time
-                if elapsed_time >= total_timeout:
-                    raise asyncio.TimeoutError("Total timeout exceeded.")
-
-                try:
-                    item = await asyncio.wait_for(
-                        gen.__anext__(), timeout=operation_timeout
+                if elapsed_time >= total_timeout or attempt >= retries:
+                    logger.error(
+                        f"Max retries or total timeout reached. Raising exception: {e}"
                     )
-                    yield item
-                except StopAsyncIteration:
-                    return
-        except exceptions as e:
-            current_time = time.monotonic()
-            elapsed_time = current_time - start_time
-            if elapsed_time >= total_timeout or attempt >= retries:
-                logger.error(
-                    f"Max retries or total timeout reached. Raising exception: {e}"
+                    raise
+                sleep_time = delay * (backoff ** (attempt - 1))
+                if jitter:
+                    sleep_time *= random.uniform(1 - jitter, 1 + jitter)
+                # Never retry sooner than the upstream asked for
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None:
+                    sleep_time = max(sleep_time, retry_after)
+                if current_time + sleep_time >= start_time + total_timeout:
+                    logger.error(
+                        f"Retrying in {sleep_time} seconds would pass the total timeout. "
+                        f"Raising exception: {e}"
+                    )
+                    raise asyncio.TimeoutError("Total timeout exceeded.") from e
+                metrics.RETRIES.inc()
+                logger.warning(
+                    f"Attempt {attempt} failed with {e!r}. Retrying in {sleep_time} seconds..."
                 )
-                raise
-            sleep_time = delay * (backoff ** (attempt - 1))
-            logger.warning(
-                f"Attempt {attempt} failed with {e!r}. Retrying in {sleep_time} seconds..."
-            )
-            await asyncio.sleep(sleep_time)
-        else:
-            break  # Exit the retry loop if successful
+                await asyncio.sleep(sleep_time)
+            else:
+                break  # Exit the retry loop if successful
+            finally:
+                if gen is not None:
+                    # Close the attempt now rather than when it is garbage
+                    # collected, so its upstream response is released
+                    await gen.aclose()
+    finally:
+        deadline.close()
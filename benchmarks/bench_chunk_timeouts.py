@@ -0,0 +1,57 @@
+"""
+Measure the per-chunk overhead of timeout enforcement in the retry wrapper.
+
+Compares the previous approach, asyncio.wait_for around every chunk, against the
+single resettable StreamDeadline now used by async_call_with_retry_generator.
+
+    python -m benchmarks.bench_chunk_timeouts --chunks 10000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from app.utils import async_call_with_retry_generator
+
+
+async def source(chunks: int):
+    for _ in range(chunks):
+        # Yield to the loop like a network read would
+        await asyncio.sleep(0)
+        yield "tok"
+
+
+async def wait_for_per_chunk(gen, operation_timeout=60.0):
+    """The previous inner loop: one wait_for task and timer per chunk."""
+    while True:
+        try:
+            item = await asyncio.wait_for(gen.__anext__(), timeout=operation_timeout)
+        except StopAsyncIteration:
+            return
+        yield item
+
+
+async def consume(stream) -> float:
+    start = time.perf_counter()
+    async for _ in stream:
+        pass
+    return time.perf_counter() - start
+
+
+async def main(args) -> dict:
+    raw = await consume(source(args.chunks))
+    before = await consume(wait_for_per_chunk(source(args.chunks)))
+    after = await consume(async_call_with_retry_generator(source, args.chunks))
+    return {
+        "chunks": args.chunks,
+        "raw_us_per_chunk": round(raw / args.chunks * 1e6, 3),
+        "wait_for_overhead_us_per_chunk": round((before - raw) / args.chunks * 1e6, 3),
+        "deadline_overhead_us_per_chunk": round((after - raw) / args.chunks * 1e6, 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=10000)
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
@@ -0,0 +1,100 @@
+"""
+Measure the bytes saved and the CPU added per stream by streaming compression.
+
+Compresses a code answer the way StreamingCompressionMiddleware does, flushing
+after every chunk, for each installed encoding. Chunks are either per-token
+deltas, as with STREAM_FLUSH_MODE=immediate, or coalesced into larger ones.
+Smaller chunks mean more flushes, which cost both ratio and CPU.
+
+    python -m benchmarks.bench_compression --answers 20 --rounds 50
+    python -m benchmarks.bench_compression --chunk-sizes 4 64 1024 --window-bits 12 15
+"""
+
+import argparse
+import json
+import time
+from typing import Dict, List
+
+from app.compression import AVAILABLE_ENCODINGS, StreamCompressor
+
+SAMPLE = (
+    "Here is a function that sorts a list using merge sort:\n\n"
+    "```python\ndef merge_sort(items):\n    if len(items) <= 1:\n        return items\n"
+    "    middle = len(items) // 2\n    left = merge_sort(items[:middle])\n"
+    "    right = merge_sort(items[middle:])\n    merged = []\n"
+    "    while left and right:\n"
+    "        merged.append(left.pop(0) if left[0] <= right[0] else right.pop(0))\n"
+    "    return merged + left + right\n```\n\n"
+    "The list is split in half until single elements remain, then the sorted "
+    "halves are merged back together by repeatedly taking the smaller head.\n"
+)
+
+
+def make_chunks(answers: int, chunk_size: int) -> List[bytes]:
+    """Split a streamed answer into chunks of about `chunk_size` characters."""
+    text = "".join(
+        SAMPLE.replace("merge_sort", f"merge_sort_{index}") for index in range(answers)
+    )
+    return [
+        text[start : start + chunk_size].encode()  # noqa: E203
+        for start in range(0, len(text), chunk_size)
+    ]
+
+
+def compress_stream(encoding: str, chunks: List[bytes], level, window_bits: int) -> int:
+    compressor = StreamCompressor(encoding, level, window_bits)
+    size = 0
+    for chunk in chunks:
+        size += len(compressor.compress(chunk))
+    return size + len(compressor.finish())
+
+
+def measure(
+    encoding: str, chunks: List[bytes], level, window_bits: int, rounds: int
+) -> Dict:
+    raw = sum(len(chunk) for chunk in chunks)
+    compressed = compress_stream(encoding, chunks, level, window_bits)
+    start = time.process_time()
+    for _ in range(rounds):
+        compress_stream(encoding, chunks, level, window_bits)
+    cpu = (time.process_time() - start) / rounds
+    return {
+        "encoding": encoding,
+        "chunk_size": len(chunks[0]),
+        "window_bits": window_bits,
+        "raw_bytes": raw,
+        "compressed_bytes": compressed,
+        "saved_percent": round((1 - compressed / raw) * 100, 1),
+        "cpu_ms_per_stream": round(cpu * 1000, 4),
+        "cpu_us_per_kib_saved": (
+            round(cpu * 1e6 / ((raw - compressed) / 1024), 2)
+            if raw > compressed
+            else None
+        ),
+    }
+
+
+def main(args) -> Dict:
+    results = []
+    for chunk_size in args.chunk_sizes:
+        chunks = make_chunks(args.answers, chunk_size)
+        for encoding in AVAILABLE_ENCODINGS:
+            for window_bits in args.window_bits:
+                results.append(
+                    measure(encoding, chunks, args.level, window_bits, args.rounds)
+                )
+    return {"encodings": list(AVAILABLE_ENCODINGS), "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--answers", type=int, default=10, help="Sample answers per stream."
+    )
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[4, 64, 1024])
+    parser.add_argument("--window-bits", type=int, nargs="+", default=[14])
+    parser.add_argument("--level", type=int, help="Defaults to each encoding's own.")
+    parser.add_argument("--rounds", type=int, default=50)
+    print(json.dumps(main(parser.parse_args()), indent=2))
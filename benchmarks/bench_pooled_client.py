@@ -0,0 +1,62 @@
+"""
+Compare a per-request httpx client against the generator's shared pooled client.
+
+Runs entirely against a local mock upstream. Use --connect-delay to simulate the
+TCP+TLS handshake round trips a remote upstream would cost on each new connection.
+
+    python -m benchmarks.bench_pooled_client --requests 200 --connect-delay 0.03
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from app.generator import StreamingCodeGenerator
+from benchmarks.mock_upstream import MockUpstream
+
+
+async def run_requests(generator: StreamingCodeGenerator, requests: int) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        async for _ in generator.generate_code_with_explanation("benchmark prompt"):
+            pass
+    return time.perf_counter() - start
+
+
+async def main(args) -> dict:
+    results = {}
+    for mode in ("per_request", "pooled"):
+        async with MockUpstream(
+            tokens=args.tokens, connect_delay=args.connect_delay
+        ) as upstream:
+            generator = StreamingCodeGenerator(api_key="bench", api_url=upstream.url)
+            if mode == "pooled":
+                await generator.start()
+            try:
+                elapsed = await run_requests(generator, args.requests)
+            finally:
+                await generator.aclose()
+            results[mode] = {
+                "total_s": round(elapsed, 4),
+                "per_request_ms": round(elapsed / args.requests * 1000, 3),
+                "connections_opened": upstream.connections,
+            }
+    results["saved_per_request_ms"] = round(
+        results["per_request"]["per_request_ms"] - results["pooled"]["per_request_ms"],
+        3,
+    )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument(
+        "--connect-delay",
+        type=float,
+        default=0.0,
+        help="Simulated handshake cost in seconds per new connection.",
+    )
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
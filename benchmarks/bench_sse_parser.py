@@ -0,0 +1,126 @@
+"""
+Compare the legacy line-based SSE handling against SSEDecoder on recorded streams.
+
+Both paths read the same chunks through a real httpx.Response. The legacy path
+iterates response.aiter_lines() and strips, prefixes, replaces and json.loads
+each line, as generate_code_with_explanation used to. The new path feeds raw
+bytes to SSEDecoder. A real recording can be passed with --file (raw response
+body bytes), otherwise an OpenAI-shaped stream is synthesized.
+
+    python -m benchmarks.bench_sse_parser --tokens 1000 --chunk-size 512
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from app.generator import StreamingCodeGenerator
+from app.sse import JSON_BACKEND, json_loads
+
+
+def record_stream(tokens: int) -> bytes:
+    """Build a stream shaped like an OpenAI chat completions response."""
+    events = []
+    for i in range(tokens):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "gpt-4",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": f"tok{i % 10} "},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        events.append(f"data: {json.dumps(chunk)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode()
+
+
+def split_chunks(body: bytes, size: int):
+    return [body[i : i + size] for i in range(0, len(body), size)]  # noqa: E203
+
+
+class RecordedStream(httpx.AsyncByteStream):
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def make_response(chunks) -> httpx.Response:
+    return httpx.Response(200, stream=RecordedStream(chunks))
+
+
+async def legacy_parse(chunks) -> int:
+    count = 0
+    async for line in make_response(chunks).aiter_lines():
+        if line.strip() == "":
+            continue
+        if line.startswith("data:"):
+            part = line.replace("data:", "").strip()
+            if part == "[DONE]":
+                break
+            parsed = json.loads(part)
+            delta = parsed["choices"][0]["delta"]
+            if "content" in delta:
+                count += 1
+    return count
+
+
+async def decoder_parse(chunks) -> int:
+    count = 0
+    async for event in StreamingCodeGenerator._iter_events(make_response(chunks)):
+        data = event.data
+        if data[:1] == b"[" and data.strip() == b"[DONE]":
+            break
+        parsed = json_loads(data)
+        choices = parsed.get("choices")
+        if choices and choices[0].get("delta", {}).get("content"):
+            count += 1
+    return count
+
+
+async def measure(func, chunks, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await func(chunks)
+    return (time.perf_counter() - start) / rounds
+
+
+async def main(args) -> dict:
+    if args.file:
+        with open(args.file, "rb") as f:
+            body = f.read()
+    else:
+        body = record_stream(args.tokens)
+    chunks = split_chunks(body, args.chunk_size)
+    events = await decoder_parse(chunks)
+    assert await legacy_parse(chunks) == events
+    before = await measure(legacy_parse, chunks, args.rounds)
+    after = await measure(decoder_parse, chunks, args.rounds)
+    return {
+        "json_backend": JSON_BACKEND,
+        "events": events,
+        "bytes": len(body),
+        "legacy_us_per_event": round(before / events * 1e6, 3),
+        "decoder_us_per_event": round(after / events * 1e6, 3),
+        "speedup": round(before / after, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--file", help="Recorded raw SSE response body.")
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=2))
@@ -0,0 +1,76 @@
+"""
+Measure event-loop time spent on token accounting per 1k streamed tokens.
+
+Compares encoding every delta on the hot path against encoding the accumulated
+completion once at the end of the stream.
+
+    python -m benchmarks.bench_token_accounting --tokens 1000 --rounds 50
+"""
+
+import argparse
+import json
+import time
+
+import tiktoken
+
+SAMPLE = (
+    "Here is a function that sorts a list using bubble sort:\n\n"
+    "```python\ndef bubble_sort(items):\n    n = len(items)\n"
+    "    for i in range(n):\n        for j in range(0, n - i - 1):\n"
+    "            if items[j] > items[j + 1]:\n"
+    "                items[j], items[j + 1] = items[j + 1], items[j]\n"
+    "    return items\n```\n\n"
+    "The outer loop runs once per element and the inner loop bubbles the "
+    "largest remaining value to the end of the list.\n"
+)
+
+
+def make_deltas(encoding, tokens: int):
+    """Split sample text into per-token deltas like an upstream stream would."""
+    ids = []
+    while len(ids) < tokens:
+        ids.extend(encoding.encode(SAMPLE))
+    return [encoding.decode([token]) for token in ids[:tokens]]
+
+
+def per_delta(encoding, deltas) -> int:
+    total = 0
+    for delta in deltas:
+        total += len(encoding.encode(delta))
+    return total
+
+
+def once_per_stream(encoding, deltas) -> int:
+    parts = []
+    for delta in deltas:
+        parts.append(delta)
+    return len(encoding.encode("".join(parts)))
+
+
+def measure(func, encoding, deltas, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(encoding, deltas)
+    return (time.perf_counter() - start) / rounds
+
+
+def main(args) -> dict:
+    encoding = tiktoken.encoding_for_model(args.model)
+    deltas = make_deltas(encoding, args.tokens)
+    before = measure(per_delta, encoding, deltas, args.rounds)
+    after = measure(once_per_stream, encoding, deltas, args.rounds)
+    scale = 1000 / args.tokens
+    return {
+        "tokens": args.tokens,
+        "per_delta_ms_per_1k_tokens": round(before * scale * 1000, 4),
+        "once_per_stream_ms_per_1k_tokens": round(after * scale * 1000, 4),
+        "saved_ms_per_1k_tokens": round((before - after) * scale * 1000, 4),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--model", default="gpt-4")
+    print(json.dumps(main(parser.parse_args()), indent=2))
@@ -0,0 +1,250 @@
+"""
+Sweep concurrency levels against the API and report latency and resource use.
+
+Starts a mock upstream and `app.main:app` under uvicorn as local subprocesses,
+then drives `/generate-code/` with the streaming call from `api_client.py`.
+For each concurrency level it reports throughput, time-to-first-token and
+inter-chunk latency percentiles, and the server's CPU time and memory per
+stream. Every prompt is unique, so the response cache and request coalescing
+do not hide upstream work. Runs entirely offline.
+
+    python -m benchmarks.load_test --concurrency 1 8 32 --requests 64
+    python -m benchmarks.load_test --rate-limit-rate 0.05 --malformed-rate 0.01 --output run.json
+
+CPU and memory are read from /proc and are reported as null on other platforms.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from api_client import APIError, stream_generate_code
+from benchmarks.mock_upstream import add_arguments
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Return p50, p90 and p99 in milliseconds."""
+    if not values:
+        return {"p50": None, "p90": None, "p99": None}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    return {
+        name: round(ordered[min(last, int(q * len(ordered)))] * 1000, 3)
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+    }
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """User plus system CPU time of a process."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except OSError:
+        return None
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident memory of a process."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Server at {url} did not start.")
+                await asyncio.sleep(0.1)
+
+
+def start_upstream(args) -> Tuple[subprocess.Popen, str]:
+    command = [sys.executable, "-m", "benchmarks.mock_upstream"]
+    for name in (
+        "tokens",
+        "token_rate",
+        "first_token_delay",
+        "events_per_chunk",
+        "rate_limit_rate",
+        "server_error_rate",
+        "malformed_rate",
+        "seed",
+    ):
+        command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = json.loads(process.stdout.readline())["url"]
+    return process, url
+
+
+def start_app(args, upstream_url: str, port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "API_KEY": "bench",
+        "UPSTREAM_TARGETS": json.dumps([{"api_key": "bench", "api_url": upstream_url}]),
+        "TOKENIZER_PREWARM": "false",
+        "STREAM_FLUSH_MODE": args.flush,
+        "ADMISSION_MAX_CONCURRENT": str(args.max_concurrent),
+    }
+    command = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "app.main:app",
+        "--port",
+        str(port),
+        "--log-level",
+        "warning",
+    ]
+    return subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+
+
+async def one_request(client: httpx.AsyncClient, base_url: str, prompt: str) -> Dict:
+    """Stream one response, recording when each chunk arrived."""
+    started = time.perf_counter()
+    arrivals = []
+    try:
+        async for _ in stream_generate_code(client, prompt, base_url=base_url):
+            arrivals.append(time.perf_counter())
+        error = None
+    except APIError as e:
+        error = str(e.status_code)
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    return {"started": started, "arrivals": arrivals, "error": error}
+
+
+async def run_level(
+    args, base_url: str, pid: int, concurrency: int, run: int, requests: int
+) -> Dict:
+    prompts = iter(
+        f"Load test run {run} request {index}: write a sorting function."
+        for index in range(requests)
+    )
+    results = []
+    peak_rss = rss_bytes(pid)
+    baseline_rss = peak_rss
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        for prompt in prompts:
+            results.append(await one_request(client, base_url, prompt))
+
+    async def sample_memory() -> None:
+        nonlocal peak_rss
+        while True:
+            await asyncio.sleep(0.05)
+            rss = rss_bytes(pid)
+            if rss is not None:
+                peak_rss = max(peak_rss, rss)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        cpu_before = cpu_seconds(pid)
+        sampler = asyncio.create_task(sample_memory())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        cpu_after = cpu_seconds(pid)
+
+    succeeded = [result for result in results if result["error"] is None]
+    ttfts = [r["arrivals"][0] - r["started"] for r in succeeded if r["arrivals"]]
+    gaps = [
+        later - earlier
+        for r in succeeded
+        for earlier, later in zip(r["arrivals"], r["arrivals"][1:])
+    ]
+    errors: Dict[str, int] = {}
+    for result in results:
+        if result["error"] is not None:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "succeeded": len(succeeded),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_second": round(len(succeeded) / elapsed, 3),
+        "tokens_per_second": round(len(succeeded) * args.tokens / elapsed, 1),
+        "ttft_ms": percentiles(ttfts),
+        "inter_chunk_ms": percentiles(gaps),
+        "cpu_ms_per_stream": (
+            round((cpu_after - cpu_before) / len(results) * 1000, 3)
+            if cpu_before is not None and results
+            else None
+        ),
+        "rss_bytes_per_stream": (
+            (peak_rss - baseline_rss) // concurrency if peak_rss is not None else None
+        ),
+        "rss_peak_bytes": peak_rss,
+    }
+
+
+async def main(args) -> Dict:
+    upstream, upstream_url = start_upstream(args)
+    port = free_port()
+    app = start_app(args, upstream_url, port)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_for_server(f"{base_url}/")
+        # Warm up imports and connection pools before measuring
+        await run_level(args, base_url, app.pid, 1, run=-1, requests=4)
+        levels = [
+            await run_level(args, base_url, app.pid, concurrency, run, args.requests)
+            for run, concurrency in enumerate(args.concurrency)
+        ]
+    finally:
+        for process in (app, upstream):
+            process.terminate()
+            process.wait()
+    config = {key: value for key, value in vars(args).items() if key not in ("output",)}
+    return {"config": config, "levels": levels}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument(
+        "--requests", type=int, default=64, help="Requests per concurrency level."
+    )
+    parser.add_argument(
+        "--flush", choices=("immediate", "coalesce"), default="coalesce"
+    )
+    parser.add_argument("--max-concurrent", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", help="Also write the JSON report to this file.")
+    add_arguments(parser)
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    print(report)
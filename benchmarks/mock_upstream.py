@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MockUpstream:
+    """
+    A minimal OpenAI-compatible chat completions server that streams SSE events.
+    Speaks HTTP/1.1 with keep-alive so connection reuse can be measured.
+
+    Faults can be injected at fixed rates from a seeded generator, so runs are
+    reproducible: 429 and 5xx responses, and events carrying malformed JSON.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        tokens: int = 20,
+        token_text: str = "tok ",
+        token_delay: float = 0.0,
+        first_token_delay: float = 0.0,
+        connect_delay: float = 0.0,
+        events_per_chunk: int = 1,
+        rate_limit_rate: float = 0.0,
+        server_error_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        retry_after: float = 0.1,
+        seed: int = 0,
+    ):
+        """
+        Initialize the MockUpstream.
+
+        Args:
+            host (str, optional): Interface to bind. Defaults to "127.0.0.1".
+            port (int, optional): Port to bind, 0 picks a free one. Defaults to 0.
+            tokens (int, optional): Number of content events per response. Defaults to 20.
+            token_text (str, optional): Content of each event. Defaults to "tok ".
+            token_delay (float, optional): Delay between events in seconds. Defaults to 0.0.
+            first_token_delay (float, optional): Delay before the first event in seconds. Defaults to 0.0.
+            connect_delay (float, optional): Delay on every new connection, used to
+                simulate TCP+TLS handshake round trips. Defaults to 0.0.
+            events_per_chunk (int, optional): Events written per HTTP chunk. Defaults to 1.
+            rate_limit_rate (float, optional): Fraction of requests answered 429. Defaults to 0.0.
+            server_error_rate (float, optional): Fraction of requests answered 503. Defaults to 0.0.
+            malformed_rate (float, optional): Fraction of content events sent as broken JSON. Defaults to 0.0.
+            retry_after (float, optional): Retry-After sent with 429 responses. Defaults to 0.1.
+            seed (int, optional): Seed for fault injection. Defaults to 0.
+        """
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_text = token_text
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.connect_delay = connect_delay
+        self.events_per_chunk = max(1, events_per_chunk)
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.malformed_rate = malformed_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.statuses = {}
+        self.connections = 0
+        self.open_connections = 0
+        self.requests = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1/chat/completions"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    @staticmethod
+    def _chunk(payload: bytes) -> bytes:
+        return b"%x\r\n%s\r\n" % (len(payload), payload)
+
+    def _event(self, data: str) -> bytes:
+        return self._chunk(f"data: {data}\n\n".encode())
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self.open_connections += 1
+        try:
+            if self.connect_delay:
+                await asyncio.sleep(self.connect_delay)
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                content_length = 0
+                for line in head.split(b"\r\n")[1:]:
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        content_length = int(value.strip())
+                body = b""
+                if content_length:
+                    body = await reader.readexactly(content_length)
+                self.requests += 1
+                await self._respond(writer, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.open_connections -= 1
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, body: bytes = b"") -> None:
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            await self._error(writer, 429, "Too Many Requests")
+            return
+        if roll < self.rate_limit_rate + self.server_error_rate:
+            await self._error(writer, 503, "Service Unavailable")
+            return
+        self.statuses[200] = self.statuses.get(200, 0) + 1
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+        if self.first_token_delay:
+            await writer.drain()
+            await asyncio.sleep(self.first_token_delay)
+        content = json.dumps({"choices": [{"delta": {"content": self.token_text}}]})
+        events = []
+        for index in range(self.tokens):
+            if self.malformed_rate and self.random.random() < self.malformed_rate:
+                events.append(b'data: {"choices": [\n\n')
+            else:
+                events.append(f"data: {content}\n\n".encode())
+            if len(events) >= self.events_per_chunk or index == self.tokens - 1:
+                writer.write(self._chunk(b"".join(events)))
+                events = []
+                if self.token_delay:
+                    await writer.drain()
+                    await asyncio.sleep(self.token_delay * self.events_per_chunk)
+        if b'"include_usage": true' in body:
+            usage = {"prompt_tokens": len(body) // 4, "completion_tokens": self.tokens}
+            writer.write(self._event(json.dumps({"choices": [], "usage": usage})))
+        writer.write(self._event("[DONE]"))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _error(
+        self, writer: asyncio.StreamWriter, status: int, reason: str
+    ) -> None:
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        body = json.dumps({"error": {"message": reason}}).encode()
+        retry_after = f"Retry-After: {self.retry_after}\r\n" if status == 429 else ""
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{retry_after}"
+            f"Connection: keep-alive\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+
+async def serve(args) -> None:
+    upstream = MockUpstream(
+        host=args.host,
+        port=args.port,
+        tokens=args.tokens,
+        token_delay=1 / args.token_rate if args.token_rate else 0.0,
+        first_token_delay=args.first_token_delay,
+        events_per_chunk=args.events_per_chunk,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        malformed_rate=args.malformed_rate,
+        seed=args.seed,
+    )
+    async with upstream:
+        print(json.dumps({"url": upstream.url}), flush=True)
+        await asyncio.Event().wait()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the mock upstream's options to a command line parser."""
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument(
+        "--token-rate",
+        type=float,
+        default=100.0,
+        help="Tokens per second, 0 for no delay.",
+    )
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--events-per-chunk", type=int, default=1)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a mock OpenAI-compatible streaming upstream."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from app.admission import AdmissionController, QueueFullError, QueueTimeoutError
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_admitted_in_order_as_slots_free():
+    controller = AdmissionController(max_concurrent=1, max_queue=2)
+    first = await controller.acquire()
+    order = []
+
+    async def wait(name):
+        slot = await controller.acquire()
+        order.append(name)
+        slot.release()
+
+    waiters = [asyncio.create_task(wait("a")), asyncio.create_task(wait("b"))]
+    await asyncio.sleep(0)
+    assert controller.stats()["queued"] == 2
+
+    first.release()
+    first.release()  # Releasing twice is a no-op
+    await asyncio.gather(*waiters)
+
+    assert order == ["a", "b"]
+    assert controller.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_and_queue_deadline_are_rejected():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.01)
+    slot = await controller.acquire()
+    queued = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+
+    with pytest.raises(QueueFullError) as exc_info:
+        await controller.acquire()
+    assert exc_info.value.retry_after >= 1
+
+    with pytest.raises(QueueTimeoutError):
+        await queued
+
+    slot.release()
+    stats = controller.stats()
+    assert (stats["rejected"], stats["timed_out"], stats["in_flight"]) == (1, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_small_prompts_are_not_starved_by_a_heavy_tenant():
+    controller = AdmissionController(max_concurrent=1, max_queue=100, quantum=1000)
+    slot = await controller.acquire()
+    admitted = []
+
+    async def request(client, cost):
+        held = await controller.acquire(client=client, cost=cost)
+        admitted.append(client)
+        await asyncio.sleep(0)  # Simulated service time
+        held.release()
+
+    # The heavy tenant saturates the queue before the light one arrives
+    tasks = [asyncio.create_task(request("heavy", 8000)) for _ in range(20)]
+    await asyncio.sleep(0)
+    tasks += [asyncio.create_task(request("light", 100)) for _ in range(5)]
+    await asyncio.sleep(0)
+
+    slot.release()
+    await asyncio.gather(*tasks)
+
+    # Every light request is admitted after at most one more heavy request,
+    # instead of waiting behind all twenty as it would in a FIFO queue
+    positions = [i for i, client in enumerate(admitted) if client == "light"]
+    assert positions[-1] <= 5
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_is_admitted_first():
+    controller = AdmissionController(max_concurrent=1, max_queue=10)
+    slot = await controller.acquire()
+    admitted = []
+
+    async def request(name, priority):
+        held = await controller.acquire(client=name, priority=priority)
+        admitted.append(name)
+        held.release()
+
+    tasks = [
+        asyncio.create_task(request("low", 0)),
+        asyncio.create_task(request("high", 5)),
+    ]
+    await asyncio.sleep(0)
+    slot.release()
+    await asyncio.gather(*tasks)
+
+    assert admitted == ["high", "low"]
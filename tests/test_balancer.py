@@ -0,0 +1,151 @@
+import pytest
+
+from app.balancer import UpstreamBalancer, UpstreamTarget, parse_duration
+from app.generator import RateLimitError, StreamingCodeGenerator
+
+
+def make_targets(count):
+    return [
+        UpstreamTarget(api_key=f"key-{i}", api_url=f"http://upstream-{i}/v1")
+        for i in range(count)
+    ]
+
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("6m0s") == 360.0
+    assert parse_duration("1.5") == 1.5
+    assert parse_duration("soon") is None
+
+
+def test_least_outstanding_spreads_requests():
+    balancer = UpstreamBalancer(make_targets(2))
+
+    first = balancer.acquire()
+    second = balancer.acquire()
+    assert first is not second
+
+    balancer.release(first)
+    assert balancer.acquire() is first
+
+
+def test_headroom_prefers_target_with_most_remaining_budget(clock):
+    low, high = make_targets(2)
+    balancer = UpstreamBalancer([low, high], strategy="headroom", clock=clock)
+    balancer.record_headers(
+        low,
+        {
+            "x-ratelimit-limit-requests": "100",
+            "x-ratelimit-remaining-requests": "5",
+            "x-ratelimit-reset-requests": "30s",
+        },
+    )
+
+    assert balancer.acquire() is high
+    balancer.release(high)
+
+    clock.now = 31.0  # The low target's window has reset
+    assert balancer.stats()["targets"][low.name]["headroom"] == 1.0
+
+
+def test_retry_after_opens_circuit_until_it_passes(clock):
+    balancer = UpstreamBalancer(make_targets(1), clock=clock)
+    target = balancer.acquire()
+    balancer.release(target)
+
+    balancer.record_failure(target, retry_after=10.0)
+    assert balancer.acquire() is None
+    assert balancer.next_available_in() == 10.0
+
+    clock.now = 10.0
+    assert balancer.acquire() is target
+
+
+def test_repeated_failures_back_off_until_success(clock):
+    balancer = UpstreamBalancer(
+        make_targets(1), failure_threshold=2, cooldown=5.0, clock=clock
+    )
+    target = balancer.targets[0]
+
+    balancer.record_failure(target)
+    assert balancer.available()
+    balancer.record_failure(target)
+    assert balancer.next_available_in() == 5.0
+
+    clock.now = 5.0
+    balancer.record_failure(target)  # Failed again while half-open
+    assert balancer.next_available_in() == 10.0
+
+    balancer.record_success(target)
+    assert balancer.available()
+    assert target.failures == 0
+
+
+def mock_upstreams(statuses):
+    """Answer each upstream URL with its status, streaming one chunk on 200."""
+    calls = []
+
+    def mock_stream(method, url, json=None, headers=None, **kwargs):
+        calls.append(url)
+
+        class MockResponse:
+            status_code = statuses[url]
+            headers = {"Retry-After": "30"}
+            text = "error"
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, exc_type, exc_val, exc_tb):
+                pass
+
+            async def aread(self):
+                return b"error"
+
+            async def aiter_bytes(self):
+                yield b'data: {"choices": [{"delta": {"content": "ok"}}]}\n\n'
+                yield b"data: [DONE]\n\n"
+
+        return MockResponse()
+
+    return mock_stream, calls
+
+
+@pytest.mark.asyncio
+async def test_generator_fails_over_without_raising(mocker):
+    targets = make_targets(2)
+    generator = StreamingCodeGenerator(api_key="unused", targets=targets)
+    mock_stream, calls = mock_upstreams(
+        {"http://upstream-0/v1": 429, "http://upstream-1/v1": 200}
+    )
+    mocker.patch("httpx.AsyncClient.stream", side_effect=mock_stream)
+
+    chunks = [chunk async for chunk in generator.generate_code_with_explanation("Test")]
+
+    assert chunks == ["ok"]
+    assert calls == ["http://upstream-0/v1", "http://upstream-1/v1"]
+    assert generator.balancer.failovers == 1
+    assert all(target.outstanding == 0 for target in targets)
+    # The healthy key keeps working while the limited one cools down
+    assert generator.rate_limiter.paused_until == 0.0
+
+
+@pytest.mark.asyncio
+async def test_generator_raises_when_every_target_fails(mocker):
+    targets = make_targets(2)
+    generator = StreamingCodeGenerator(api_key="unused", targets=targets)
+    mock_stream, calls = mock_upstreams(
+        {"http://upstream-0/v1": 429, "http://upstream-1/v1": 429}
+    )
+    mocker.patch("httpx.AsyncClient.stream", side_effect=mock_stream)
+
+    with pytest.raises(RateLimitError):
+        async for _ in generator.generate_code_with_explanation("Test"):
+            pass
+    assert len(calls) == 2
+
+    with pytest.raises(RateLimitError) as exc_info:
+        async for _ in generator.generate_code_with_explanation("Test"):
+            pass
+    assert len(calls) == 2  # Both are cooling down, nothing is sent
+    assert exc_info.value.retry_after == pytest.approx(30.0, abs=1.0)
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from app.batch import run_batch
+
+
+@pytest.mark.asyncio
+async def test_records_are_interleaved_and_completed():
+    async def stream(prompt, usage):
+        for part in prompt.split():
+            await asyncio.sleep(0)
+            yield part
+        usage.add(1, len(prompt.split()), False)
+
+    records = [record async for record in run_batch(["a b", "c d e"], stream)]
+
+    chunks = {0: [], 1: []}
+    for record in records:
+        if "chunk" in record:
+            chunks[record["id"]].append(record["chunk"])
+    assert chunks == {0: ["a", "b"], 1: ["c", "d", "e"]}
+    assert records[0]["id"] != records[1]["id"]  # Both prompts ran at once
+    done = {record["id"]: record for record in records if record.get("done")}
+    assert done[1]["usage"] == {
+        "prompt_tokens": 1,
+        "completion_tokens": 3,
+        "total_tokens": 4,
+    }
+    assert "error" not in done[0]
+
+
+@pytest.mark.asyncio
+async def test_failed_item_does_not_abort_batch():
+    async def stream(prompt, usage):
+        if prompt == "bad":
+            raise ValueError("upstream failed")
+        yield prompt
+
+    records = [record async for record in run_batch(["ok", "bad", "fine"], stream)]
+
+    done = {record["id"]: record for record in records if record.get("done")}
+    assert done[1]["error"] == "upstream failed"
+    assert "error" not in done[0] and "error" not in done[2]
+    assert {"id": 2, "chunk": "fine"} in records
+
+
+@pytest.mark.asyncio
+async def test_parallelism_is_capped():
+    running = 0
+    peak = 0
+
+    async def stream(prompt, usage):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        yield prompt
+
+    records = [
+        record async for record in run_batch([str(i) for i in range(10)], stream, 3)
+    ]
+
+    assert peak == 3
+    assert sum(1 for record in records if record.get("done")) == 10
+
+
+@pytest.mark.asyncio
+async def test_closing_the_batch_cancels_workers():
+    cancelled = []
+
+    async def stream(prompt, usage):
+        try:
+            yield prompt
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(prompt)
+            raise
+
+    batch = run_batch(["a", "b"], stream)
+    await batch.__anext__()
+    await batch.aclose()
+
+    assert sorted(cancelled) == ["a", "b"]
@@ -0,0 +1,76 @@
+import pytest
+
+from app.cache import ResponseCache, cached_stream
+
+
+def test_make_key_normalizes_prompt_whitespace():
+    key = ResponseCache.make_key("gpt-4", "system", 0.7, "  sort\r\na list\n")
+    assert key == ResponseCache.make_key("gpt-4", "system", 0.7, "sort\na list")
+    assert key != ResponseCache.make_key("gpt-4", "system", 0.2, "sort\na list")
+
+
+def test_make_key_keeps_indentation():
+    nested = "fix this Python:\nif a:\n    if b:\n        run()"
+    flat = "fix this Python:\nif a:\n    if b:\n    run()"
+    assert ResponseCache.make_key(
+        "gpt-4", "system", 0.7, nested
+    ) != ResponseCache.make_key("gpt-4", "system", 0.7, flat)
+
+
+def test_lru_and_ttl_eviction(clock):
+    cache = ResponseCache(max_entries=2, ttl=10.0, clock=clock)
+    cache.set("a", ["1"], [0.0])
+    cache.set("b", ["2"], [0.0])
+    assert cache.get("a") is not None  # "b" is now least recently used
+    cache.set("c", ["3"], [0.0])
+
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+    clock.now = 11.0
+    assert cache.get("a") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_stream_stores_only_completed_streams():
+    cache = ResponseCache()
+    calls = 0
+
+    async def failing_source():
+        yield "partial"
+        raise ConnectionError("dropped")
+
+    async def source():
+        nonlocal calls
+        calls += 1
+        yield "hello "
+        yield "world"
+
+    with pytest.raises(ConnectionError):
+        async for _ in cached_stream(cache, "k", failing_source):
+            pass
+    assert cache.stats()["entries"] == 0
+
+    first = [chunk async for chunk in cached_stream(cache, "k", source)]
+    second = [chunk async for chunk in cached_stream(cache, "k", source)]
+
+    assert first == second == ["hello ", "world"]
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_stream_skips_streams_rejected_by_should_store():
+    cache = ResponseCache()
+
+    async def source():
+        yield "truncated"
+
+    chunks = [
+        chunk
+        async for chunk in cached_stream(cache, "k", source, should_store=lambda: False)
+    ]
+
+    assert chunks == ["truncated"]
+    assert cache.get("k") is None
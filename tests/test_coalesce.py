@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from app.coalesce import coalesce
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+@pytest.mark.asyncio
+async def test_flushes_at_size_and_line_boundaries():
+    async def source():
+        for chunk in ["de", "f f", "oo():\n", "    re", "turn 1", "23"]:
+            await asyncio.sleep(0)  # Arrive one at a time like network reads
+            yield chunk
+
+    chunks = await collect(coalesce(source(), max_bytes=8, max_latency=10.0))
+
+    assert chunks == ["def foo():\n", "    return 1", "23"]
+
+
+@pytest.mark.asyncio
+async def test_flushes_after_max_latency_when_upstream_stalls():
+    flushed = asyncio.Event()
+
+    async def source():
+        yield "partial"
+        await asyncio.wait_for(flushed.wait(), timeout=1.0)
+        yield " rest"
+
+    stream = coalesce(source(), max_bytes=1024, max_latency=0.01)
+    assert await stream.__anext__() == "partial"
+    flushed.set()
+    assert await collect(stream) == [" rest"]
+
+
+@pytest.mark.asyncio
+async def test_source_errors_are_raised_after_flushing():
+    async def source():
+        yield "data"
+        raise ConnectionError("dropped")
+
+    stream = coalesce(source(), max_latency=10.0)
+    assert await stream.__anext__() == "data"
+    with pytest.raises(ConnectionError):
+        await stream.__anext__()
@@ -0,0 +1,107 @@
+import asyncio
+import zlib
+
+import pytest
+from starlette.responses import Response, StreamingResponse
+
+from app.compression import StreamingCompressionMiddleware, negotiate
+
+
+def test_negotiate_follows_weights_then_server_preference():
+    available = ("zstd", "br", "gzip")
+
+    assert negotiate("gzip, br", available) == "br"
+    assert negotiate("gzip;q=1.0, br;q=0.5", available) == "gzip"
+    assert negotiate("*;q=0.1, gzip;q=0", available) == "zstd"
+    assert negotiate("br", ("gzip",)) is None
+    assert negotiate("identity", available) is None
+    assert negotiate("", available) is None
+
+
+async def call(app, accept_encoding="gzip"):
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [(b"accept-encoding", accept_encoding.encode())],
+    }
+    messages = []
+
+    async def receive():
+        await asyncio.Event().wait()  # The client never disconnects
+
+    async def send(message):
+        messages.append(message)
+
+    await StreamingCompressionMiddleware(app, min_size=64)(scope, receive, send)
+    return messages[0], messages[1:]
+
+
+@pytest.mark.asyncio
+async def test_each_streamed_chunk_is_flushed_compressed():
+    chunks = ["def add(a, b):\n", "    return a + b\n" * 8, "\n"]
+
+    async def body():
+        for chunk in chunks:
+            yield chunk
+
+    start, bodies = await call(StreamingResponse(body(), media_type="text/plain"))
+
+    headers = dict(start["headers"])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert b"content-length" not in headers
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # Every message decodes to its chunk on arrival, without waiting for the rest
+    decoded = [decoder.decompress(message["body"]).decode() for message in bodies]
+    assert decoded[: len(chunks)] == chunks
+    assert decoder.eof
+    assert sum(len(message["body"]) for message in bodies) < len("".join(chunks))
+
+
+@pytest.mark.asyncio
+async def test_tiny_and_binary_responses_are_not_compressed():
+    start, bodies = await call(Response("small", media_type="text/plain"))
+    assert b"content-encoding" not in dict(start["headers"])
+    assert bodies[0]["body"] == b"small"
+
+    start, bodies = await call(Response(b"\0" * 1024, media_type="image/png"))
+    assert b"content-encoding" not in dict(start["headers"])
+
+
+@pytest.mark.asyncio
+async def test_streamed_response_start_is_not_held_back():
+    started = asyncio.Event()
+    messages = []
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [(b"accept-encoding", b"gzip")],
+    }
+
+    async def body():
+        # The headers are out before the first chunk exists
+        await asyncio.wait_for(started.wait(), 1.0)
+        yield "hi"
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.start":
+            started.set()
+
+    app = StreamingResponse(
+        body(), media_type="text/event-stream", headers={"X-Stream-ID": "abc"}
+    )
+    await StreamingCompressionMiddleware(app, min_size=64)(scope, receive, send)
+
+    headers = dict(messages[0]["headers"])
+    assert headers[b"x-stream-id"] == b"abc"
+    # A streamed body has no known size, so even a tiny one is compressed
+    assert headers[b"content-encoding"] == b"gzip"
+    decoded = zlib.decompress(
+        b"".join(message["body"] for message in messages[1:]), 16 + zlib.MAX_WBITS
+    )
+    assert decoded == b"hi"
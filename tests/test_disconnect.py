@@ -0,0 +1,149 @@
+import asyncio
+import json
+import time
+
+import pytest
+import pytest_asyncio
+
+from app.disconnect import DisconnectAwareResponse
+from app.generator import StreamingCodeGenerator
+from app.main import app
+from benchmarks.mock_upstream import MockUpstream
+
+
+async def call_and_disconnect(app, path, payload):
+    """Call an ASGI app and disconnect once the first body chunk arrives."""
+    body = json.dumps(payload).encode()
+    first_chunk = asyncio.Event()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            first_chunk.set()
+
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), timeout=5.0)
+
+
+async def wait_until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+@pytest_asyncio.fixture
+async def upstream(mocker):
+    mocker.patch("app.tokenizer.get_encoding")
+    async with MockUpstream(tokens=1000, token_delay=0.01) as mock:
+        generator = StreamingCodeGenerator(api_key="test-api-key", api_url=mock.url)
+        await generator.start()
+        mocker.patch("app.routes.generator", generator)
+        yield mock
+        await generator.aclose()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("flush", ["immediate", "coalesce"])
+async def test_upstream_is_closed_when_client_disconnects(upstream, mocker, flush):
+    stats = mocker.patch("app.routes.disconnect_stats")
+
+    await call_and_disconnect(
+        app, f"/generate-code/?flush={flush}", {"prompt": f"Disconnect {flush}"}
+    )
+
+    assert await wait_until(lambda: upstream.open_connections == 0, timeout=1.0)
+    assert upstream.requests == 1  # The disconnect was not retried
+    stats.record.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_batch_upstreams_are_closed_when_client_disconnects(upstream):
+    await call_and_disconnect(
+        app, "/generate-code/batch", {"prompts": ["Batch one", "Batch two"]}
+    )
+
+    assert await wait_until(lambda: upstream.open_connections == 0, timeout=1.0)
+    assert upstream.requests == 2
+
+
+@pytest.mark.asyncio
+async def test_response_closes_body_suspended_at_yield():
+    closed = asyncio.Event()
+
+    async def body():
+        try:
+            yield "first"
+            await asyncio.sleep(10)
+        finally:
+            closed.set()
+
+    response = DisconnectAwareResponse(body(), media_type="text/plain")
+
+    async def receive():
+        await asyncio.sleep(0.05)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message.get("body"):
+            await asyncio.sleep(10)  # A client that stopped reading
+
+    await asyncio.wait_for(response({"type": "http"}, receive, send), timeout=1.0)
+
+    assert closed.is_set()
+    assert response.disconnected
+
+
+@pytest.mark.asyncio
+async def test_server_timing_trailer_when_supported():
+    async def body():
+        yield "code"
+
+    response = DisconnectAwareResponse(
+        body(), media_type="text/plain", server_timing=lambda: "total;dur=1.0"
+    )
+    messages = []
+
+    async def receive():
+        await asyncio.sleep(10)
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "extensions": {"http.response.trailers": {}}}
+    await response(scope, receive, send)
+
+    assert messages[0]["trailers"] is True
+    assert (b"trailer", b"server-timing") in messages[0]["headers"]
+    assert messages[-1] == {
+        "type": "http.response.trailers",
+        "headers": [(b"server-timing", b"total;dur=1.0")],
+        "more_trailers": False,
+    }
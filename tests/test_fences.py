@@ -0,0 +1,88 @@
+from app.fences import MEDIA_TYPES, OUTPUT_FORMATS, FenceSplitter, encode_events
+
+ANSWER = (
+    "Here is the function:\n"
+    "\n"
+    "```python\n"
+    "def quote():\n"
+    "    return '``'\n"
+    "```\n"
+    "It returns ``` in a line of text.\n"
+    "~~~\n"
+    "````\n"
+    "~~~~\n"
+    "   ```js  extra\n"
+    "let x = 1;"
+)
+
+
+def split(chunks):
+    splitter = FenceSplitter()
+    events = []
+    for chunk in chunks:
+        events.extend(splitter.feed(chunk))
+    events.extend(splitter.flush())
+    # Merge deltas so differently chunked streams compare equal
+    merged = []
+    for event in events:
+        if merged and "text" in event and merged[-1]["type"] == event["type"]:
+            merged[-1] = {**event, "text": merged[-1]["text"] + event["text"]}
+        else:
+            merged.append(event)
+    return merged
+
+
+def test_fences_split_across_chunks():
+    whole = split([ANSWER])
+    char_by_char = split(list(ANSWER))
+
+    assert whole == char_by_char
+    assert whole == [
+        {"type": "explanation_delta", "text": "Here is the function:\n\n"},
+        {"type": "code_start", "lang": "python"},
+        {"type": "code_delta", "text": "def quote():\n    return '``'\n"},
+        {"type": "code_end"},
+        {
+            "type": "explanation_delta",
+            "text": "It returns ``` in a line of text.\n",
+        },
+        {"type": "code_start", "lang": None},
+        # A backtick fence cannot close a tilde block
+        {"type": "code_delta", "text": "````\n"},
+        {"type": "code_end"},
+        {"type": "code_start", "lang": "js"},
+        # An unterminated block is closed at the end of the stream
+        {"type": "code_delta", "text": "let x = 1;"},
+        {"type": "code_end"},
+    ]
+
+
+def test_text_is_passed_through_before_the_line_ends():
+    splitter = FenceSplitter()
+
+    assert splitter.feed("Some expl") == [
+        {"type": "explanation_delta", "text": "Some expl"}
+    ]
+    assert splitter.feed("anation\n``") == [
+        {"type": "explanation_delta", "text": "anation\n"}
+    ]
+    assert splitter.feed("`py") == []  # Held until the info string is complete
+    assert splitter.feed("\nx") == [
+        {"type": "code_start", "lang": "py"},
+        {"type": "code_delta", "text": "x"},
+    ]
+
+
+def test_encode_events():
+    events = [{"type": "code_start", "lang": "sql"}, {"type": "code_end"}]
+
+    assert encode_events(events, "ndjson") == (
+        '{"type": "code_start", "lang": "sql"}\n{"type": "code_end"}\n'
+    )
+    assert encode_events(events, "sse").startswith(
+        'event: code_start\ndata: {"type": "code_start", "lang": "sql"}\n\n'
+    )
+
+
+def test_every_output_format_has_a_media_type():
+    assert set(OUTPUT_FORMATS) == set(MEDIA_TYPES)
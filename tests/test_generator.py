@@ -1,7 +1,12 @@
+import asyncio
+import threading
+
 import httpx
 import pytest
 
-from app.generator import RateLimitError, StreamingCodeGenerator
+from app import metrics
+from app.generator import RateLimitError, StreamingCodeGenerator, Usage
+from app.sinks import QueuedSink
 
 
 @pytest.fixture
@@ -60,3 +65,174 @@ async def test_generate_code_with_explanation_timeout(generator, mocker):
             pass
 
     assert "Request to OpenAI API timed out." in str(exc_info.value)
+
+
+@pytest.mark.asyncio
+async def test_shared_client_is_reused_until_closed(generator):
+    await generator.start()
+    client = generator._client
+
+    async with generator._get_client() as used:
+        assert used is client
+
+    await generator.start()
+    assert generator._client is client
+
+    await generator.aclose()
+    assert client.is_closed
+    assert generator._client is None
+
+
+def mock_sse_stream(lines):
+    def mock_stream(*args, **kwargs):
+        class MockResponse:
+            status_code = 200
+            headers = {}
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, exc_type, exc_val, exc_tb):
+                pass
+
+            async def aiter_bytes(self):
+                for line in lines:
+                    yield line.encode() + b"\n\n"
+
+        return MockResponse()
+
+    return mock_stream
+
+
+@pytest.mark.asyncio
+async def test_usage_taken_from_upstream_report(generator, mocker):
+    lines = [
+        'data: {"choices": [{"delta": {"content": "Hello"}}]}',
+        'data: {"choices": [{"delta": {"content": " world"}}]}',
+        'data: {"choices": [], "usage": {"prompt_tokens": 20, "completion_tokens": 2}}',
+        "data: [DONE]",
+    ]
+    mocker.patch("httpx.AsyncClient.stream", side_effect=mock_sse_stream(lines))
+    tokenizer = mocker.patch("app.tokenizer.get_encoding").return_value
+    usage = Usage()
+    ttft_count = metrics.TIME_TO_FIRST_TOKEN.count
+    gap_count = metrics.INTER_CHUNK_GAP.count
+
+    chunks = [
+        chunk
+        async for chunk in generator.generate_code_with_explanation(
+            "Test prompt", usage=usage
+        )
+    ]
+
+    assert chunks == ["Hello", " world"]
+    assert metrics.TIME_TO_FIRST_TOKEN.count == ttft_count + 1
+    assert metrics.INTER_CHUNK_GAP.count == gap_count + 1
+    assert usage.to_dict() == {
+        "prompt_tokens": 20,
+        "completion_tokens": 2,
+        "total_tokens": 22,
+    }
+    assert not usage.estimated
+    tokenizer.encode.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_usage_estimated_once_per_stream(generator, mocker):
+    lines = [
+        'data: {"choices": [{"delta": {"content": "one "}}]}',
+        'data: {"choices": [{"delta": {"content": "two "}}]}',
+        'data: {"choices": [{"delta": {"content": "three"}}]}',
+        "data: [DONE]",
+    ]
+    mocker.patch("httpx.AsyncClient.stream", side_effect=mock_sse_stream(lines))
+    tokenizer = mocker.patch("app.tokenizer.get_encoding").return_value
+    threads = set()
+
+    def encode(text):
+        threads.add(threading.get_ident())
+        return text.split()
+
+    tokenizer.encode.side_effect = encode
+    usage = Usage()
+
+    async for _ in generator.generate_code_with_explanation("a b", usage=usage):
+        pass
+
+    assert usage.completion_tokens == 3
+    assert usage.estimated
+    # Two prompt messages plus a single encode of the whole completion
+    assert tokenizer.encode.call_count == 3
+    # All of it in a worker thread, off the event loop
+    assert threading.get_ident() not in threads
+
+
+@pytest.mark.asyncio
+async def test_async_callback_and_sinks_receive_every_chunk(mocker):
+    lines = [
+        'data: {"choices": [{"delta": {"content": "Hello"}}]}',
+        'data: {"choices": [{"delta": {"content": " world"}, "finish_reason": "stop"}]}',
+        "data: [DONE]",
+    ]
+    mocker.patch("httpx.AsyncClient.stream", side_effect=mock_sse_stream(lines))
+    mocker.patch("app.tokenizer.get_encoding")
+    seen, sunk = [], []
+
+    async def callback(chunk):
+        seen.append(chunk)
+
+    generator = StreamingCodeGenerator(
+        api_key="test-api-key", sinks=[QueuedSink(sunk.append)]
+    )
+    usage = Usage()
+
+    async for _ in generator.generate_code_with_explanation(
+        "Test prompt", callback=callback, usage=usage
+    ):
+        pass
+    await generator.aclose()
+
+    assert seen == sunk == ["Hello", " world"]
+    assert usage.finish_reason == "stop"
+
+
+@pytest.mark.asyncio
+async def test_stalled_body_after_done_is_closed_not_raised(generator, mocker):
+    closed = False
+
+    def mock_stream(*args, **kwargs):
+        class MockResponse:
+            status_code = 200
+            headers = {}
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, exc_type, exc_val, exc_tb):
+                pass
+
+            async def aiter_bytes(self):
+                yield b'data: {"choices": [{"delta": {"content": "Hi"}}]}\n\n'
+                yield b"data: [DONE]\n\n"
+                await asyncio.sleep(10)  # The upstream holds the connection open
+
+            async def aclose(self):
+                nonlocal closed
+                closed = True
+
+        return MockResponse()
+
+    mocker.patch("httpx.AsyncClient.stream", side_effect=mock_stream)
+    mocker.patch("app.tokenizer.get_encoding")
+    mocker.patch("app.generator.DRAIN_TIMEOUT", 0.05)
+
+    chunks = await asyncio.wait_for(
+        _collect(generator.generate_code_with_explanation("Test prompt")), 1.0
+    )
+
+    assert chunks == ["Hi"]
+    assert closed
+
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
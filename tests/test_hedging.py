@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from app.hedging import Hedger
+
+
+@pytest.mark.asyncio
+async def test_hedge_wins_and_slow_primary_is_cancelled():
+    hedger = Hedger(default_delay=0.01, min_delay=0.01, max_hedge_ratio=1.0)
+    calls = 0
+    primary_cancelled = asyncio.Event()
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            try:
+                await asyncio.sleep(10)
+                yield "slow"
+            except asyncio.CancelledError:
+                primary_cancelled.set()
+                raise
+        else:
+            yield "fast"
+            yield " answer"
+
+    chunks = [chunk async for chunk in hedger.stream(upstream)]
+
+    assert chunks == ["fast", " answer"]
+    assert primary_cancelled.is_set()
+    assert hedger.stats()["hedge_wins"] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedge_budget_caps_extra_requests():
+    hedger = Hedger(default_delay=0.001, min_delay=0.001, max_hedge_ratio=0.0)
+    hedger._budget = 0.0
+    calls = 0
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        yield "only"
+
+    chunks = [chunk async for chunk in hedger.stream(upstream)]
+
+    assert chunks == ["only"]
+    assert calls == 1
+    assert hedger.stats()["budget_denied"] == 1
+
+
+def test_delay_tracks_percentile_of_recent_samples():
+    hedger = Hedger(min_samples=20, min_delay=0.0)
+    for i in range(1, 101):
+        hedger.record(i / 100)
+
+    assert hedger.delay() == pytest.approx(0.95)
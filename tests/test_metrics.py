@@ -0,0 +1,47 @@
+import pytest
+
+from app.metrics import Counter, Histogram, Registry
+
+
+def test_histogram_buckets_are_cumulative_when_rendered():
+    histogram = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.samples() == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_labelled_counter_keeps_one_child_per_label_set():
+    counter = Counter("responses_total", "Responses.", ["status"])
+    counter.labels("200").inc()
+    counter.labels("200").inc()
+    counter.labels("429").inc(3)
+
+    assert counter.samples() == [
+        'responses_total{status="200"} 2',
+        'responses_total{status="429"} 3',
+    ]
+    with pytest.raises(ValueError):
+        counter.labels("200", "extra")
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    registry.counter("retries_total", "Retries.").inc()
+    registry.histogram("gap_seconds", "Gaps.", buckets=(1.0,))
+
+    text = registry.render()
+
+    assert "# HELP retries_total Retries.\n# TYPE retries_total counter\n" in text
+    assert "retries_total 1\n" in text
+    assert "# TYPE gap_seconds histogram\n" in text
+    assert text.endswith("gap_seconds_count 0\n")
+    with pytest.raises(ValueError):
+        registry.counter("retries_total", "Duplicate.")
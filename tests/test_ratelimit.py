@@ -0,0 +1,52 @@
+import pytest
+
+from app.ratelimit import RateLimiter, parse_retry_after
+
+
+@pytest.fixture
+def fake_sleep(mocker, clock):
+
+    async def sleep(seconds):
+        clock.now += seconds
+
+    mocker.patch("app.ratelimit.asyncio.sleep", side_effect=sleep)
+    return clock
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after("0.5") == 0.5
+    assert parse_retry_after(None) == 5.0
+    assert parse_retry_after("soon") == 5.0
+
+
+@pytest.mark.asyncio
+async def test_token_budget_throttles_until_refilled(fake_sleep):
+    limiter = RateLimiter(tokens_per_minute=600, clock=fake_sleep)
+
+    await limiter.acquire(600)
+    await limiter.acquire(60)  # 60 tokens refill in 6 seconds
+
+    assert fake_sleep.now == pytest.approx(6.0)
+    assert limiter.stats()["throttled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_all_callers(fake_sleep):
+    limiter = RateLimiter(clock=fake_sleep)
+
+    limiter.pause(3.0)
+    await limiter.acquire(0)
+
+    assert fake_sleep.now == pytest.approx(3.0)
+    assert limiter.stats()["retry_after_pauses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_reconcile_returns_unused_tokens(fake_sleep):
+    limiter = RateLimiter(tokens_per_minute=1000, clock=fake_sleep)
+
+    await limiter.acquire(800)
+    limiter.reconcile(800, 300)
+
+    assert limiter.stats()["tokens_available"] == 700
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from app.resume import StreamGone, StreamRegistry
+
+
+async def collect(registry, stream, last_event_id=None):
+    return [item async for item in registry.follow(stream, last_event_id)]
+
+
+@pytest.mark.asyncio
+async def test_reconnect_resumes_from_last_event_id_without_restarting():
+    registry = StreamRegistry(grace_period=10.0)
+    release = asyncio.Event()
+    calls = 0
+
+    async def source():
+        nonlocal calls
+        calls += 1
+        yield "a"
+        yield "b"
+        await release.wait()
+        yield "c"
+
+    stream = registry.create(source())
+    first = registry.follow(stream)
+    assert await first.__anext__() == (1, "a")
+    await first.aclose()  # The client drops, the generation keeps running
+
+    release.set()
+    assert await collect(registry, stream, last_event_id=1) == [(2, "b"), (3, "c")]
+    assert calls == 1
+    assert registry.stats()["resumed"] == 1
+    await registry.aclose()
+
+
+@pytest.mark.asyncio
+async def test_detached_stream_expires_and_closes_its_source():
+    registry = StreamRegistry(grace_period=0.01)
+    closed = asyncio.Event()
+
+    async def source():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+        finally:
+            closed.set()
+
+    stream = registry.create(source())
+    await asyncio.wait_for(closed.wait(), 1.0)
+
+    assert registry.get(stream.id) is None
+    assert registry.stats()["expired"] == 1
+    with pytest.raises(StreamGone):
+        await collect(registry, stream)
+
+
+@pytest.mark.asyncio
+async def test_buffers_are_bounded_per_stream_and_globally():
+    registry = StreamRegistry(max_stream_bytes=4, max_total_bytes=6)
+
+    async def source(text):
+        for char in text:
+            yield char
+
+    old = registry.create(source("xyz"))
+    await old.task
+    assert old.first_seq == 1
+
+    ring = registry.create(source("abcdef"))
+    await ring.task
+    # Only the last four chunks fit, and the detached stream made room for them
+    assert not ring.can_resume(1)
+    assert await collect(registry, ring, last_event_id=2) == [
+        (3, "c"),
+        (4, "d"),
+        (5, "e"),
+        (6, "f"),
+    ]
+    assert registry.get(old.id) is None
+    assert registry.stats()["evictions"] == 1
+    await registry.aclose()
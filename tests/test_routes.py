@@ -1,9 +1,18 @@
+import json
+
 import pytest
 from fastapi import status
 from httpx import ASGITransport, AsyncClient
 
+from app.admission import AdmissionController
 from app.main import app
-from app.routes import generator
+from app.routes import generator, response_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    if response_cache is not None:
+        response_cache.clear()
 
 
 @pytest.mark.asyncio
@@ -25,3 +34,194 @@ async def test_generate_code_success(mocker):
 
     assert response.status_code == status.HTTP_200_OK
     assert response.text == "Sample code"
+
+
+@pytest.mark.asyncio
+async def test_generate_code_sheds_load_when_queue_is_full(mocker):
+    mocker.patch(
+        "app.routes.admission", AdmissionController(max_concurrent=0, max_queue=0)
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post("/generate-code/", json={"prompt": "Test prompt"})
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+@pytest.mark.asyncio
+async def test_generate_code_batch_streams_ndjson(mocker):
+    async def mock_generate(prompt, **kwargs):
+        if prompt == "bad":
+            raise ValueError("Bad prompt")
+        yield f"code for {prompt}"
+
+    mocker.patch.object(
+        generator, "generate_code_with_explanation", side_effect=mock_generate
+    )
+    mocker.patch("app.utils.asyncio.sleep", new=mocker.AsyncMock())
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post(
+            "/generate-code/batch", json={"prompts": ["one", "bad", "two"]}
+        )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert {"id": 0, "chunk": "code for one"} in records
+    assert {"id": 2, "chunk": "code for two"} in records
+    done = {record["id"]: record for record in records if record.get("done")}
+    assert sorted(done) == [0, 1, 2]
+    assert "error" in done[1]
+
+
+@pytest.mark.asyncio
+async def test_metrics_and_server_timing(mocker):
+    async def mock_generate(prompt, **kwargs):
+        yield "Sample code"
+
+    mocker.patch.object(
+        generator, "generate_code_with_explanation", side_effect=mock_generate
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post("/generate-code/", json={"prompt": "Timed prompt"})
+        metrics = await ac.get("/metrics")
+
+    assert response.headers["Server-Timing"].startswith("queue;dur=")
+    assert metrics.status_code == status.HTTP_200_OK
+    assert metrics.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'scg_requests_total{endpoint="generate"}' in metrics.text
+    assert "# TYPE scg_time_to_first_token_seconds histogram" in metrics.text
+
+
+@pytest.mark.asyncio
+async def test_generate_code_streams_typed_events(mocker):
+    async def mock_generate(prompt, **kwargs):
+        yield "Use this:\n``"
+        yield "`python\nprint(1)\n```\n"
+
+    mocker.patch.object(
+        generator, "generate_code_with_explanation", side_effect=mock_generate
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post(
+            "/generate-code/?output=ndjson&flush=immediate",
+            json={"prompt": "Structured prompt"},
+        )
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"type": "explanation_delta", "text": "Use this:\n"},
+        {"type": "code_start", "lang": "python"},
+        {"type": "code_delta", "text": "print(1)\n"},
+        {"type": "code_end"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_resumes_from_last_event_id(mocker):
+    async def mock_generate(prompt, **kwargs):
+        yield "Intro\n"
+        yield "```sh\nls\n```\n"
+
+    generate = mocker.patch.object(
+        generator, "generate_code_with_explanation", side_effect=mock_generate
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post(
+            "/generate-code/?output=sse&flush=immediate",
+            json={"prompt": "Resumable prompt"},
+        )
+        stream_id = response.headers["X-Stream-ID"]
+        resumed = await ac.get(
+            f"/generate-code/streams/{stream_id}", headers={"Last-Event-ID": "2"}
+        )
+        unknown = await ac.get("/generate-code/streams/unknown")
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text.startswith('id: 1\nevent: explanation_delta\ndata: {"type"')
+    assert resumed.text.startswith("id: 3\n")
+    assert response.text.endswith(resumed.text)
+    assert generate.call_count == 1
+    assert unknown.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_streamed_response_is_compressed_unless_flushed_per_token(mocker):
+    async def mock_generate(prompt, **kwargs):
+        for _ in range(50):
+            yield "print('hello')\n"
+
+    mocker.patch.object(
+        generator, "generate_code_with_explanation", side_effect=mock_generate
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        coalesced = await ac.post(
+            "/generate-code/",
+            json={"prompt": "Compressed prompt"},
+            headers={"Accept-Encoding": "gzip"},
+        )
+        immediate = await ac.post(
+            "/generate-code/?flush=immediate",
+            json={"prompt": "Uncompressed prompt"},
+            headers={"Accept-Encoding": "gzip"},
+        )
+
+    assert coalesced.headers["content-encoding"] == "gzip"
+    assert coalesced.text == "print('hello')\n" * 50
+    assert "content-encoding" not in immediate.headers
+    assert immediate.text == coalesced.text
+
+
+@pytest.mark.asyncio
+async def test_truncated_completions_are_not_cached(mocker):
+    async def truncated(prompt, usage=None, **kwargs):
+        usage.finish_reason = "length"
+        yield "def cut_"
+
+    generate = mocker.patch.object(
+        generator, "generate_code_with_explanation", side_effect=truncated
+    )
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        for _ in range(2):
+            response = await ac.post(
+                "/generate-code/", json={"prompt": "Truncated prompt"}
+            )
+            assert response.text == "def cut_"
+
+    assert generate.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_unknown_flush_mode_is_rejected():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post(
+            "/generate-code/?flush=sometimes", json={"prompt": "Test prompt"}
+        )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_unknown_output_format_is_rejected():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://testserver") as ac:
+        response = await ac.post(
+            "/generate-code/?output=xml", json={"prompt": "Test prompt"}
+        )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from app.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_share_one_upstream():
+    registry = SingleFlight()
+    calls = 0
+    release = asyncio.Event()
+
+    async def source():
+        nonlocal calls
+        calls += 1
+        yield "a"
+        await release.wait()
+        yield "b"
+
+    async def consume():
+        return [chunk async for chunk in registry.stream("key", source)]
+
+    first = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    # Joins late and must still see the buffered prefix
+    second = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    release.set()
+
+    assert await first == ["a", "b"]
+    assert await second == ["a", "b"]
+    assert calls == 1
+    assert registry.stats()["coalesced"] == 1
+    assert registry.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_upstream_cancelled_when_last_subscriber_leaves():
+    registry = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def source():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    first = registry.stream("key", source)
+    second = registry.stream("key", source)
+    assert await first.__anext__() == "a"
+    assert await second.__anext__() == "a"
+
+    await first.aclose()
+    await asyncio.sleep(0)
+    assert not cancelled.is_set()
+
+    await second.aclose()
+    await asyncio.wait_for(cancelled.wait(), timeout=1.0)
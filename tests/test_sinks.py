@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.sinks import FileSink, QueuedSink
+
+
+@pytest.mark.asyncio
+async def test_slow_sink_drops_instead_of_delaying_the_stream():
+    release = asyncio.Event()
+    handled = []
+
+    async def slow(chunk):
+        await release.wait()
+        handled.append(chunk)
+
+    sink = QueuedSink(slow, max_queue=4, overflow="drop")
+    started = time.perf_counter()
+    for index in range(20):
+        await sink.put(str(index))
+    assert time.perf_counter() - started < 0.05
+
+    release.set()
+    await sink.aclose()
+    assert handled == ["0", "1", "2", "3"]
+    assert sink.stats()["dropped"] == 16
+
+
+@pytest.mark.asyncio
+async def test_block_policy_delivers_every_chunk():
+    handled = []
+
+    async def slow(chunk):
+        await asyncio.sleep(0)
+        handled.append(chunk)
+
+    sink = QueuedSink(slow, max_queue=2, overflow="block")
+    for index in range(10):
+        await sink.put(index)
+    await sink.aclose()
+
+    assert handled == list(range(10))
+    assert sink.stats()["dropped"] == 0
+
+
+@pytest.mark.asyncio
+async def test_sample_policy_thins_the_stream_under_load():
+    sink = QueuedSink(
+        lambda chunk: None, max_queue=8, overflow="sample", sample_every=4
+    )
+    for index in range(24):
+        await sink.put(index)  # The queue is not drained while this loop runs
+
+    # Four go in freely, then one in four until the queue is full
+    assert sink.stats()["queued"] == 8
+    assert sink.stats()["dropped"] == 16
+    await sink.aclose()
+
+
+@pytest.mark.asyncio
+async def test_offloaded_sink_runs_off_the_event_loop(tmp_path):
+    threads = set()
+    path = tmp_path / "chunks.log"
+    file_sink = FileSink(str(path))
+
+    def handler(chunk):
+        threads.add(threading.get_ident())
+        file_sink(chunk)
+
+    handler.close = file_sink.close
+    sink = QueuedSink(handler, offload=True)
+    for chunk in ("def ", "f():", " pass"):
+        await sink.put(chunk)
+    await sink.aclose()
+
+    assert threading.get_ident() not in threads
+    assert path.read_text() == "def f(): pass"
+    assert sink.stats()["delivered"] == 3
@@ -0,0 +1,40 @@
+from app.sse import SSEDecoder
+
+
+def decode(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    return events + decoder.flush()
+
+
+def test_events_split_across_chunks():
+    stream = b'data: {"a": 1}\n\ndata: {"b": 2}\n\n'
+    whole = decode([stream])
+    byte_by_byte = decode([bytes([byte]) for byte in stream])
+
+    assert [event.data for event in whole] == [b'{"a": 1}', b'{"b": 2}']
+    assert byte_by_byte == whole
+
+
+def test_multiline_data_and_fields():
+    events = decode(
+        [
+            b": keep-alive comment\r\n",
+            b"event: update\r",
+            b"\nid: 7\r\ndata: first\r\ndata:second\r\n\r\n",
+            b"data: third\n\n",
+        ]
+    )
+
+    assert events[0].data == b"first\nsecond"
+    assert events[0].event == "update"
+    assert events[0].id == "7"
+    # The last event ID carries over and the event type resets
+    assert events[1].event == "message"
+    assert events[1].id == "7"
+
+
+def test_flush_dispatches_unterminated_event():
+    assert [event.data for event in decode([b"data: [DONE]"])] == [b"[DONE]"]
@@ -0,0 +1,116 @@
+import sqlite3
+
+import pytest
+
+from app.store import CompletionStore, stored_stream
+
+
+@pytest.mark.asyncio
+async def test_replay_streams_in_batches_and_is_shared_across_instances(tmp_path):
+    path = str(tmp_path / "completions.db")
+    writer = CompletionStore(path)
+    chunks = [f"chunk {index} " for index in range(10)]
+    await writer.put("k", chunks)
+
+    # A second instance stands in for another worker process
+    reader = CompletionStore(path, batch_size=3)
+    assert await reader.contains("k")
+    entry = await reader.get("k")
+    assert entry.chunks == 10
+    assert entry.size == len("".join(chunks))
+
+    replay = reader.replay("k")
+    first = await replay.__anext__()
+    await writer.compact()  # Shrinking the file must not disturb the open replay
+    assert [first] + [chunk async for chunk in replay] == chunks
+
+    await writer.aclose()
+    await reader.aclose()
+
+
+@pytest.mark.asyncio
+async def test_compaction_expires_and_evicts_least_recently_used(tmp_path, clock):
+    store = CompletionStore(
+        str(tmp_path / "completions.db"),
+        max_bytes=10,
+        ttl=100.0,
+        touch_interval=0.0,
+        clock=clock,
+    )
+    await store.put("old", ["x" * 4])
+    clock.now += 50
+    await store.put("a", ["a" * 4])
+    await store.put("b", ["b" * 4])
+    clock.now += 1
+    await store.get("a")  # "b" is now least recently used
+    clock.now += 60  # "old" has expired
+
+    assert not await store.contains("old")
+    assert await store.compact() == 1
+    assert await store.contains("a") and await store.contains("b")
+
+    await store.put("c", ["c" * 4])
+    assert await store.compact() == 1
+    assert not await store.contains("b")
+    assert await store.contains("a") and await store.contains("c")
+    assert store.stats()["evictions"] == 2
+    await store.aclose()
+
+
+@pytest.mark.asyncio
+async def test_stored_stream_stores_only_finished_successful_streams(tmp_path):
+    store = CompletionStore(str(tmp_path / "completions.db"))
+    calls = 0
+
+    async def failing_source():
+        yield "partial"
+        raise ConnectionError("dropped")
+
+    async def source():
+        nonlocal calls
+        calls += 1
+        yield "hello "
+        yield "world"
+
+    with pytest.raises(ConnectionError):
+        async for _ in stored_stream(store, "k", failing_source):
+            pass
+    truncated = [
+        chunk
+        async for chunk in stored_stream(store, "k", source, should_store=lambda: False)
+    ]
+    assert truncated == ["hello ", "world"]
+    assert not await store.contains("k")
+
+    first = [chunk async for chunk in stored_stream(store, "k", source)]
+    await store.flush_writes()
+    second = [chunk async for chunk in stored_stream(store, "k", source)]
+
+    assert first == second == ["hello ", "world"]
+    assert calls == 2
+    assert store.stats()["writes"] == 1
+    assert store.stats()["hits"] == 1
+    await store.aclose()
+
+
+@pytest.mark.asyncio
+async def test_store_failures_fall_back_to_the_source(tmp_path, mocker):
+    store = CompletionStore(str(tmp_path / "completions.db"))
+
+    async def source():
+        yield "fresh"
+
+    mocker.patch.object(
+        store, "get", side_effect=sqlite3.OperationalError("database is locked")
+    )
+    put = mocker.patch.object(
+        store, "put", side_effect=sqlite3.OperationalError("database is locked")
+    )
+
+    chunks = [chunk async for chunk in stored_stream(store, "k", source)]
+
+    assert chunks == ["fresh"]
+    # The write runs after the stream has ended, and its failure is only logged
+    await store.flush_writes()
+    put.assert_awaited_once_with("k", ["fresh"])
+    await store.aclose()
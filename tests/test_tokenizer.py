@@ -0,0 +1,57 @@
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from app import tokenizer
+
+# Importing the app must stay fast and must not load any BPE data
+IMPORT_TIME_TARGET = 2.0
+
+
+def test_import_app_does_not_load_tokenizer():
+    code = (
+        "import time; start = time.perf_counter(); import app; "
+        "elapsed = time.perf_counter() - start; "
+        "import sys; from app import tokenizer; "
+        "print(elapsed, len(tokenizer._ENCODINGS), 'tiktoken' in sys.modules)"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout.split()
+
+    assert float(output[0]) < IMPORT_TIME_TARGET
+    assert output[1] == "0"
+    assert output[2] == "False"
+
+
+def test_encodings_are_shared_per_model(mocker):
+    mocker.patch.dict(tokenizer._ENCODINGS, clear=True)
+    load = mocker.patch("tiktoken.encoding_for_model", return_value=object())
+
+    first = tokenizer.get_encoding("gpt-4")
+    second = tokenizer.get_encoding("gpt-4")
+    tokenizer.prewarm_encodings(["gpt-4"]).join()
+
+    assert first is second
+    load.assert_called_once_with("gpt-4")
+
+
+@pytest.mark.asyncio
+async def test_count_tokens_runs_off_the_loop_and_falls_back(mocker):
+    loop_thread = threading.get_ident()
+    threads = []
+
+    def encode(text):
+        threads.append(threading.get_ident())
+        return text.split()
+
+    encoding = mocker.patch("app.tokenizer.get_encoding").return_value
+    encoding.encode.side_effect = encode
+
+    assert await tokenizer.count_tokens("gpt-4", "one two three") == 3
+    assert threads and threads[0] != loop_thread
+
+    encoding.encode.side_effect = RuntimeError("no BPE data")
+    assert await tokenizer.count_tokens("gpt-4", "x" * 40) == 10
@@ -1,6 +1,8 @@
+import asyncio
+
 import pytest
 
-from app.utils import async_call_with_retry_generator
+from app.utils import ContinuationTrimmer, async_call_with_retry_generator
 
 
 @pytest.mark.asyncio
@@ -14,3 +16,152 @@ async def test_async_call_with_retry_generator_success():
         result.append(item)
 
     assert result == ["chunk1", "chunk2"]
+
+
+@pytest.mark.asyncio
+async def test_async_call_with_retry_generator_resume_trims_overlap():
+    calls = []
+
+    async def flaky_generator(continuation=None):
+        calls.append(continuation)
+        if continuation is None:
+            yield "def add(a, b):"
+            yield "\n    return"
+            raise ConnectionError("stream dropped")
+        # The resumed stream repeats a little of what was already sent
+        yield "    return"
+        yield " a + b\n"
+
+    result = []
+    async for item in async_call_with_retry_generator(
+        flaky_generator, delay=0, resume=True, overlap_window=8
+    ):
+        result.append(item)
+
+    assert calls == [None, "def add(a, b):\n    return"]
+    assert "".join(result) == "def add(a, b):\n    return a + b\n"
+
+
+@pytest.mark.asyncio
+async def test_async_call_with_retry_generator_idle_timeout():
+    async def stalling_generator():
+        yield "chunk1"
+        await asyncio.sleep(10)
+        yield "chunk2"
+
+    result = []
+    with pytest.raises(asyncio.TimeoutError):
+        async for item in async_call_with_retry_generator(
+            stalling_generator, retries=1, operation_timeout=0.05
+        ):
+            result.append(item)
+            # Time spent by the consumer does not count against the idle timeout
+            await asyncio.sleep(0.1)
+
+    assert result == ["chunk1"]
+    # The task is usable again, the deadline's cancellation was cleared
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_cancellation_is_never_retried():
+    calls = 0
+
+    async def cancelled_gen():
+        nonlocal calls
+        calls += 1
+        raise asyncio.CancelledError()
+        yield  # pragma: no cover
+
+    with pytest.raises(asyncio.CancelledError):
+        async for _ in async_call_with_retry_generator(
+            cancelled_gen, retries=3, delay=0, exceptions=(BaseException,)
+        ):
+            pass
+
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_closing_the_wrapper_closes_the_attempt():
+    closed = False
+
+    async def endless_gen():
+        nonlocal closed
+        try:
+            while True:
+                yield "chunk"
+        finally:
+            closed = True
+
+    stream = async_call_with_retry_generator(endless_gen)
+    assert await stream.__anext__() == "chunk"
+    await stream.aclose()
+
+    assert closed
+
+
+def test_continuation_trimmer_keeps_short_coincidental_overlap():
+    # A shared newline is not repeated text
+    trimmer = ContinuationTrimmer("def add(a, b):\n", overlap_window=8)
+    assert trimmer.feed("\n    return a + b\n") == "\n    return a + b\n"
+
+    trimmer = ContinuationTrimmer("def add(a, b):\n    return", overlap_window=8)
+    assert trimmer.feed("    return a + b\n") == " a + b\n"
+
+
+@pytest.mark.asyncio
+async def test_async_call_with_retry_generator_without_operation_timeout():
+    async def slow_generator():
+        await asyncio.sleep(0.01)
+        yield "chunk1"
+
+    result = [
+        item
+        async for item in async_call_with_retry_generator(
+            slow_generator, operation_timeout=None, total_timeout=1.0
+        )
+    ]
+
+    assert result == ["chunk1"]
+
+
+class RetryLater(Exception):
+    def __init__(self, retry_after):
+        super().__init__("retry later")
+        self.retry_after = retry_after
+
+
+@pytest.mark.asyncio
+async def test_backoff_longer_than_operation_timeout_still_retries():
+    calls = 0
+
+    async def cooling_generator():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RetryLater(retry_after=0.3)
+        yield "chunk1"
+
+    result = [
+        item
+        async for item in async_call_with_retry_generator(
+            cooling_generator, delay=0, operation_timeout=0.1, total_timeout=5.0
+        )
+    ]
+
+    assert result == ["chunk1"]
+    assert asyncio.current_task().cancelling() == 0
+
+
+@pytest.mark.asyncio
+async def test_backoff_past_total_timeout_raises_timeout():
+    async def cooling_generator():
+        raise RetryLater(retry_after=120.0)
+        yield  # pragma: no cover
+
+    with pytest.raises(asyncio.TimeoutError):
+        async for _ in async_call_with_retry_generator(
+            cooling_generator, delay=0, total_timeout=1.0
+        ):
+            pass